@@ -1,4 +1,5 @@
 #! /bin/sh
 # wrapper script to run mkgmap
 
-exec java -Xms1g -Xmx1g -Dlog.config="${MKGMAP_HOME}/mkgmap-log.cfg" -jar "${MKGMAP_HOME}/mkgmap.jar" "$@"
\ No newline at end of file
+# heap size chosen by the caller through JAVA_TOOL_OPTIONS takes precedence over the default one
+exec java ${JAVA_TOOL_OPTIONS:--Xms1g -Xmx1g} -Dlog.config="${MKGMAP_HOME}/mkgmap-log.cfg" -jar "${MKGMAP_HOME}/mkgmap.jar" "$@"
\ No newline at end of file
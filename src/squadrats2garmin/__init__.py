@@ -1,3 +1,21 @@
-from squadrats2garmin.poly_download import main as poly_download
-from squadrats2garmin.squadrats2garmin import main as squadrats_grid
-from squadrats2garmin.visited_squadrats import main as visited_squadrats
\ No newline at end of file
+"""Console scripts of the package
+
+Entry points are imported on first access, so that every script imports only the modules it needs.
+"""
+import importlib
+
+_ENTRY_POINTS = {
+    'build_dist': 'squadrats2garmin.build_dist',
+    'poly_download': 'squadrats2garmin.poly_download',
+    'serve': 'squadrats2garmin.serve',
+    'squadrats_grid': 'squadrats2garmin.squadrats2garmin',
+    'visited_squadrats': 'squadrats2garmin.visited_squadrats',
+}
+
+__all__ = list(_ENTRY_POINTS)
+
+
+def __getattr__(name: str):
+    if name not in _ENTRY_POINTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return importlib.import_module(_ENTRY_POINTS[name]).main
@@ -0,0 +1,188 @@
+"""Incremental build of all the grids defined in the config directory
+
+Every config file is a build target. Its inputs are the config file itself, polygon files of all the regions
+it selects, mkgmap style and TYP files and the version of the tools. Only targets whose output is missing
+or whose inputs changed since the last successful build are rebuilt.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from importlib import metadata, resources
+from pathlib import Path
+
+from squadrats2garmin.common.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, FileCache, cache_key, \
+    create_file_caches, file_digest
+from squadrats2garmin.common.region import RegionIndex
+from squadrats2garmin.common.squadrats import OSM_FORMAT_VERSION
+from squadrats2garmin.common.timer import timeit
+from squadrats2garmin.squadrats2garmin import process_input_job
+
+logger = logging.getLogger(__name__)
+
+_POLYGONS_DIR = Path("config/polygons")
+
+
+def tool_version() -> str:
+    """Version of the tools, part of the fingerprint of every target"""
+    try:
+        version = metadata.version('Squadrats2Garmin')
+    except metadata.PackageNotFoundError:
+        version = 'unknown'
+    return f'{version}/{OSM_FORMAT_VERSION}'
+
+
+class BuildTarget:
+    """Single output file together with all the files it depends on
+    """
+
+    def __init__(self, config_file: Path, output: Path, inputs: list[Path]) -> None:
+        self.config_file = config_file
+        self.output = output
+        self.inputs = inputs
+
+    def __repr__(self) -> str:
+        return f'BuildTarget({self.config_file} -> {self.output})'
+
+    def fingerprint(self) -> str:
+        """Digest of all the inputs of the target"""
+        return cache_key(tool_version(), *(f'{path}:{file_digest(path)}' for path in self.inputs))
+
+    @staticmethod
+    def from_config(config_file: Path, poly_index: RegionIndex) -> BuildTarget:
+        """Resolve the dependencies of the config file: config -> regions -> polygon files"""
+        with config_file.open(encoding='UTF-8') as f:
+            config = json.load(f)
+
+        regions = poly_index.select_regions(regions=config['zoom_14']) + \
+                  poly_index.select_regions(regions=config['zoom_17'])
+        polygons = sorted({path for region in regions for path in region.source_paths})
+
+        mkgmap_resources = resources.files("squadrats2garmin.config.mkgmap")
+        style_and_typ = [
+            Path(config['style_file']) if 'style_file' in config else mkgmap_resources / "squadrats-default.style",
+            Path(config['typ_file']) if 'typ_file' in config else mkgmap_resources / "squadrats.typ.txt",
+        ]
+
+        return BuildTarget(config_file=config_file, output=Path(config['output']),
+                           inputs=[config_file, *polygons, *style_and_typ])
+
+
+class BuildState:
+    """Fingerprints of the targets from their last successful build, kept in a JSON file
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        try:
+            self._fingerprints: dict[str, str] = json.loads(path.read_text(encoding='UTF-8'))
+        except FileNotFoundError:
+            self._fingerprints = {}
+
+    def is_up_to_date(self, target: BuildTarget, fingerprint: str) -> bool:
+        return target.output.exists() and self._fingerprints.get(str(target.output)) == fingerprint
+
+    def update(self, target: BuildTarget, fingerprint: str) -> None:
+        """Record a successful build and save the state"""
+        self._fingerprints[str(target.output)] = fingerprint
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self._fingerprints, indent=2, sort_keys=True), encoding='UTF-8')
+        os.replace(tmp_path, self._path)
+
+
+# RegionIndex of the worker process, built once per worker
+_worker_poly_index: RegionIndex | None = None
+
+
+def _init_worker(verbose: bool, manifest_path: Path | None, poly_cache: FileCache | None) -> None:
+    global _worker_poly_index
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+    _worker_poly_index = RegionIndex(_POLYGONS_DIR, manifest_path=manifest_path, poly_cache=poly_cache)
+
+
+def _build(config_file: Path, osm_cache: FileCache | None, img_cache: FileCache | None) -> None:
+    with tempfile.TemporaryDirectory(prefix="mkgmap-") as tmp_dir_name:
+        with timeit(msg=f"Processing {config_file}", level=logging.INFO):
+            process_input_job(config_file=str(config_file), poly_index=_worker_poly_index,
+                              output_dir=Path(tmp_dir_name), osm_cache=osm_cache, img_cache=img_cache)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rebuild grids whose inputs changed since the last build")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="verbose output")
+    parser.add_argument('-c', '--config-files', nargs='+', type=Path, metavar='CONFIG_FILE',
+                        help="config files to build (default: all config files in the config directory)")
+    parser.add_argument('-j', '--jobs', type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help="number of config files built concurrently (default: %(default)s)")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="rebuild all targets")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="only list targets that would be rebuilt")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="do not use the cache of generated files")
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR,
+                        help=f"cache directory (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // 1024 ** 2, metavar='MB',
+                        help="maximum size of the cache in megabytes (default: %(default)s)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    manifest_path = None if args.no_cache else args.cache_dir / 'region-index.json'
+    caches = create_file_caches(cache_dir=args.cache_dir, cache_size=args.cache_size * 1024 ** 2,
+                                no_cache=args.no_cache)
+    poly_index = RegionIndex(_POLYGONS_DIR, manifest_path=manifest_path, poly_cache=caches.poly)
+    config_files = args.config_files or sorted(Path("config").glob("*.json"))
+    state = BuildState(args.cache_dir / 'build-state.json')
+
+    # resolve dependencies and find targets that need to be rebuilt
+    outdated: list[tuple[BuildTarget, str]] = []
+    for config_file in config_files:
+        target = BuildTarget.from_config(config_file=config_file, poly_index=poly_index)
+        fingerprint = target.fingerprint()
+        if args.force or not state.is_up_to_date(target=target, fingerprint=fingerprint):
+            outdated.append((target, fingerprint))
+        else:
+            logger.debug('%s is up to date', target.output)
+
+    logger.info('%d of %d targets need to be rebuilt', len(outdated), len(config_files))
+    if args.dry_run:
+        for target, _ in outdated:
+            print(f'{target.config_file} -> {target.output}')
+        return
+
+
+    failed: list[BuildTarget] = []
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker,
+                             initargs=(args.verbose, manifest_path, caches.poly)) as executor:
+        futures = {
+            executor.submit(_build, config_file=target.config_file, osm_cache=caches.osm, img_cache=caches.img):
+                (target, fingerprint)
+            for target, fingerprint in outdated
+        }
+        for future in as_completed(futures):
+            target, fingerprint = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error('Building %s failed: %s', target.output, e)
+                failed.append(target)
+            else:
+                state.update(target=target, fingerprint=fingerprint)
+
+    if failed:
+        raise SystemExit(f'{len(failed)} of {len(outdated)} targets failed')
+
+
+if __name__ == "__main__":
+    main()
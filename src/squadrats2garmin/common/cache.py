@@ -0,0 +1,189 @@
+"""Classes and functions to cache generated files on disk
+
+Cache entries are addressed by a key computed from everything that influences the content of the cached file.
+Entries are evicted in the least-recently-used order once the total size of the cache exceeds the limit.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'squadrats2garmin'
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+# shares of the cache size of the parsed polygons, generated OSM files and compiled map tiles
+_POLY_SHARE, _OSM_SHARE, _IMG_SHARE = 0.2, 0.4, 0.4
+
+
+def file_digest(path: Path) -> str:
+    """Calculate SHA-256 digest of the file content
+    """
+    with path.open('rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def cache_key(*parts) -> str:
+    """Build a cache key from the parts that determine the content of the cached file
+    """
+    return hashlib.sha256('\0'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+class FileCache:
+    """
+    Content-addressed on-disk cache of files with size-capped LRU eviction
+
+    Entries are stored as ``<root>/<key[:2]>/<key><suffix>``, the modification time of the entry
+    is refreshed on every hit and serves as the last access time.
+    """
+
+    def __init__(self, root: Path, max_size: int = DEFAULT_CACHE_SIZE, suffix: str = '') -> None:
+        self._root = root
+        self._max_size = max_size
+        self._suffix = suffix
+
+    @property
+    def root(self) -> Path:
+        return self._root
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    def _entry(self, key: str) -> Path:
+        return self._root / key[:2] / f'{key}{self._suffix}'
+
+    def get(self, key: str, dst: Path) -> bool:
+        """Copy the cached file to dst
+
+        :return: True if the entry was found in the cache
+        """
+        entry = self._entry(key)
+        try:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(entry, dst)
+            os.utime(entry)
+        except FileNotFoundError:
+            logger.debug('Cache miss %s', key)
+            return False
+
+        logger.debug('Cache hit %s -> %s', key, dst)
+        return True
+
+    def lookup(self, key: str) -> Path | None:
+        """Find the cached file to be read in place
+
+        :return: path of the entry or None if the entry is not in the cache
+        """
+        entry = self._entry(key)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            logger.debug('Cache miss %s', key)
+            return None
+
+        logger.debug('Cache hit %s', key)
+        return entry
+
+    def put(self, key: str, src: Path) -> None:
+        """Store a copy of src in the cache under the key
+        """
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+
+        # copy into a temporary file first, so that concurrent readers never see a partial entry
+        fd, tmp_name = tempfile.mkstemp(dir=entry.parent, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_name)
+            os.replace(tmp_name, entry)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+
+        logger.debug('Cached %s as %s', src, key)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits in the size limit
+        """
+        entries = []
+        for path in self._root.glob(f'*/*{self._suffix}'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self._max_size:
+                break
+            logger.debug('Evicting %s from cache', path)
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+
+class FileMemo:
+    """
+    Memo of files generated during a single run
+
+    Files are kept in the root directory (usually a temporary one) and handed out as hard links,
+    falling back to copies when linking is not possible.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self._root = root
+        self._entries: dict[str, Path] = {}
+
+    def get(self, key: str, dst: Path) -> bool:
+        """Link the memoized file to dst
+
+        :return: True if the entry was found in the memo
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(src=entry, dst=dst)
+        logger.debug('Memo hit %s -> %s', key, dst)
+        return True
+
+    def put(self, key: str, src: Path) -> None:
+        """Memoize src under the key
+        """
+        entry = self._root / f'{len(self._entries)}{src.suffix}'
+        self._root.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(src=src, dst=entry)
+        self._entries[key] = entry
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class FileCaches(NamedTuple):
+    """Caches of parsed polygons, generated OSM files and compiled map tiles, None when caching is disabled"""
+    poly: FileCache | None
+    osm: FileCache | None
+    img: FileCache | None
+
+
+def create_file_caches(cache_dir: Path, cache_size: int, no_cache: bool = False) -> FileCaches:
+    """Create the caches in subdirectories of the cache_dir
+
+    The caches share the cache_size in bytes, so that together they never take more.
+    """
+    if no_cache:
+        return FileCaches(poly=None, osm=None, img=None)
+    return FileCaches(poly=FileCache(root=cache_dir / 'poly', max_size=int(cache_size * _POLY_SHARE), suffix='.bin'),
+                      osm=FileCache(root=cache_dir / 'osm', max_size=int(cache_size * _OSM_SHARE), suffix='.osm'),
+                      img=FileCache(root=cache_dir / 'img', max_size=int(cache_size * _IMG_SHARE), suffix='.img'))
@@ -0,0 +1,179 @@
+"""Classes and methods to read GeoJSON files incrementally
+
+Features of a FeatureCollection are read one at a time and polygons of their geometries are decoded one
+at a time, so only the polygon being processed is kept in memory, not the whole document.
+"""
+import json
+from collections.abc import Iterator
+from pathlib import Path
+from typing import NamedTuple, TextIO
+
+# size of the first read, reads needed to complete a value grow with the value so that it's decoded in linear time
+_CHUNK_SIZE = 64 * 1024
+_WHITESPACE = ' \t\n\r'
+
+
+class _JSONReader:
+    """Buffer over a text file, decoding JSON values and tokens from its current position"""
+
+    def __init__(self, file: TextIO, chunk_size: int) -> None:
+        self._file = file
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read(self) -> bool:
+        """Read more data into the buffer, at least as much as is buffered already
+
+        :return: False at the end of the file
+        """
+        if self._eof:
+            return False
+        # consumed data is dropped
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        data = self._file.read(max(self._chunk_size, len(self._buffer)))
+        self._eof = not data
+        self._buffer += data
+        return not self._eof
+
+    def peek(self) -> str:
+        """Next character after whitespace, empty string at the end of the file"""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._read():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, token: str) -> None:
+        """Consume the character
+
+        :raises ValueError: when the next character is different
+        """
+        if self.peek() != token:
+            raise ValueError(f'Expected {token!r} but found {self.peek()!r}')
+        self._pos += 1
+
+    def decode(self):
+        """Decode the next value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # the value may continue past the buffer
+                if self._read():
+                    continue
+                raise
+            # a number may continue past the buffer too
+            if end == len(self._buffer) and self._read():
+                continue
+            self._pos = end
+            return value
+
+    def members(self) -> Iterator[str]:
+        """Iterate over keys of the next object, the caller consumes the value of every key"""
+        self.expect('{')
+        if self.peek() != '}':
+            while True:
+                key = self.decode()
+                self.expect(':')
+                yield key
+                if self.peek() != ',':
+                    break
+                self.expect(',')
+        self.expect('}')
+
+    def items(self) -> Iterator[None]:
+        """Iterate over the next array, the caller consumes every item"""
+        self.expect('[')
+        if self.peek() != ']':
+            while True:
+                yield
+                if self.peek() != ',':
+                    break
+                self.expect(',')
+        self.expect(']')
+
+
+class Feature(NamedTuple):
+    """Feature with the polygons of its geometry decoded one at a time
+
+    Polygons are lists of rings, the outer ring first. They have to be taken before the next feature,
+    polygons left are skipped.
+    """
+    properties: dict
+    polygons: Iterator[list]
+
+
+def iter_features(path: Path, chunk_size: int = _CHUNK_SIZE) -> Iterator[Feature]:
+    """Iterate over features of the GeoJSON FeatureCollection
+
+    Other members of the collection are decoded and skipped. Only the polygon being processed is kept
+    in memory, unless the properties of a feature follow its geometry or the type of a geometry follows
+    its coordinates, then the geometry is decoded whole.
+
+    :raises ValueError: when the file is not a JSON object
+    """
+    with path.open(encoding='utf-8') as f:
+        reader = _JSONReader(file=f, chunk_size=chunk_size)
+        for key in reader.members():
+            if key == 'features':
+                for _ in reader.items():
+                    yield from _read_feature(reader)
+            else:
+                reader.decode()
+
+
+def _read_feature(reader: _JSONReader) -> Iterator[Feature]:
+    properties: dict | None = None
+    polygons: list | None = None
+    streamed = False
+    for key in reader.members():
+        if key == 'properties':
+            properties = reader.decode() or {}
+        elif key == 'geometry' and properties is not None:
+            feature = Feature(properties=properties, polygons=_read_polygons(reader))
+            yield feature
+            # polygons not taken by the caller are skipped
+            for _ in feature.polygons:
+                pass
+            streamed = True
+        elif key == 'geometry':
+            # properties follow the geometry, which has to be kept until they are known
+            polygons = list(_read_polygons(reader))
+        else:
+            reader.decode()
+
+    if not streamed:
+        yield Feature(properties=properties or {}, polygons=iter(polygons or []))
+
+
+def _read_polygons(reader: _JSONReader) -> Iterator[list]:
+    """Iterate over polygons of the Polygon or MultiPolygon geometry, other geometries have no polygons"""
+    if reader.peek() != '{':
+        reader.decode()
+        return
+
+    geometry_type: str | None = None
+    coordinates: list | None = None
+    for key in reader.members():
+        if key == 'type':
+            geometry_type = reader.decode()
+        elif key == 'coordinates' and geometry_type == 'MultiPolygon':
+            for _ in reader.items():
+                yield reader.decode()
+        elif key == 'coordinates' and geometry_type == 'Polygon':
+            yield reader.decode()
+        elif key == 'coordinates' and geometry_type is None:
+            # type follows the coordinates, which have to be kept until it's known
+            coordinates = reader.decode()
+        else:
+            reader.decode()
+
+    if coordinates is not None and geometry_type == 'Polygon':
+        yield coordinates
+    elif coordinates is not None and geometry_type == 'MultiPolygon':
+        yield from coordinates
@@ -2,22 +2,38 @@
 """
 import itertools
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, NamedTuple
 
 from squadrats2garmin.common.region import Region
 from squadrats2garmin.common.tile import Zoom
 
+
+class Shard(NamedTuple):
+    """Band of tile rows of a region processed as a separate job
+
+    The shard owns horizontal grid lines y_start <= y < y_end and vertical grid lines
+    of tile rows y_start <= y < y_end, so that adjacent shards neither share nor miss any edge.
+    """
+    index: int
+    count: int
+    y_start: int
+    y_end: int
+
+
 class Job:
     """Representation of the job context
     """
 
-    def __init__(self, region: Region, zoom: Zoom, osm_file: Path) -> None:
+    def __init__(self, region: Region, zoom: Zoom, osm_file: Path, shard: Shard | None = None) -> None:
         self.region: Region = region
         self.zoom: Zoom = zoom
         self.osm_file: Path = osm_file
+        self.shard: Shard | None = shard
         self._id: Iterator[int] = itertools.count(start=-1, step=-1)
 
     def __str__(self) -> str:
+        if self.shard:
+            return f"{self.region.code}@{self.zoom.zoom}#{self.shard.index}/{self.shard.count}"
         return f"{self.region.code}@{self.zoom.zoom}"
 
     def next_id(self) -> int:
@@ -4,14 +4,21 @@ See https://www.mkgmap.org.uk/
 """
 from __future__ import annotations
 
+import io
 import json
 import logging
+import os
+import resource
 import shutil
 import subprocess
+import sys
+import tempfile
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 from importlib import resources
 from pathlib import Path
 
+from squadrats2garmin.common.cache import FileCache, cache_key, file_digest
 from squadrats2garmin.common.job import Job
 from squadrats2garmin.common.region import Region, RegionIndex, Subdivision
 from squadrats2garmin.common.tile import Zoom, ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS
@@ -27,12 +34,68 @@ _IMG_FAMILY_NAME = 'Squadrats2Garmin'
 _IMG_PRODUCT_ID = '1'
 _IMG_MAPNAME_PREFIX_LENGTH = 5
 
+# regions estimated to cover more tiles are split into shards, every shard being a separate map tile
+_DEFAULT_SHARD_MAX_TILES = 2_000_000
+
+# JVM heap sizing: fixed overhead plus a multiple of the OSM input size
+_MKGMAP_MIN_HEAP_MB = 512
+_MKGMAP_HEAP_OVERHEAD_MB = 256
+_MKGMAP_HEAP_PER_INPUT_MB = 3
+# share of the physical memory available to all concurrently running mkgmap processes
+_MKGMAP_MEMORY_SHARE = 0.75
+
+
+def _physical_memory() -> int | None:
+    """Size of the physical memory in bytes or None if it can't be determined"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        return None
+
+
+class MkgmapResources:
+    """JVM heap size and number of mkgmap threads for a single mkgmap run
+    """
+
+    def __init__(self, heap_mb: int, max_jobs: int) -> None:
+        self.heap_mb = heap_mb
+        self.max_jobs = max_jobs
+
+    def __repr__(self) -> str:
+        return f'MkgmapResources(heap_mb={self.heap_mb}, max_jobs={self.max_jobs})'
+
+    @staticmethod
+    def tune(input_size: int, tiles: int = 1, processes: int = 1,
+             heap_mb: int | None = None, max_jobs: int | None = None) -> MkgmapResources:
+        """Size the JVM heap and mkgmap's max-jobs for the input
+
+        :param input_size: total size of the input files in bytes
+        :param tiles: number of tiles compiled in the run, there is no point in running more threads
+        :param processes: number of mkgmap processes sharing the machine
+        :param heap_mb: heap size override
+        :param max_jobs: max-jobs override
+        """
+        if heap_mb is None:
+            heap_mb = max(_MKGMAP_MIN_HEAP_MB,
+                          _MKGMAP_HEAP_OVERHEAD_MB + _MKGMAP_HEAP_PER_INPUT_MB * input_size // 1024 ** 2)
+            memory = _physical_memory()
+            if memory:
+                heap_mb = min(heap_mb, int(memory * _MKGMAP_MEMORY_SHARE / processes) // 1024 ** 2)
+
+        if max_jobs is None:
+            max_jobs = max(1, min(tiles, (os.cpu_count() or 1) // processes))
+
+        return MkgmapResources(heap_mb=heap_mb, max_jobs=max_jobs)
+
+
 class Config(ABC):
 
     def __init__(self, output: Path, config: dict) -> None:
         config = {
             'style_file': None,
             'typ_file': None,
+            'mkgmap_max_heap': None,
+            'mkgmap_max_jobs': None,
         } | config
         self.__img_family_id = config['img_family_id']
         self.__img_family_name = config['img_family_name'] if 'img_family_name' in config else _IMG_FAMILY_NAME
@@ -43,6 +106,8 @@ class Config(ABC):
         self.__output = output
         self.__style_file = config['style_file']
         self.__typ_file = config['typ_file']
+        self.__mkgmap_max_heap = config['mkgmap_max_heap']
+        self.__mkgmap_max_jobs = config['mkgmap_max_jobs']
 
     @property
     def output_dir(self) -> Path:
@@ -73,6 +138,16 @@ class Config(ABC):
     def img_series_name(self) -> str:
         return self.__img_series_name
 
+    @property
+    def mkgmap_max_heap(self) -> int | None:
+        """mkgmap's JVM heap size in megabytes, sized automatically when not set"""
+        return self.__mkgmap_max_heap
+
+    @property
+    def mkgmap_max_jobs(self) -> int | None:
+        """Number of mkgmap's threads, sized automatically when not set"""
+        return self.__mkgmap_max_jobs
+
     @property
     def style_file(self) -> Path:
         return self.__style_file
@@ -98,11 +173,11 @@ class Config(ABC):
                 # requires Python 3.14
                 # self.__typ_file = typ_file.copy_into(self.output_dir)
 
-    def write_mkgmap_config_headers(self, config_file) -> None:
+    def write_mkgmap_config_headers(self, config_file, output_dir: Path | None = None) -> None:
         # images with 'unicode' encoding are not displayed on Garmin
         config_file.write('latin1\n')
         config_file.write('transparent\n')
-        config_file.write(f'output-dir={self.output_dir}\n')
+        config_file.write(f'output-dir={output_dir or self.output_dir}\n')
 
         config_file.write(f'family-id={self.img_family_id}\n')
         config_file.write(f'family-name={self.img_family_name}\n')
@@ -127,25 +202,18 @@ class Config(ABC):
 
         return self.output
 
-    def _run_mkgmap(self, config_path: Path) -> Path:
-        with timeit(msg=f'Running mkgmap --read-config={config_path}'):
-            result = subprocess.run(
-                ['mkgmap', f'--read-config={str(config_path)}'],
-                cwd=Path.cwd(),
-                capture_output=True,
-                text=True,
-                check=False
-            )
-            if result.returncode != 0:
-                raise RuntimeError(f'mkgmap failed: {result.stderr}')
-
-        return self._move_output_file_to_final_location()
+    def _run_mkgmap(self, config_path: Path, input_size: int, tiles: int = 1) -> None:
+        run_mkgmap(config_path=config_path,
+                   mkgmap_resources=MkgmapResources.tune(input_size=input_size, tiles=tiles,
+                                                         heap_mb=self.mkgmap_max_heap, max_jobs=self.mkgmap_max_jobs))
 
 
 class RegionConfig(Config):
     """Representation of a single input job
     """
     mapname_prefix: str
+    mkgmap_processes: int
+    shard_max_tiles: int
     regions: dict[Zoom, list[Region]]
 
     def __init__(self, output: Path, config: dict, regions_14: list[Region], regions_17: list[Region]) -> None:
@@ -158,37 +226,113 @@ class RegionConfig(Config):
         if len(self.mapname_prefix) > _IMG_MAPNAME_PREFIX_LENGTH:
             raise ValueError(f'Mapname prefix "{self.mapname_prefix}" is too long')
 
+        self.mkgmap_processes = config.get('mkgmap_processes', 1)
+        if self.mkgmap_processes < 1:
+            raise ValueError(f'Number of mkgmap processes must be positive, got {self.mkgmap_processes}')
+
+        self.shard_max_tiles = config.get('shard_max_tiles', _DEFAULT_SHARD_MAX_TILES)
+        if self.shard_max_tiles < 1:
+            raise ValueError(f'Maximum number of tiles of a shard must be positive, got {self.shard_max_tiles}')
+
         self.regions = {
             ZOOM_SQUADRATS: regions_14,
             ZOOM_SQUADRATINHOS: regions_17
         }
 
     @staticmethod
-    def parse(filename: str, poly_index: RegionIndex, output_dir: Path) -> RegionConfig:
+    def parse(filename: str, poly_index: RegionIndex, output_dir: Path, options: dict | None = None) -> RegionConfig:
         """Parse input file and return a Config object
+
+        Values in options (ie. from the command line) override the values from the input file
         """
         logger.debug("Processing input job from %s", filename)
         with open(filename, encoding='UTF-8') as config_file:
-            config = json.load(config_file) | {
-                'img_family_id': IMG_FAMILY_ID_SQUADRATS_GRID,
-                'series_name': "Squadrats grid",
-                'output_dir': output_dir
-            }
+            return RegionConfig.from_dict(config=json.load(config_file), poly_index=poly_index,
+                                          output_dir=output_dir, options=options)
 
-            regions_14: list[Region] = poly_index.select_regions(regions=config['zoom_14'])
-            regions_17: list[Region] = poly_index.select_regions(regions=config['zoom_17'])
+    @staticmethod
+    def from_dict(config: dict, poly_index: RegionIndex, output_dir: Path, options: dict | None = None) -> RegionConfig:
+        """Create a Config object from the content of an input file
 
-            return RegionConfig(output=Path(config['output']), config=config, regions_14=regions_14, regions_17=regions_17)
+        Values in options override the values from the config
+        """
+        config = config | (options or {}) | {
+            'img_family_id': IMG_FAMILY_ID_SQUADRATS_GRID,
+            'series_name': "Squadrats grid",
+            'output_dir': output_dir
+        }
 
-    def build_garmin_img(self, jobs: list[Job]) -> Path:
-        """Generate a single Garmin IMG file from multiple jobs"""
-        # generate mkgmap config file
-        config_path = self.output_dir / 'mkgmap.cfg'
+        regions_14: list[Region] = poly_index.select_regions(regions=config['zoom_14'])
+        regions_17: list[Region] = poly_index.select_regions(regions=config['zoom_17'])
+
+        return RegionConfig(output=Path(config['output']), config=config, regions_14=regions_14, regions_17=regions_17)
+
+    def assign_mapnames(self, jobs: list[Job]) -> list[tuple[str, Job]]:
+        """Assign a unique mapname to every job"""
+        # mapname_prefix is 5 characters long, and we're adding 3 digits of a sequence number
+        if len(jobs) > 999:
+            raise ValueError("Too many mapfiles to merge")
+        return [(f'{self.mapname_prefix}{sequence_number:03d}', job)
+                for sequence_number, job in enumerate(jobs, start=1)]
+
+    def tile_cache_key(self, mapname: str, job: Job) -> str:
+        """Build the key of the tile IMG file in the IMG cache
+
+        Key covers everything that makes it into the tile: OSM content, style, TYP, header options
+        and the map options (mapname, description, etc.)
+        """
+        with io.StringIO() as map_options:
+            write_mkgmap_map_options(config_file=map_options, config=self, mapname=mapname, job=job)
+            return cache_key(
+                file_digest(job.osm_file),
+                file_digest(Path(self.style_file)),
+                file_digest(Path(self.typ_file)),
+                self.img_family_id, self.img_family_name, self.img_product_id, self.img_series_name,
+                map_options.getvalue())
+
+    def prepare_tiles(self, jobs: list[Job], img_cache: FileCache | None = None) \
+            -> tuple[list[tuple[str, Job]], list[tuple[str, Job]]]:
+        """Assign mapnames to the jobs and fetch already compiled tiles from the img_cache
+
+        :return: all the tiles and the tiles that still need to be compiled
+        """
         self._use_default_style_and_typ()
-        generate_mkgmap_config(output=config_path, config=self, jobs=jobs)
 
-        # generate Garmin IMG file
-        return self._run_mkgmap(config_path=config_path)
+        tiles = self.assign_mapnames(jobs)
+        missing = [(mapname, job) for mapname, job in tiles
+                   if not (img_cache and img_cache.get(key=self.tile_cache_key(mapname=mapname, job=job),
+                                                       dst=self.tile_img(mapname)))]
+        logger.info('%s: %d of %d tiles found in the cache', self.output, len(tiles) - len(missing), len(tiles))
+        return tiles, missing
+
+    def cache_tiles(self, tiles: list[tuple[str, Job]], img_cache: FileCache) -> None:
+        """Store compiled tiles in the img_cache"""
+        for mapname, job in tiles:
+            img_cache.put(key=self.tile_cache_key(mapname=mapname, job=job), src=self.tile_img(mapname))
+
+    def combine_tiles(self, tiles: list[tuple[str, Job]]) -> Path:
+        """Combine compiled tiles and the TYP file into gmapsupp.img and move it to the final location"""
+        config_path = self.output_dir / 'mkgmap.cfg'
+        img_files = [self.tile_img(mapname) for mapname, _ in tiles]
+        generate_mkgmap_gmapsupp_config(output=config_path, config=self, img_files=img_files)
+        self._run_mkgmap(config_path=config_path, input_size=sum(img_file.stat().st_size for img_file in img_files))
+
+        return self._move_output_file_to_final_location()
+
+    def build_garmin_img(self, jobs: list[Job], img_cache: FileCache | None = None) -> Path:
+        """Generate a single Garmin IMG file from multiple jobs
+
+        Every job is compiled into a separate tile IMG file, then all the tiles are combined into gmapsupp.img.
+        Tiles found in the img_cache are not compiled again.
+        """
+        [output] = build_garmin_imgs(builds=[(self, jobs)], work_dir=self.output_dir, img_cache=img_cache,
+                                     processes=self.mkgmap_processes,
+                                     heap_mb=self.mkgmap_max_heap, max_jobs=self.mkgmap_max_jobs)
+        return output
+
+    def tile_img(self, mapname: str) -> Path:
+        """Path of the tile IMG file compiled by mkgmap for the mapname"""
+        return self.output_dir / f'{mapname}.img'
 
 
 class VisitedSquadratsConfig(Config):
@@ -231,53 +375,169 @@ class VisitedSquadratsConfig(Config):
         self.__write_mkgmap_config(config_path=config_path)
 
         # generate Garmin IMG file
-        return self._run_mkgmap(config_path=config_path)
+        self._run_mkgmap(config_path=config_path, input_size=self.osm_path.stat().st_size)
+        return self._move_output_file_to_final_location()
+
 
+def build_garmin_imgs(builds: list[tuple[RegionConfig, list[Job]]], work_dir: Path,
+                      img_cache: FileCache | None = None, processes: int = 1,
+                      heap_mb: int | None = None, max_jobs: int | None = None) -> list[Path]:
+    """Generate Garmin IMG files for multiple configs
 
-def generate_mkgmap_config(output: Path, config: RegionConfig, jobs: list[Job]):
-    """Generate mkgmap config file
+    Tiles of all the configs are compiled together, so mkgmap starts and compiles the style once,
+    not once per config. Then the tiles of every config are combined into a separate gmapsupp.img.
+    heap_mb and max_jobs override the automatically sized resources of the compiling mkgmap processes.
+    """
+    all_tiles: list[list[tuple[str, Job]]] = []
+    missing: list[tuple[RegionConfig, str, Job]] = []
+    for config, jobs in builds:
+        config_tiles, config_missing = config.prepare_tiles(jobs=jobs, img_cache=img_cache)
+        all_tiles.append(config_tiles)
+        missing.extend((config, mapname, job) for mapname, job in config_missing)
+
+    # mkgmap writes tiles named after the mapname, so configs sharing a mapname can't be compiled together
+    rounds: list[list[tuple[RegionConfig, str, Job]]] = []
+    for tile in missing:
+        free = next((r for r in rounds if all(mapname != tile[1] for _, mapname, _ in r)), None)
+        if free is None:
+            rounds.append(free := [])
+        free.append(tile)
+
+    for tiles in rounds:
+        compile_tiles(tiles=tiles, work_dir=work_dir, processes=processes, heap_mb=heap_mb, max_jobs=max_jobs)
+
+    outputs = []
+    for (config, _), config_tiles in zip(builds, all_tiles):
+        if img_cache:
+            config.cache_tiles(tiles=[(mapname, job) for c, mapname, job in missing if c is config],
+                               img_cache=img_cache)
+        outputs.append(config.combine_tiles(tiles=config_tiles))
+
+    return outputs
+
+
+def compile_tiles(tiles: list[tuple[RegionConfig, str, Job]], work_dir: Path, processes: int = 1,
+                  heap_mb: int | None = None, max_jobs: int | None = None) -> None:
+    """Compile tiles running up to processes mkgmap instances concurrently
+
+    Tiles are split into batches of similar total OSM size, one batch per mkgmap instance. mkgmap writes
+    the tiles into work_dir, from where they are moved to the output directories of their configs.
+    JVM heap and mkgmap threads of every instance are sized from the batch size unless overridden.
+    """
+    if not tiles:
+        return
+
+    batches: list[list[tuple[RegionConfig, str, Job]]] = [[] for _ in range(min(processes, len(tiles)))]
+    batch_sizes = [0] * len(batches)
+    for tile in sorted(tiles, key=lambda t: t[2].osm_file.stat().st_size, reverse=True):
+        smallest = batch_sizes.index(min(batch_sizes))
+        batches[smallest].append(tile)
+        batch_sizes[smallest] += tile[2].osm_file.stat().st_size
+
+    # keep the original order of tiles within a batch, so tiles of the same config stay together
+    order = {id(tile): position for position, tile in enumerate(tiles)}
+    runs: list[tuple[Path, MkgmapResources]] = []
+    for batch_number, (batch, batch_size) in enumerate(zip(batches, batch_sizes), start=1):
+        config_path = work_dir / f'mkgmap-tiles-{batch_number}.cfg'
+        generate_mkgmap_tiles_config(output=config_path, tiles=sorted(batch, key=lambda t: order[id(t)]),
+                                     work_dir=work_dir)
+        runs.append((config_path, MkgmapResources.tune(input_size=batch_size, tiles=len(batch),
+                                                       processes=len(batches), heap_mb=heap_mb, max_jobs=max_jobs)))
+
+    with timeit(msg=f'Compiling {len(tiles)} tiles in {len(batches)} mkgmap processes'):
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            # list() re-raises the first mkgmap failure
+            list(executor.map(lambda run: run_mkgmap(config_path=run[0], mkgmap_resources=run[1]), runs))
+
+    for config, mapname, _ in tiles:
+        tile_img = work_dir / f'{mapname}.img'
+        if tile_img != config.tile_img(mapname):
+            shutil.move(src=tile_img, dst=config.tile_img(mapname))
+
+
+def write_mkgmap_map_options(config_file, config: RegionConfig, mapname: str, job: Job,
+                             base_dir: Path | None = None) -> None:
+    """Write mkgmap options of a single map (tile)
+
+    Input file is written relative to the base_dir (directory of the mkgmap config file),
+    config's output directory by default
+    """
+    config_file.write(f'mapname={mapname}\n')
+    if job.region.get_country_code():
+        config_file.write(f'country-name={job.region.get_country_name()}\n')
+        config_file.write(f'country-abbr={job.region.get_country_code()}\n')
+    if isinstance(job.region, Subdivision):
+        config_file.write(f'region-name={job.region.name}\n')
+        config_file.write(f'region-abbr={job.region.code}\n')
+
+    shard = f' {job.shard.index}/{job.shard.count}' if job.shard else ''
+    description = (f'{job.region.name} @{job.zoom.zoom}{shard}'
+                   # country name replacements
+                   .replace(", Republic of", "")
+                   .replace("Bosnia and Herzegovina", "BiH")
+                   # region name replacements
+                   .replace(", Unitatea teritorială autonomă (UTAG)", "")
+                   .replace(", unitatea teritorială din", "")
+                   )
+    config_file.write(f'description={description}\n')
+    config_file.write(f'input-file={Path(os.path.relpath(job.osm_file, base_dir or config.output_dir))}\n')
+
+
+def generate_mkgmap_tiles_config(output: Path, tiles: list[tuple[RegionConfig, str, Job]], work_dir: Path):
+    """Generate mkgmap config file compiling every job into a separate tile IMG file in the work_dir
+    """
+    with output.open('w', encoding='UTF-8') as config_file:
+        current_config = None
+        for config, mapname, job in tiles:
+            # header options apply to all the following maps, so they need to be repeated when the config changes
+            if config is not current_config:
+                config.write_mkgmap_config_headers(config_file, output_dir=work_dir)
+                current_config = config
+            write_mkgmap_map_options(config_file=config_file, config=config, mapname=mapname, job=job,
+                                     base_dir=output.parent)
+
+
+def generate_mkgmap_gmapsupp_config(output: Path, config: Config, img_files: list[Path]):
+    """Generate mkgmap config file combining tile IMG files and TYP file into gmapsupp.img
     """
     with output.open('w', encoding='UTF-8') as config_file:
         config.write_mkgmap_config_headers(config_file)
 
-        sequence_number = 1
-        for job in jobs:
-            # mapname_prefix is 5 characters long, and we're adding 3 digits of a sequence number
-            if sequence_number > 999:
-                raise ValueError("Too many mapfiles to merge")
-            config_file.write(f'mapname={config.mapname_prefix}{sequence_number:03d}\n')
-            config_file.write(f'country-name={job.region.get_country_name()}\n')
-            config_file.write(f'country-abbr={job.region.get_country_code()}\n')
-            if isinstance(job.region, Subdivision):
-                config_file.write(f'region-name={job.region.name}\n')
-                config_file.write(f'region-abbr={job.region.code}\n')
-
-            description = (f'{job.region.name} @{job.zoom.zoom}'
-                           # country name replacements
-                           .replace(", Republic of", "")
-                           .replace("Bosnia and Herzegovina", "BiH")
-                           # region name replacements
-                           .replace(", Unitatea teritorială autonomă (UTAG)", "")
-                           .replace(", unitatea teritorială din", "")
-                           )
-            config_file.write(f'description={description}\n')
-            config_file.write(f'input-file={job.osm_file.relative_to(config.output_dir)}\n')
-
-            sequence_number += 1
+        for img_file in img_files:
+            config_file.write(f'input-file={img_file.relative_to(config.output_dir)}\n')
 
         config_file.write(f'input-file={config.typ_file.relative_to(config.output_dir)}\n')
 
         config_file.write(f'description={config.description}\n')
         config_file.write("gmapsupp\n")
 
-def run_mkgmap(config_path: Path):
-    with timeit(msg=f'Running mkgmap --read-config={config_path}'):
-        result = subprocess.run(
-            ['mkgmap', f'--read-config={str(config_path)}'],
-            cwd=Path.cwd(),
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        if result.returncode != 0:
-            raise RuntimeError(f'mkgmap failed: {result.stderr}')
+
+def _max_rss_bytes(rusage: resource.struct_rusage) -> int:
+    """Peak resident memory in bytes of the process the resource usage was reported for"""
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    return rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+
+
+def run_mkgmap(config_path: Path, mkgmap_resources: MkgmapResources | None = None):
+    command = ['mkgmap', f'--read-config={str(config_path)}']
+    env = None
+    if mkgmap_resources:
+        logger.info('Running mkgmap --read-config=%s with %d MB heap and %d jobs',
+                    config_path, mkgmap_resources.heap_mb, mkgmap_resources.max_jobs)
+        # mkgmap reads options in order, so this needs to go before the config file to be overridden by it
+        command.insert(1, f'--max-jobs={mkgmap_resources.max_jobs}')
+        java_tool_options = os.environ.get('JAVA_TOOL_OPTIONS', '')
+        env = os.environ | {'JAVA_TOOL_OPTIONS': f'{java_tool_options} -Xmx{mkgmap_resources.heap_mb}m'.strip()}
+
+    with timeit(msg=f'Running mkgmap --read-config={config_path}'), tempfile.TemporaryFile(mode='w+') as stderr:
+        # the process is reaped with wait4 to get the resource usage of this very process, not the cumulative
+        # usage of all the children, which includes mkgmap processes run before or in parallel
+        process = subprocess.Popen(command, cwd=Path.cwd(), env=env, stdout=subprocess.DEVNULL, stderr=stderr,
+                                   text=True)
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f'mkgmap failed: {stderr.read()}')
+
+    logger.info('Peak memory usage of mkgmap: %d MB', _max_rss_bytes(rusage) // 1024 ** 2)
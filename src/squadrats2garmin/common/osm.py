@@ -4,9 +4,9 @@ import itertools
 import xml.etree.ElementTree as ET
 from abc import ABC
 from pathlib import Path
-from typing import Iterator, Protocol
-
-from squadrats2garmin.common.timer import timeit
+from types import TracebackType
+from typing import Iterator, Protocol, Self
+from xml.sax.saxutils import quoteattr
 
 # all squadratinhos
 # 4^17 = 17 179 869 184
@@ -24,15 +24,55 @@ class AbstractOSMProducer(ABC, OSMProducer):
     """Abstract OSM producer class"""
 
     def __init__(self):
-        self._document: ET.Element = ET.Element("osm", {"version": '0.6'})
         self.__id_generator: Iterator[int] = itertools.count(start=1)
 
     def _next_id(self) -> int:
         return next(self.__id_generator)
 
-    def _write_document(self, file: Path):
-        with timeit(msg=f"Writing {file}"):
-            ET.ElementTree(self._document).write(file, encoding='utf-8', xml_declaration=True)
+
+class OSMWriter:
+    """
+    Write OSM elements straight to the file as they are produced, without building the document in memory
+
+    The written elements are the same as the ones built by node_to_xml, way_to_xml and multipolygon_to_xml.
+    """
+
+    def __init__(self, file: Path) -> None:
+        self._file = file.open('w', encoding='utf-8')
+        self._file.write("<?xml version='1.0' encoding='utf-8'?>\n<osm version=\"0.6\">")
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, exc_value: BaseException | None,
+                 traceback: TracebackType | None) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # incomplete document is left unterminated
+            self._file.close()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self._file.write('</osm>')
+            self._file.close()
+
+    def write_node(self, element_id: int, geom: Point) -> None:
+        self._file.write(f'<node id="{element_id}" lon="{geom[0]}" lat="{geom[1]}" />')
+
+    def write_way(self, element_id: int, refs: list[int]) -> None:
+        self._file.write(f'<way id="{element_id}">')
+        self._file.write(''.join(f'<nd ref="{ref}" />' for ref in refs))
+        self._file.write('</way>')
+
+    def write_multipolygon(self, element_id: int, outer_rings: list[int], inner_rings: list[int] = None,
+                           tags: Tags = None) -> None:
+        tags = {'type': 'multipolygon'} | (tags or {})
+        self._file.write(f'<relation id="{element_id}">')
+        self._file.write(''.join(f'<tag k={quoteattr(k)} v={quoteattr(str(v))} />' for k, v in tags.items()))
+        for role, rings in [('outer', outer_rings), ('inner', inner_rings or [])]:
+            self._file.write(''.join(f'<member type="way" ref="{way_id}" role="{role}" />' for way_id in rings))
+        self._file.write('</relation>')
 
 
 class OSMElement(ABC):
@@ -5,11 +5,26 @@ POLY file contains lines with longitude and latitude of points creating polygon.
 Points are ordered clockwise
 https://wiki.openstreetmap.org/wiki/Osmosis/Polygon_Filter_File_Format
 """
+import io
+import logging
+import re
+import tempfile
+from collections.abc import Iterator
 from pathlib import Path
 from typing import cast, Protocol
 
+import numpy as np
 import shapely
 
+from squadrats2garmin.common.cache import FileCache, cache_key, file_digest
+
+logger = logging.getLogger(__name__)
+
+# binary polygon file: magic, number of coordinates and numbers of ring, polygon and multipolygon offsets,
+# followed by (x, y) float64 coordinates and int64 offsets, see shapely.to_ragged_array
+_BINARY_MAGIC = b'S2GPOLY1'
+_BINARY_HEADER = np.dtype([('magic', 'S8'), ('sizes', '<i8', 4)])
+
 
 class PolyFileFormatException(Exception):
     """Raised when a POLY file has an incorrect format
@@ -26,6 +41,10 @@ class PolyFileIncorrectFiletypeException(PolyFileFormatException):
 
 
 class PolyLoader(Protocol):
+    @property
+    def path(self) -> Path:
+        ...
+
     def load(self) -> shapely.MultiPolygon:
         ...
 
@@ -34,6 +53,10 @@ class GeoJSONPolyLoader(PolyLoader):
     def __init__(self, path: Path):
         self._path = path
 
+    @property
+    def path(self) -> Path:
+        return self._path
+
     def load(self) -> shapely.MultiPolygon:
         geometry = shapely.orient_polygons(shapely.from_geojson(self._path.read_bytes()))
         if geometry.geom_type == 'MultiPolygon':
@@ -44,47 +67,150 @@ class GeoJSONPolyLoader(PolyLoader):
             raise PolyFileFormatException(f"Geometry type {geometry.geom_type} is not supported")
 
 
-def _read_points(file):
-    for line in file:
-        line = line.strip()
-        if line == 'END':
-            break
-        yield tuple(float(c) for c in line.split())
+# line closing a section of the POLY file
+_END_LINE = re.compile(r'^[ \t]*END[ \t]*\r?$', re.MULTILINE)
+
+
+def _parse_ring(block: str) -> np.ndarray:
+    """Convert lines with coordinates of a single ring into an array of (lon, lat) points in one NumPy call
+    """
+    try:
+        return np.loadtxt(io.StringIO(block), dtype=np.float64, ndmin=2)
+    except ValueError as e:
+        raise PolyFileFormatException(f'Invalid coordinates: {e}') from e
+
+
+def _read_rings(text: str) -> Iterator[tuple[str, np.ndarray]]:
+    """Read sections of the POLY file content (without the first line) as blocks
+
+    :return: section names and points of their rings
+    """
+    pos = 0
+    while pos < len(text):
+        line_end = text.find('\n', pos)
+        if line_end == -1:
+            line_end = len(text)
+        name = text[pos:line_end].strip()
+        if name == 'END':
+            return
+        if not name:
+            pos = line_end + 1
+            continue
+
+        end = _END_LINE.search(text, line_end + 1)
+        block_end = end.start() if end else len(text)
+        yield name, _parse_ring(text[line_end + 1:block_end])
+        pos = end.end() + 1 if end else len(text)
 
 
 class POLYPolyLoader(PolyLoader):
     def __init__(self, path: Path):
         self._path = path
 
+    @property
+    def path(self) -> Path:
+        return self._path
+
     def load(self) -> shapely.MultiPolygon:
-        with self._path.open(encoding='UTF-8') as f:
-            filetype = f.readline().rstrip('\n')
-            if filetype != 'polygon':
-                raise PolyFileIncorrectFiletypeException(filetype)
-
-            polygons: list[shapely.Polygon] = []
-            shell: shapely.LineString = None
-            holes: list[shapely.LineString] = []
-
-            for line in f:
-                line = line.strip()
-                if line == 'END':
-                    break
-                if line.startswith('!'):
-                    holes.append(shapely.LinearRing([p for p in _read_points(f)]))
-                else:
-                    if shell:
-                        polygons.append(shapely.Polygon(shell=shell.coords, holes=tuple(h.coords for h in holes)))
-                        holes = []
-                    shell = shapely.LinearRing([p for p in _read_points(f)])
-
-            if shell:
-                polygons.append(shapely.Polygon(shell=shell.coords, holes=tuple(h.coords for h in holes)))
-
-            return shapely.orient_polygons(shapely.MultiPolygon(polygons))
+        filetype, _, text = self._path.read_text(encoding='UTF-8').partition('\n')
+        if filetype != 'polygon':
+            raise PolyFileIncorrectFiletypeException(filetype)
+
+        polygons: list[shapely.Polygon] = []
+        shell: np.ndarray | None = None
+        holes: list[np.ndarray] = []
+
+        # polygons are built straight from the coordinate arrays
+        for name, ring in _read_rings(text):
+            if name.startswith('!'):
+                holes.append(ring)
+            else:
+                if shell is not None:
+                    polygons.append(shapely.Polygon(shell=shell, holes=holes))
+                    holes = []
+                shell = ring
+
+        if shell is not None:
+            polygons.append(shapely.Polygon(shell=shell, holes=holes))
+
+        return shapely.orient_polygons(shapely.MultiPolygon(polygons))
+
+
+def write_binary_poly(path: Path, geoms: shapely.MultiPolygon) -> None:
+    """Write the MultiPolygon as coordinate and offset arrays"""
+    _, coords, offsets = shapely.to_ragged_array([geoms])
+    header = np.array([(_BINARY_MAGIC, [len(coords), *(len(o) for o in offsets)])], dtype=_BINARY_HEADER)
+    with path.open('wb') as f:
+        f.write(header.tobytes())
+        f.write(np.ascontiguousarray(coords, dtype='<f8').tobytes())
+        for o in offsets:
+            f.write(np.ascontiguousarray(o, dtype='<i8').tobytes())
+
+
+def read_binary_poly(path: Path) -> shapely.MultiPolygon:
+    """Read the MultiPolygon written by write_binary_poly, the arrays are memory mapped instead of parsed
+
+    :raises PolyFileFormatException: when the file is not a valid binary polygon file
+    """
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if len(data) < _BINARY_HEADER.itemsize:
+        raise PolyFileFormatException(f'Binary polygon file {path} is truncated')
+    header = data[:_BINARY_HEADER.itemsize].view(_BINARY_HEADER)[0]
+    if header['magic'] != _BINARY_MAGIC:
+        raise PolyFileFormatException(f'Binary polygon file {path} has unknown format')
+
+    n_coords, *n_offsets = (int(n) for n in header['sizes'])
+    if len(data) != _BINARY_HEADER.itemsize + 16 * n_coords + 8 * sum(n_offsets):
+        raise PolyFileFormatException(f'Binary polygon file {path} is truncated')
+
+    pos = _BINARY_HEADER.itemsize
+    coords = data[pos:pos + 16 * n_coords].view('<f8').reshape(-1, 2)
+    pos += 16 * n_coords
+    offsets = []
+    for n in n_offsets:
+        offsets.append(data[pos:pos + 8 * n].view('<i8'))
+        pos += 8 * n
+
+    return shapely.from_ragged_array(shapely.GeometryType.MULTIPOLYGON, coords, tuple(offsets))[0]
+
+
+class CachedPolyLoader(PolyLoader):
+    """
+    Keep parsed and oriented polygons in a binary form in the cache, keyed by the digest of the source file
+
+    Changed source file gets a new key, so stale entries are never used and eventually evicted.
+    """
+    # bump whenever a change in the loaders alters the loaded polygons
+    FORMAT_VERSION = 1
+
+    def __init__(self, delegate: PolyLoader, cache: FileCache):
+        self._delegate = delegate
+        self._cache = cache
+
+    @property
+    def path(self) -> Path:
+        return self._delegate.path
+
+    def load(self) -> shapely.MultiPolygon:
+        key = cache_key(file_digest(self.path), self.FORMAT_VERSION)
+
+        entry = self._cache.lookup(key)
+        if entry is not None:
+            try:
+                return read_binary_poly(entry)
+            except (OSError, PolyFileFormatException) as e:
+                logger.warning('Ignoring cached polygon of %s: %s', self.path, e)
+
+        geoms = self._delegate.load()
+        with tempfile.TemporaryDirectory(prefix='squadrats-poly-') as tmp_dir_name:
+            binary_path = Path(tmp_dir_name) / 'poly.bin'
+            write_binary_poly(binary_path, geoms)
+            self._cache.put(key=key, src=binary_path)
+        return geoms
+
 
 class ExtensionAwarePolyLoader(PolyLoader):
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, cache: FileCache | None = None):
         match path.suffix:
             case '.poly':
                 self._delegate = POLYPolyLoader(path)
@@ -92,6 +218,12 @@ class ExtensionAwarePolyLoader(PolyLoader):
                 self._delegate = GeoJSONPolyLoader(path)
             case _:
                 raise ValueError(f"Don't know how to parse file with '{path.suffix}' extension")
+        if cache is not None:
+            self._delegate = CachedPolyLoader(delegate=self._delegate, cache=cache)
+
+    @property
+    def path(self) -> Path:
+        return self._delegate.path
 
     def load(self) -> shapely.MultiPolygon:
         return self._delegate.load()
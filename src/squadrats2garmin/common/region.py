@@ -1,17 +1,104 @@
 """Classes and functions to handle ISO-3166 regions
 """
+from __future__ import annotations
+
+import hashlib
+import json
 import logging
+import os
 import re
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import NamedTuple
 
-import pycountry
 import shapely
 
-from squadrats2garmin.common.poly import PolyLoader, ExtensionAwarePolyLoader
+from squadrats2garmin.common.cache import FileCache
+from squadrats2garmin.common.poly import PolyFileFormatException, PolyLoader, ExtensionAwarePolyLoader
+from squadrats2garmin.common.timer import timeit
+from squadrats2garmin.common.track import corridor, corridor_extent, load_track
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_GEOMETRY_CACHE_VERTICES = 5_000_000
+# distance of the corridor boundary from the track in meters
+DEFAULT_ROUTE_BUFFER = 250.0
+# names of the areas, which are used in file names
+_AREA_NAME = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]*$')
+
+
+class GeometryCache:
+    """
+    LRU cache of region coordinates shared by the regions, bounded by the total number of vertices
+
+    Least recently used coordinates are evicted once the limit is exceeded and loaded again on demand.
+    The most recently loaded coordinates are always kept, even if they alone exceed the limit.
+    """
+
+    def __init__(self, max_vertices: int = DEFAULT_GEOMETRY_CACHE_VERTICES) -> None:
+        self._max_vertices = max_vertices
+        self._vertices = 0
+        self._entries: OrderedDict[Path, tuple[shapely.MultiPolygon, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def vertices(self) -> int:
+        """Total number of vertices of the cached coordinates"""
+        return self._vertices
+
+    def get(self, key: Path, load: Callable[[], shapely.MultiPolygon]) -> shapely.MultiPolygon:
+        """Return the cached coordinates, load them if missing"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # load outside the lock, so that other regions can be served in the meantime
+        geoms = load()
+        vertices = shapely.get_num_coordinates(geoms)
+
+        with self._lock:
+            if key in self._entries:
+                # loaded concurrently by another thread
+                return self._entries[key][0]
+            self._entries[key] = (geoms, vertices)
+            self._vertices += vertices
+            while self._vertices > self._max_vertices and len(self._entries) > 1:
+                evicted_key, (_, evicted_vertices) = self._entries.popitem(last=False)
+                self._vertices -= evicted_vertices
+                self.evictions += 1
+                logger.debug('Evicted coordinates of %s (%d vertices)', evicted_key, evicted_vertices)
+
+        return geoms
+
+    def discard(self, key: Path) -> None:
+        """Remove the coordinates from the cache"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._vertices -= entry[1]
+
+    def log_stats(self) -> None:
+        logger.info('Geometry cache: %d hits, %d misses, %d evictions, %d vertices in %d regions',
+                    self.hits, self.misses, self.evictions, self._vertices, len(self._entries))
+
+
+# cache used by regions unless given another one
+GEOMETRY_CACHE = GeometryCache()
+
+
 def get_country_code(code: str) -> str:
     """Match the input string with a pattern for ISO 3166-1 alpha-2 country code
     """
@@ -22,15 +109,49 @@ def get_subdivision_code(code: str) -> str:
     """
     return code if re.match(r'^[A-Z0-9]{1,3}$', code) else None
 
+def get_country_name(iso_code: str) -> str:
+    """Look up the name of the ISO 3166-1 country
+    """
+    # pycountry is imported on the first lookup, regions in the index manifest don't need it at all
+    import pycountry
+
+    country = pycountry.countries.get(alpha_2=iso_code)
+    if not country:
+        raise ValueError(f"Illegal country ISO code {iso_code}")
+    return country.name
+
+def get_subdivision_name(iso_code: str) -> str:
+    """Look up the name of the ISO 3166-2 subdivision
+    """
+    import pycountry
+
+    subdivision = pycountry.subdivisions.get(code=iso_code)
+    if not subdivision:
+        raise ValueError(f'Illegal subdivision ISO code {iso_code}')
+    return subdivision.name
+
+
+class Footprint(NamedTuple):
+    """Bounding box and area of the region coordinates, enough to plan the grid without the coordinates
+    """
+    bbox: tuple[float, float, float, float]
+    area: float
+
+    @staticmethod
+    def of(geometry: shapely.Geometry) -> Footprint:
+        return Footprint(bbox=tuple(geometry.bounds), area=geometry.area)
+
 
 class Region(ABC):
     """Abstract base class for regions
     """
-    def __init__(self, iso_code: str, name: str, poly_loader: PolyLoader):
+    def __init__(self, iso_code: str, name: str, poly_loader: PolyLoader, geometry_cache: GeometryCache | None = None,
+                 footprint: Footprint | None = None):
         self._iso_code: str = iso_code
         self._name: str = name
-        self._geoms: shapely.MultiPolygon | None = None
         self._poly_loader = poly_loader
+        self._geometry_cache = geometry_cache or GEOMETRY_CACHE
+        self._footprint = footprint
 
     @property
     def code(self) -> str:
@@ -49,12 +170,35 @@ class Region(ABC):
         """
         Get region coordinates
 
-        Coordinates are loaded on demand and memorised
+        Coordinates are loaded on demand and kept in the geometry cache
+        """
+        if self._poly_loader is None:
+            return None
+
+        return self._geometry_cache.get(key=self._poly_loader.path, load=self._poly_loader.load)
+
+    @property
+    def footprint(self) -> Footprint:
         """
-        if self._geoms is None and self._poly_loader is not None:
-            self._geoms = self._poly_loader.load()
+        Get the bounding box and the area of the region coordinates
 
-        return self._geoms
+        Footprint known in advance (ie. from the RegionIndex manifest) is used without loading the coordinates
+        """
+        return self._footprint or Footprint.of(self.coords)
+
+    @property
+    def poly_path(self) -> Path | None:
+        """
+        Get the path of the file with region coordinates
+        """
+        return self._poly_loader.path if self._poly_loader is not None else None
+
+    @property
+    def source_paths(self) -> list[Path]:
+        """
+        Get the paths of all the files the region coordinates are read from
+        """
+        return [self.poly_path] if self.poly_path is not None else []
 
     @property
     def has_coords(self) -> bool:
@@ -63,6 +207,20 @@ class Region(ABC):
         """
         return self._poly_loader is not None
 
+    def invalidate(self) -> None:
+        """
+        Forget cached coordinates, they are loaded again on the next access
+        """
+        if self._poly_loader is not None:
+            self._geometry_cache.discard(self._poly_loader.path)
+
+    @property
+    def grid_parameters(self) -> tuple:
+        """
+        Parameters other than the content of the polygon file that influence the generated grid
+        """
+        return ()
+
     @abstractmethod
     def get_country_code(self) -> str:
         """Get region country code
@@ -79,12 +237,14 @@ class Subdivision(Region):
     """
     country: Region
 
-    def __init__(self, country: Region, iso_code: str, poly_loader: PolyLoader):
-        subdivision = pycountry.subdivisions.get(code=iso_code)
-        if not subdivision:
-            raise ValueError(f'Illegal subdivision ISO code {iso_code}')
+    def __init__(self, country: Region, iso_code: str, poly_loader: PolyLoader,
+                 geometry_cache: GeometryCache | None = None, name: str | None = None,
+                 footprint: Footprint | None = None):
+        if name is None:
+            name = get_subdivision_name(iso_code)
 
-        super().__init__(iso_code=iso_code, name=subdivision.name, poly_loader=poly_loader)
+        super().__init__(iso_code=iso_code, name=name, poly_loader=poly_loader, geometry_cache=geometry_cache,
+                         footprint=footprint)
         self.country = country
 
     def __repr__(self):
@@ -113,13 +273,14 @@ class Country(Region):
     Representation of the ISO 3166-1 country
     """
 
-    def __init__(self, iso_code: str, poly_loader: PolyLoader = None) -> None:
-        country = pycountry.countries.get(alpha_2=iso_code)
-        if not country:
-            raise ValueError(f"Illegal country ISO code {iso_code}")
+    def __init__(self, iso_code: str, poly_loader: PolyLoader = None,
+                 geometry_cache: GeometryCache | None = None, name: str | None = None,
+                 footprint: Footprint | None = None) -> None:
+        if name is None:
+            name = get_country_name(iso_code)
 
-        super().__init__(iso_code=iso_code, name=country.name, poly_loader=poly_loader)
-        self.__country: pycountry.db.Country = country
+        super().__init__(iso_code=iso_code, name=name, poly_loader=poly_loader, geometry_cache=geometry_cache,
+                         footprint=footprint)
         # subdivisions multimap (should be a regular dictionary but Norway was special)
         self.__subdivisions: dict[str, list[Subdivision]] = {}
 
@@ -130,13 +291,15 @@ class Country(Region):
         return self.code
 
     def get_country_name(self) -> str:
-        return self.__country.name
+        return self._name
 
-    def add_subdivision(self, iso_code: str, poly_loader: PolyLoader):
+    def add_subdivision(self, iso_code: str, poly_loader: PolyLoader, name: str | None = None,
+                        footprint: Footprint | None = None):
         """
         Register a subdivision polygon
         """
-        subdivision = Subdivision(country=self, iso_code=iso_code, poly_loader=poly_loader)
+        subdivision = Subdivision(country=self, iso_code=iso_code, poly_loader=poly_loader,
+                                  geometry_cache=self._geometry_cache, name=name, footprint=footprint)
         if iso_code not in self.__subdivisions:
             self.__subdivisions[iso_code] = [subdivision]
         else:
@@ -153,58 +316,536 @@ class Country(Region):
         return None
 
 
-class RegionIndex:
+class Route(Region):
     """
-    Loads polygons for all regions found in the filesystem
+    Corridor along a track read from GPX or GeoJSON file
+
+    Routes are not part of the RegionIndex, the track and the corridor are loaded on the first access
+    and kept by the route. Tiles of the corridor are found by walking the track in tile space,
+    or by clipping the buffered corridor polygon like any other region when the method is 'buffer'.
     """
+    METHODS = ['walk', 'buffer']
+
+    def __init__(self, path: Path, buffer: float = DEFAULT_ROUTE_BUFFER, method: str = 'walk') -> None:
+        if not isinstance(buffer, (int, float)) or buffer <= 0:
+            raise ValueError(f'Route buffer must be a positive number of meters, got {buffer}')
+        if method not in self.METHODS:
+            raise ValueError(f'Invalid route method {method}, expecting one of {self.METHODS}')
+        if not path.is_file():
+            raise ValueError(f'Missing route file {path}')
+
+        # routes of the same name in different directories get different codes and so different OSM files
+        digest = hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:8]
+        super().__init__(iso_code=f'route-{path.stem}-{digest}', name=path.stem, poly_loader=None)
+        self.buffer = float(buffer)
+        self.method = method
+        self._path = path
+        self._track: shapely.MultiLineString | None = None
+        self._coords: shapely.MultiPolygon | None = None
+        self._lock = threading.Lock()
 
-    def __init__(self, root_path: Path):
-        self.country: dict[str, Country] = {}
+    def __repr__(self):
+        return f'Route("{self._path}", {self.buffer}, {self.method})'
 
-        logger.debug('Building polygon index from "%s"', root_path)
-        input_files = filter(lambda path: path.is_file() and path.suffix in ['.geojson', '.poly'],
-                             root_path.rglob('*'))
-        for path in input_files:
-            codes = path.stem.split("-", maxsplit=2)
+    @property
+    def track(self) -> shapely.MultiLineString:
+        """Get the track the corridor follows"""
+        with self._lock:
+            if self._track is None:
+                self._track = load_track(self._path)
+            return self._track
 
-            country_code = get_country_code(codes[0])
-            if not country_code:
-                logger.debug('File "%s" does not contain country code in the name - skipping',
-                              path)
-                continue
+    @property
+    def coords(self) -> shapely.MultiPolygon:
+        """Get the corridor polygon"""
+        track = self.track
+        with self._lock:
+            if self._coords is None:
+                with timeit(msg=f'{self.code}: buffering track by {self.buffer} m'):
+                    self._coords = corridor(track=track, buffer=self.buffer)
+            return self._coords
 
-            # country poly
-            if len(codes) == 1:
-                self._add_country(country_code, path)
-                continue
+    @property
+    def footprint(self) -> Footprint:
+        """Footprint of the corridor estimated from the track, the corridor is not built"""
+        bbox, area = corridor_extent(track=self.track, buffer=self.buffer)
+        return Footprint(bbox=bbox, area=area)
 
-            subdivision_code = get_subdivision_code(codes[1])
-            if not subdivision_code:
-                self._add_country(country_code, path)
-                continue
+    @property
+    def poly_path(self) -> Path:
+        return self._path
 
-            self._add_subdivision(country_code, subdivision_code, path)
+    @property
+    def has_coords(self) -> bool:
+        return True
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._track, self._coords = None, None
+
+    @property
+    def grid_parameters(self) -> tuple:
+        return self.buffer, self.method
+
+    def get_country_code(self) -> str:
+        return ''
+
+    def get_country_name(self) -> str:
+        return ''
 
-    def _add_country(self, country_code: str, poly_path: Path):
-        self.country[country_code] = Country(iso_code=country_code, poly_loader=ExtensionAwarePolyLoader(poly_path))
 
-    def _add_subdivision(self, country_code: str, subdivision_code: str, poly_path: Path):
-        iso_code = "-".join([country_code, subdivision_code])
+class Area(Region):
+    """
+    Ad-hoc region given by a bounding box or a polygon, optionally limited to another region
+
+    Polygon of the area limited to a region is the intersection with the region coordinates, the region
+    provides the country and the name. Polygon files are loaded on the first access and kept by the area.
+    Areas are not part of the RegionIndex.
+    """
 
-        if not country_code in self.country:
-            self.country[country_code] = Country(iso_code=country_code)
+    def __init__(self, code: str, geometry: shapely.Geometry | None = None, poly_loader: PolyLoader | None = None,
+                 within: Region | None = None, name: str | None = None, source_path: Path | None = None) -> None:
+        name = name or code
+        super().__init__(iso_code=code, name=name if within is None else f'{within.name} - {name}',
+                         poly_loader=poly_loader)
+        self.within = within
+        # polygon file the geometry was read from, when it's not loaded by the area itself
+        self._source_path = source_path
+        self._geometry = geometry
+        self._coords: shapely.MultiPolygon | None = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'Area("{self.code}")'
 
-        self.country[country_code].add_subdivision(iso_code=iso_code, poly_loader=ExtensionAwarePolyLoader(poly_path))
+    @property
+    def coords(self) -> shapely.MultiPolygon:
+        """Get the polygon of the area
+
+        :raises ValueError: when the area is empty
+        """
+        with self._lock:
+            if self._coords is None:
+                geometry = self._poly_loader.load() if self._poly_loader is not None else self._geometry
+                polygons = area_polygons(geometry)
+                if not polygons:
+                    raise ValueError(f'Area {self.code} is empty')
+                self._coords = shapely.orient_polygons(shapely.MultiPolygon(polygons))
+            return self._coords
 
-    def select_regions(self, regions: list[str]) -> list[Region]:
+    @property
+    def poly_path(self) -> Path | None:
+        if self._poly_loader is not None:
+            return self._poly_loader.path
+        return self.within.poly_path if self.within is not None else None
+
+    @property
+    def source_paths(self) -> list[Path]:
+        own = self._poly_loader.path if self._poly_loader is not None else self._source_path
+        return ([own] if own is not None else []) + (self.within.source_paths if self.within is not None else [])
+
+    @property
+    def has_coords(self) -> bool:
+        return True
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._coords = None
+
+    @property
+    def grid_parameters(self) -> tuple:
+        return (hashlib.sha256(shapely.to_wkb(self.coords)).hexdigest(),)
+
+    def get_country_code(self) -> str:
+        return self.within.get_country_code() if self.within is not None else ''
+
+    def get_country_name(self) -> str:
+        return self.within.get_country_name() if self.within is not None else ''
+
+
+class RegionEntry(NamedTuple):
+    """Record of a single polygon file in the RegionIndex manifest
+    """
+    path: str
+    country_code: str
+    country_name: str
+    subdivision_code: str | None
+    subdivision_name: str | None
+    mtime_ns: int
+    size: int
+    bbox: tuple[float, float, float, float] | None = None
+    vertices: int | None = None
+    area: float | None = None
+
+    @property
+    def code(self) -> str:
+        return self.subdivision_code or self.country_code
+
+    @property
+    def footprint(self) -> Footprint | None:
+        return Footprint(bbox=self.bbox, area=self.area) if self.bbox and self.area is not None else None
+
+
+class _CountryMap(Mapping[str, Country]):
+    """Countries of the RegionIndex created on the first access"""
+
+    def __init__(self, codes: Iterable[str], create: Callable[[str], Country]) -> None:
+        self._codes = set(codes)
+        self._create = create
+        self._countries: dict[str, Country] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, code: str) -> Country:
+        with self._lock:
+            country = self._countries.get(code)
+            if country is None:
+                if code not in self._codes:
+                    raise KeyError(code)
+                country = self._countries[code] = self._create(code)
+            return country
+
+    def __contains__(self, code: object) -> bool:
+        return code in self._codes
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(sorted(self._codes))
+
+    def __len__(self) -> int:
+        return len(self._codes)
+
+
+def area_polygons(geometry: shapely.Geometry) -> list[shapely.Polygon]:
+    """Non-empty polygons of the geometry, lines and points (ie. along the boundaries of intersected polygons)
+    are dropped
+    """
+    return [part for part in shapely.get_parts(shapely.get_parts(geometry))
+            if part.geom_type == 'Polygon' and part.area > 0]
+
+
+def parse_geometry(value: list[float] | dict) -> shapely.Geometry:
+    """Parse [min_lon, min_lat, max_lon, max_lat] bounding box or GeoJSON geometry
+
+    :raises ValueError: when the value is neither
+    """
+    if isinstance(value, list) and len(value) == 4 and all(isinstance(v, (int, float)) for v in value):
+        return shapely.box(*value)
+    if isinstance(value, dict):
+        try:
+            return shapely.from_geojson(json.dumps(value))
+        except shapely.errors.GEOSException as e:
+            raise ValueError(f'Invalid GeoJSON geometry: {e}') from e
+    raise ValueError(f'Invalid geometry: {value}')
+
+
+class RegionSpatialIndex:
+    """
+    STRtree over the bounding boxes of the regions
+
+    Candidates found in the tree are tested against the prepared region coordinates, which are kept
+    in the geometry cache, so that repeated queries don't prepare the same polygons again.
+    """
+
+    def __init__(self, regions: list[Region], bounds: list[tuple[float, float, float, float]]) -> None:
+        self._regions = regions
+        self._tree = shapely.STRtree(shapely.box(*zip(*bounds)) if bounds else [])
+
+    def query(self, geometry: shapely.Geometry) -> list[Region]:
+        """Regions intersecting the geometry (point, bounding box, track, ...) in the index order"""
+        result = []
+        for i in sorted(self._tree.query(geometry)):
+            coords = self._regions[i].coords
+            shapely.prepare(coords)
+            if coords.intersects(geometry):
+                result.append(self._regions[i])
+        return result
+
+
+class RegionIndex:
+    """
+    Loads polygons for all regions found in the filesystem
+
+    Names of the polygon files are parsed into a manifest of RegionEntry records. When a manifest file
+    is given, the manifest is kept there together with the bounding boxes, the numbers of vertices and the areas
+    of the polygons, and only entries of new or changed files are built again on the next start.
+    Country and Subdivision objects are created on demand. When a polygon cache is given, parsed polygons
+    are kept there in a binary form. The spatial index is built on the first geometric query from the bounding
+    boxes in the manifest.
+    """
+    _MANIFEST_VERSION = 2
+
+    def __init__(self, root_path: Path, geometry_cache: GeometryCache | None = None,
+                 manifest_path: Path | None = None, poly_cache: FileCache | None = None):
+        self.geometry_cache = geometry_cache or GEOMETRY_CACHE
+        self.manifest_path = manifest_path
+        self.poly_cache = poly_cache
+        self._root_path = root_path
+
+        logger.debug('Building polygon index from "%s"', root_path)
+        cached = self._load_manifest()
+        self._entries: dict[str, RegionEntry] = {}
+        for path in self._scan():
+            relative_path = path.relative_to(root_path).as_posix()
+            stat = path.stat()
+            entry = cached.get(relative_path)
+            if entry is None or (entry.mtime_ns, entry.size) != (stat.st_mtime_ns, stat.st_size):
+                entry = self._create_entry(path=path, relative_path=relative_path, stat=stat)
+            if entry is not None:
+                self._entries[relative_path] = entry
+
+        if self.manifest_path is not None and self._entries != cached:
+            self._save_manifest()
+
+        self._entries_by_country: dict[str, list[RegionEntry]] = {}
+        for entry in self._entries.values():
+            self._entries_by_country.setdefault(entry.country_code, []).append(entry)
+        self.country: Mapping[str, Country] = _CountryMap(codes=self._entries_by_country.keys(),
+                                                          create=self._create_country)
+        self._spatial_index: RegionSpatialIndex | None = None
+        self._spatial_index_lock = threading.Lock()
+
+    def _scan(self) -> list[Path]:
+        return sorted(Path(dir_path) / file_name
+                      for dir_path, _, file_names in os.walk(self._root_path)
+                      for file_name in file_names
+                      if Path(file_name).suffix in ['.geojson', '.poly'])
+
+    def _create_entry(self, path: Path, relative_path: str, stat: os.stat_result) -> RegionEntry | None:
+        codes = path.stem.split("-", maxsplit=2)
+
+        country_code = get_country_code(codes[0])
+        if not country_code:
+            logger.debug('File "%s" does not contain country code in the name - skipping',
+                          path)
+            return None
+
+        # country poly, unless the name contains a subdivision code
+        subdivision_code = get_subdivision_code(codes[1]) if len(codes) > 1 else None
+        iso_code = "-".join([country_code, subdivision_code]) if subdivision_code else None
+
+        bbox, vertices, area = None, None, None
+        if self.manifest_path is not None:
+            # loading the polygon is paid only once, the manifest is persisted
+            try:
+                geoms = self._poly_loader(path).load()
+                bbox, vertices, area = tuple(geoms.bounds), int(shapely.get_num_coordinates(geoms)), geoms.area
+            except (PolyFileFormatException, OSError, shapely.errors.GEOSException) as e:
+                # the file is indexed anyway, the error is raised again when the region is used
+                logger.error("Polygon file %s can't be loaded: %s", path, e)
+
+        return RegionEntry(path=relative_path, country_code=country_code,
+                           country_name=get_country_name(country_code),
+                           subdivision_code=iso_code,
+                           subdivision_name=get_subdivision_name(iso_code) if iso_code else None,
+                           mtime_ns=stat.st_mtime_ns, size=stat.st_size, bbox=bbox, vertices=vertices, area=area)
+
+    def _poly_loader(self, path: Path) -> PolyLoader:
+        return ExtensionAwarePolyLoader(path, cache=self.poly_cache)
+
+    def _load_manifest(self) -> dict[str, RegionEntry]:
+        if self.manifest_path is None:
+            return {}
+        try:
+            manifest = json.loads(self.manifest_path.read_text(encoding='UTF-8'))
+        except (OSError, ValueError) as e:
+            logger.debug('Polygon index manifest %s not loaded: %s', self.manifest_path, e)
+            return {}
+        if manifest.get('version') != self._MANIFEST_VERSION or manifest.get('root') != str(self._root_path):
+            return {}
+        return {
+            path: RegionEntry(**(entry | {'bbox': tuple(entry['bbox']) if entry['bbox'] else None}))
+            for path, entry in manifest['entries'].items()
+        }
+
+    def _save_manifest(self) -> None:
+        logger.debug('Saving polygon index manifest %s', self.manifest_path)
+        manifest = {
+            'version': self._MANIFEST_VERSION,
+            'root': str(self._root_path),
+            'entries': {path: entry._asdict() for path, entry in self._entries.items()},
+        }
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.manifest_path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='UTF-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_name, self.manifest_path)
+
+    def _create_country(self, country_code: str) -> Country:
+        entries = self._entries_by_country[country_code]
+        country_entries = [entry for entry in entries if entry.subdivision_code is None]
+
+        country = Country(iso_code=country_code, name=entries[0].country_name, geometry_cache=self.geometry_cache,
+                          poly_loader=self._poly_loader(self._root_path / country_entries[-1].path)
+                          if country_entries else None,
+                          footprint=country_entries[-1].footprint if country_entries else None)
+        for entry in entries:
+            if entry.subdivision_code is not None:
+                country.add_subdivision(iso_code=entry.subdivision_code, name=entry.subdivision_name,
+                                        poly_loader=self._poly_loader(self._root_path / entry.path),
+                                        footprint=entry.footprint)
+        return country
+
+    @property
+    def entries(self) -> list[RegionEntry]:
+        """Manifest records of all polygon files in the index"""
+        return list(self._entries.values())
+
+    def regions(self) -> Iterator[Region]:
+        """Iterate over all countries and subdivisions in the index"""
+        for country in self.country.values():
+            yield country
+            yield from country.get_all_subdivisions()
+
+    def poly_paths(self) -> set[Path]:
+        """Paths of all polygon files in the index"""
+        return {self._root_path / entry.path for entry in self._entries.values()}
+
+    def invalidate(self, paths: Iterable[Path]) -> None:
+        """Forget cached coordinates of the regions loaded from the given polygon files
+
+        Manifest entries of the changed files are built again, regions are created again from them and the spatial
+        index is rebuilt on the next geometric query, so that the bounding boxes and the footprints follow
+        the polygons.
+        """
+        indexed = False
+        updated = False
+        for path in paths:
+            self.geometry_cache.discard(path)
+            if not path.is_relative_to(self._root_path):
+                continue
+            relative_path = path.relative_to(self._root_path).as_posix()
+            entry = self._entries.get(relative_path)
+            if entry is None:
+                continue
+            indexed = True
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if (entry.mtime_ns, entry.size) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            entry = self._create_entry(path=path, relative_path=relative_path, stat=stat)
+            self._entries[relative_path] = entry
+            self._entries_by_country[entry.country_code] = [
+                entry if e.path == relative_path else e for e in self._entries_by_country[entry.country_code]]
+            updated = True
+
+        if updated:
+            # regions are created again with the footprints of the new entries
+            self.country = _CountryMap(codes=self._entries_by_country.keys(), create=self._create_country)
+            if self.manifest_path is not None:
+                self._save_manifest()
+        if indexed:
+            with self._spatial_index_lock:
+                self._spatial_index = None
+
+    @property
+    def spatial_index(self) -> RegionSpatialIndex:
+        """Spatial index of all the regions, built on the first access"""
+        with self._spatial_index_lock:
+            if self._spatial_index is None:
+                with timeit(msg='Building spatial index of the regions'):
+                    regions, bounds = [], []
+                    for entry in self._entries.values():
+                        region = self._entry_region(entry)
+                        if region is not None:
+                            regions.append(region)
+                            # bounding box is missing in the manifest only when the manifest is not persisted
+                            bounds.append(entry.bbox or tuple(region.coords.bounds))
+                    self._spatial_index = RegionSpatialIndex(regions=regions, bounds=bounds)
+            return self._spatial_index
+
+    def _entry_region(self, entry: RegionEntry) -> Region | None:
+        country = self.country[entry.country_code]
+        candidates = [country] if entry.subdivision_code is None else country.get_subdivisions(entry.subdivision_code)
+        path = self._root_path / entry.path
+        # only the last country polygon of a country is used
+        return next((region for region in candidates if region.poly_path == path), None)
+
+    def query(self, geometry: shapely.Geometry, level: str = 'subdivision') -> list[Region]:
+        """Select regions intersecting the geometry
+
+        :param geometry: point, bounding box, track or any other geometry
+        :param level: 'country' for country polygons only, 'subdivision' for subdivision polygons and polygons
+                      of the countries without subdivisions
+        """
+        if level not in ['country', 'subdivision']:
+            raise ValueError(f'Invalid region level: {level}')
+
+        if level == 'country':
+            return [region for region in self.spatial_index.query(geometry) if isinstance(region, Country)]
+        return [region for region in self.spatial_index.query(geometry)
+                if isinstance(region, Subdivision) or not region.get_all_subdivisions()]
+
+    def _select_areas(self, entry: dict) -> list[Area]:
+        """Create areas of the bbox or polygon entry, one for every region the area is limited to"""
+        geometry, poly_loader = None, None
+        if 'bbox' in entry:
+            bbox = entry['bbox']
+            if not isinstance(bbox, list) or len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                raise ValueError(f'Invalid bounding box {bbox}, expecting [min_lon, min_lat, max_lon, max_lat]')
+            geometry = parse_geometry(bbox)
+        elif isinstance(entry['polygon'], str):
+            path = Path(entry['polygon'])
+            if not path.is_file():
+                raise ValueError(f'Missing polygon file {path}')
+            poly_loader = self._poly_loader(path)
+        else:
+            geometry = parse_geometry(entry['polygon'])
+            if geometry.geom_type not in ['Polygon', 'MultiPolygon']:
+                raise ValueError(f'Geometry type {geometry.geom_type} is not supported')
+
+        # unnamed areas are named after their definition, so that the names are stable between the runs
+        definition = json.dumps({key: entry[key] for key in ['bbox', 'polygon'] if key in entry}, sort_keys=True)
+        code = entry.get('name') or f'area-{hashlib.sha256(definition.encode()).hexdigest()[:8]}'
+        # the code becomes part of the file names
+        if not isinstance(code, str) or not _AREA_NAME.match(code):
+            raise ValueError(f'Invalid area name {code!r}, expecting letters, digits, _, . and - not starting with .')
+
+        if 'within' not in entry:
+            return [Area(code=code, geometry=geometry, poly_loader=poly_loader)]
+
+        # regions the area doesn't overlap are skipped, so that wildcards can be used
+        geometry = poly_loader.load() if poly_loader is not None else geometry
+        within = entry['within'] if isinstance(entry['within'], list) else [entry['within']]
+        areas = []
+        for region in self.select_regions(within):
+            intersection = shapely.intersection(geometry, region.coords)
+            if area_polygons(intersection):
+                areas.append(Area(code=f'{region.code}-{code}', geometry=intersection, within=region, name=code,
+                                  source_path=poly_loader.path if poly_loader is not None else None))
+        if not areas:
+            raise ValueError(f'Area {code} does not overlap any of {within}')
+        return areas
+
+    def select_regions(self, regions: list[str | dict]) -> list[Region]:
         """Select regions from index according to the given list of regions.
         Regions can be specified by:
         - country code (country is returned)
         - country wildcard ie PL-* (all subdivisions of a country are returned)
         - subdivision code (subdivision is returned)
+        - {"intersects": geometry, "level": "country" | "subdivision"} where geometry is a [min_lon, min_lat,
+          max_lon, max_lat] bounding box or a GeoJSON geometry (regions intersecting the geometry are returned)
+        - {"route": path, "buffer": meters, "method": "walk" | "buffer"} where path is a GPX or GeoJSON file
+          (corridor along the track is returned)
+        - {"bbox": [min_lon, min_lat, max_lon, max_lat], "name": name, "within": regions} or
+          {"polygon": geometry | path, "name": name, "within": regions} where geometry is a GeoJSON geometry
+          and path is a POLY or GeoJSON file (area is returned, intersected with every region selected by within
+          when given); names are made of letters, digits, _, . and -, don't start with . and are unique
         """
         result: list[Region] = []
         for region in regions:
+            if isinstance(region, dict) and 'route' in region:
+                result.append(Route(path=Path(region['route']), buffer=region.get('buffer', DEFAULT_ROUTE_BUFFER),
+                                    method=region.get('method', 'walk')))
+                continue
+            if isinstance(region, dict) and ('bbox' in region or 'polygon' in region):
+                result.extend(self._select_areas(region))
+                continue
+            if isinstance(region, dict):
+                result.extend(self.query(geometry=parse_geometry(region.get('intersects')),
+                                         level=region.get('level', 'subdivision')))
+                continue
+
             country_code, sep, subdivision_code = region.partition("-")
 
             # country_code not defined
@@ -236,4 +877,64 @@ class RegionIndex:
                         f'in country {country.name}'
                     )
 
+        # regions are written to files named after their codes
+        codes = [region.code for region in result]
+        for area in result:
+            if isinstance(area, Area) and codes.count(area.code) > 1:
+                raise ValueError(f'Area name {area.code} is used more than once')
         return result
+
+
+class CoordsPrefetcher:
+    """
+    Load coordinates of the regions on a background thread ahead of their use
+
+    Iterating over the prefetcher yields coordinates of the regions in order, while coordinates of up to
+    lookahead following regions are being loaded in the background. Coordinates already loaded when needed
+    are counted as hits, the ones the caller had to wait for as misses.
+    """
+
+    def __init__(self, regions: list[Region], lookahead: int = 2) -> None:
+        self._regions = regions
+        self._lookahead = lookahead
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='coords-prefetch')
+        # futures of the scheduled regions not yet taken by the caller, by index of the region
+        self._futures: dict[int, Future[shapely.MultiPolygon]] = {}
+        self._scheduled = 0
+        self.hits = 0
+        self.misses = 0
+        self.wait_time = 0.0
+
+    def __enter__(self) -> CoordsPrefetcher:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        logger.info('Prefetched coordinates: %d hits, %d misses, %.3f s waiting', self.hits, self.misses,
+                    self.wait_time)
+
+    def _prefetch(self, until: int) -> None:
+        while self._scheduled < min(until, len(self._regions)):
+            self._futures[self._scheduled] = self._executor.submit(self._load, self._regions[self._scheduled])
+            self._scheduled += 1
+
+    @staticmethod
+    def _load(region: Region) -> shapely.MultiPolygon:
+        start = time.perf_counter()
+        coords = region.coords
+        logger.debug('Loaded coordinates of %s in %.3f s', region.code, time.perf_counter() - start)
+        return coords
+
+    def __iter__(self) -> Iterator[shapely.MultiPolygon]:
+        for index, region in enumerate(self._regions):
+            self._prefetch(until=index + 1 + self._lookahead)
+            future = self._futures.pop(index)
+            if future.done():
+                self.hits += 1
+            else:
+                self.misses += 1
+                start = time.perf_counter()
+                future.result()
+                self.wait_time += time.perf_counter() - start
+                logger.debug('Waited for coordinates of %s', region.code)
+            yield future.result()
@@ -1,32 +1,49 @@
 import itertools
 import logging
+import math
 import xml.etree.ElementTree as ET
 from operator import attrgetter
+from pathlib import Path
 
-import requests
+import numpy as np
 import shapely
 from typing import Protocol
 
-from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
-
 from squadrats2garmin.common import util
-from squadrats2garmin.common.job import Job
+from squadrats2garmin.common.cache import cache_key, file_digest
+from squadrats2garmin.common.job import Job, Shard
 from squadrats2garmin.common.osm import Node, Way
+from squadrats2garmin.common.region import Footprint, Route
 from squadrats2garmin.common.tile import Zoom
 from squadrats2garmin.common.timer import timeit
+from squadrats2garmin.common.track import buffer_in_tiles, to_tile_space
 
 TAGS_WAY = {'name': 'grid'}
 
+# bump whenever a change in the generator alters the content of the OSM files
+OSM_FORMAT_VERSION = 1
+
 logger = logging.getLogger(__name__)
 
 type TileRange = tuple[int, int]
 type TileBars = list[TileRange]
 type TileMap = dict[int, TileBars]
 
+# step of walking the track in tiles
+_WALK_STEP = 0.25
+# multiplier of the x coordinate in the integer key of a tile
+_KEY_SHIFT = 2 ** 32
+# trophies are streamed to disk in chunks of this size
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 class SquadratsClient:
     def __init__(self):
+        # imported here, so that generating the grid doesn't pay for importing requests
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util import Retry
+
         self._session = requests.Session()
         self._session.headers.update({
             'User-Agent': 'SquadratsClient/1.0'
@@ -56,6 +73,17 @@ class SquadratsClient:
             response.raise_for_status()
             return response.json()
 
+    def download_trophies(self, user_id: str, path: Path) -> None:
+        """Download trophies GeoJSON into the file, the body is streamed to disk without decoding"""
+        with timeit(msg=f"Downloading trophies for user {user_id}"):
+            geojson_info = self._get_geojson(user_id)
+
+            with self._session.get(geojson_info['url'], timeout=self._timeout, stream=True) as response:
+                response.raise_for_status()
+                with path.open('wb') as f:
+                    for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+
 
 class TileMapGenerator(Protocol):
     def generate_rows(self, poly: shapely.MultiPolygon, zoom: Zoom) -> TileMap:
@@ -154,33 +182,109 @@ class ShapelyTileMapGenerator(TileMapGenerator):
         return y_min, y_max
 
 
-def generate_grid(poly: shapely.MultiPolygon, job: Job, generator: TileMapGenerator = ShapelyTileMapGenerator()) -> \
-list[Way]:
+class TrackTileMapGenerator(TileMapGenerator):
+    """
+    Generate tiles closer to the track than the buffer distance by walking the track in tile space
+
+    No polygon is buffered nor clipped, the polygon passed to the methods is ignored. The track is walked
+    in steps of a fraction of a tile and the tiles within the buffer distance (extended by half of the step)
+    from every point are taken, so the tiles cover the whole corridor.
+    """
+
+    def __init__(self, track: shapely.MultiLineString, buffer: float):
+        self._track = track
+        self._buffer = buffer
+        self._tiles: dict[Zoom, np.ndarray] = {}
+
+    def generate_rows(self, poly: shapely.MultiPolygon, zoom: Zoom) -> TileMap:
+        tiles = self._covered_tiles(zoom)
+        return _group_ranges(keys=tiles[:, 1], values=tiles[:, 0])
+
+    def generate_cols(self, poly: shapely.MultiPolygon, zoom: Zoom) -> TileMap:
+        tiles = self._covered_tiles(zoom)
+        return _group_ranges(keys=tiles[:, 0], values=tiles[:, 1])
+
+    def _covered_tiles(self, zoom: Zoom) -> np.ndarray:
+        """Unique (x, y) tiles covered by the corridor"""
+        if zoom not in self._tiles:
+            n = 2 ** zoom.zoom
+            projected = shapely.transform(self._track, lambda coords: to_tile_space(coords, n))
+            points = shapely.get_coordinates(shapely.segmentize(projected, max_segment_length=_WALK_STEP))
+            radius = buffer_in_tiles(track=self._track, buffer=self._buffer, n=n) + _WALK_STEP / 2
+
+            # candidate tiles around the tile of every point, kept when their distance from the point is within radius
+            reach = math.ceil(radius)
+            dx, dy = [d.ravel() for d in np.meshgrid(np.arange(-reach, reach + 1), np.arange(-reach, reach + 1))]
+            px, py = points[:, :1], points[:, 1:]
+            tx, ty = np.floor(px).astype(np.int64) + dx, np.floor(py).astype(np.int64) + dy
+            gap_x = np.maximum(np.maximum(tx - px, px - tx - 1), 0)
+            gap_y = np.maximum(np.maximum(ty - py, py - ty - 1), 0)
+            within = (gap_x ** 2 + gap_y ** 2 <= radius ** 2) & (tx >= 0) & (tx < n) & (ty >= 0) & (ty < n)
+
+            # tiles are deduplicated as single integers, which is much faster than unique rows
+            keys = np.unique(tx[within] * _KEY_SHIFT + ty[within])
+            self._tiles[zoom] = np.column_stack([keys // _KEY_SHIFT, keys % _KEY_SHIFT])
+        return self._tiles[zoom]
+
+
+def _group_ranges(keys: np.ndarray, values: np.ndarray) -> TileMap:
+    """Group tiles by the key into end-inclusive ranges of consecutive values"""
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    # a range starts where the key changes or the values are not consecutive
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]) | (values[1:] != values[:-1] + 1)])
+    ends = np.r_[starts[1:], len(keys)] - 1
+
+    tiles: TileMap = {}
+    for key, start, end in zip(keys[starts].tolist(), values[starts].tolist(), values[ends].tolist()):
+        tiles.setdefault(key, []).append((start, end))
+    return tiles
+
+
+def tile_map_generator(job: Job) -> TileMapGenerator:
+    """Choose the generator of the job's tiles"""
+    region = job.region
+    if isinstance(region, Route) and region.method == 'walk':
+        return TrackTileMapGenerator(track=region.track, buffer=region.buffer)
+    return ShapelyTileMapGenerator()
+
+
+def generate_grid(poly: shapely.MultiPolygon | None, job: Job,
+                  generator: TileMapGenerator = ShapelyTileMapGenerator()) -> list[Way]:
     ways: list[Way] = []
+    shard = job.shard
+    if shard:
+        # keep a margin of a tile row around the shard, so that the rows next to its edges are not distorted
+        poly = shapely.clip_by_rect(poly, xmin=-180.0, ymin=job.zoom.lat(shard.y_end + 1),
+                                    xmax=180.0, ymax=job.zoom.lat(shard.y_start - 2))
+        if poly.is_empty:
+            return ways
+
     # generate horizontal ranges
     row_map = generator.generate_rows(poly=poly, zoom=job.zoom)
     ranges_by_y = {
         y: util.make_ranges_end_inclusive(rr)
         for y, rr in row_map.items()
     }
-    for y in sorted(ranges_by_y.keys()):
-        if y - 1 not in ranges_by_y:
-            # first row or a gap - generate top edge
-            ways.extend(_create_horizontal_ways_for_ranges(y=y, tiles=ranges_by_y[y], job=job))
-
-        if y + 1 in ranges_by_y:
-            # generate bottom edge between current and next row
-            ways.extend(
-                _create_horizontal_ways_for_ranges(
-                    y=y + 1,
-                    tiles=util.merge_ranges(itertools.chain(ranges_by_y[y], ranges_by_y[y + 1])),
-                    job=job))
-        else:
-            # generate bottom edge when next row is empty
-            ways.extend(_create_horizontal_ways_for_ranges(y=y + 1, tiles=ranges_by_y[y], job=job))
+    # horizontal line y is the bottom edge of row y - 1 and the top edge of row y
+    lines = sorted(set(ranges_by_y.keys()) | {y + 1 for y in ranges_by_y.keys()})
+    for y in lines:
+        if shard and not shard.y_start <= y < shard.y_end:
+            continue
+        ways.extend(
+            _create_horizontal_ways_for_ranges(
+                y=y,
+                tiles=util.merge_ranges(itertools.chain(ranges_by_y.get(y - 1, []), ranges_by_y.get(y, []))),
+                job=job))
 
     # generate vertical ranges
     col_map = generator.generate_cols(poly=poly, zoom=job.zoom)
+    if shard:
+        col_map = {
+            x: clamped
+            for x, rr in col_map.items()
+            if (clamped := _clamp_ranges(ranges=rr, start=shard.y_start, end=shard.y_end - 1))
+        }
     ranges_by_x = {
         x: util.make_ranges_end_inclusive(rr)
         for x, rr in col_map.items()
@@ -205,6 +309,43 @@ list[Way]:
     return ways
 
 
+def _clamp_ranges(ranges: TileBars, start: int, end: int) -> TileBars:
+    """Clamp end-inclusive tile ranges to start..end, dropping the ranges outside"""
+    return [(max(r_start, start), min(r_end, end)) for r_start, r_end in ranges if r_start <= end and r_end >= start]
+
+
+def estimate_tiles(footprint: Footprint, zoom: Zoom) -> int:
+    """Estimate the number of tiles covered by the polygon of the footprint
+
+    Number of tiles of the bounding box scaled by the share of the bounding box covered by the polygon
+    """
+    (bounds_w, bounds_s, bounds_e, bounds_n) = footprint.bbox
+    bbox_tiles = (zoom.x(bounds_e) - zoom.x(bounds_w) + 1) * (zoom.y(bounds_s) - zoom.y(bounds_n) + 1)
+    bbox_area = (bounds_e - bounds_w) * (bounds_n - bounds_s)
+    return int(bbox_tiles * footprint.area / bbox_area) if bbox_area else bbox_tiles
+
+
+def plan_shards(footprint: Footprint, zoom: Zoom, max_tiles: int) -> list[Shard]:
+    """Split the polygon of the footprint into bands of tile rows, each covering at most about max_tiles tiles
+
+    Shards are planned from the bounding box and the area only, so the polygon doesn't need to be loaded.
+
+    :return: empty list if the polygon does not need to be split
+    """
+    tiles = estimate_tiles(footprint=footprint, zoom=zoom)
+    if tiles <= max_tiles:
+        return []
+
+    (_, bounds_s, _, bounds_n) = footprint.bbox
+    # horizontal lines from the top edge of the first row to the bottom edge of the last row
+    y_min = zoom.y(bounds_n)
+    lines = zoom.y(bounds_s) + 2 - y_min
+    count = min(math.ceil(tiles / max_tiles), lines)
+    bounds = [y_min + lines * i // count for i in range(count + 1)]
+    return [Shard(index=index, count=count, y_start=y_start, y_end=y_end)
+            for index, (y_start, y_end) in enumerate(itertools.pairwise(bounds), start=1)]
+
+
 def _create_horizontal_ways_for_ranges(y: int, tiles: TileBars, job: Job) -> list[Way]:
     return [
         Way(
@@ -231,13 +372,23 @@ def _osm_node(tile: tuple[int, int], job: Job) -> Node:
     return Node(node_id=job.next_id(), geom=job.zoom.to_point(tile))
 
 
+def osm_cache_key(job: Job) -> str:
+    """Build the key of the job's OSM file in the OSM cache"""
+    poly_path = job.region.poly_path
+    return cache_key(file_digest(poly_path) if poly_path else None, job.zoom.zoom, OSM_FORMAT_VERSION,
+                     *job.region.grid_parameters, *(job.shard or ()))
+
+
 def generate_osm(job: Job):
     pretty_print = False
     """Generate a single OSM file for a job"""
     logger.info('Generating OSM: %s -> %s', job, job.osm_file)
 
+    generator = tile_map_generator(job)
+    # the track is walked without the corridor polygon, so the polygon is not built at all
+    poly = None if isinstance(generator, TrackTileMapGenerator) else job.region.coords
     with timeit(f"{job}: generate_grid"):
-        ways = generate_grid(poly=job.region.coords, job=job)
+        ways = generate_grid(poly=poly, job=job, generator=generator)
 
     logger.debug('%s: %d ways', job, len(ways))
 
@@ -0,0 +1,101 @@
+"""Classes and methods to read tracks and build route corridors
+
+Tracks are read from GPX files (track and route points) or from GeoJSON files with LineString geometries.
+Buffer distances are given in meters and converted to Web Mercator units at the latitude of the track
+farthest from the equator, so that the corridor is at least as wide as requested along the whole track.
+"""
+import math
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+import shapely
+
+from squadrats2garmin.common.poly import PolyFileFormatException
+
+# equatorial radius of the Web Mercator projection
+EARTH_RADIUS = 6378137.0
+
+
+def load_track(path: Path) -> shapely.MultiLineString:
+    """Read the track from GPX or GeoJSON file
+
+    :raises PolyFileFormatException: when the file contains no track
+    """
+    match path.suffix:
+        case '.gpx':
+            lines = _read_gpx(path)
+        case '.json' | '.geojson':
+            geometry = shapely.from_geojson(path.read_bytes())
+            lines = [part for part in shapely.get_parts(shapely.line_merge(shapely.get_parts(geometry)))
+                     if part.geom_type == 'LineString']
+        case _:
+            raise ValueError(f"Don't know how to parse track with '{path.suffix}' extension")
+
+    lines = [line for line in lines if len(line.coords) > 1]
+    if not lines:
+        raise PolyFileFormatException(f'No track found in {path}')
+    return shapely.MultiLineString(lines)
+
+
+def _read_gpx(path: Path) -> list[shapely.LineString]:
+    lines = []
+    # GPX 1.0 and 1.1 differ in the namespace only, so the elements are matched by the local name
+    for element in ET.parse(path).iter():
+        if _local_name(element) in ['trkseg', 'rte']:
+            points = [(float(point.get('lon')), float(point.get('lat')))
+                      for point in element if _local_name(point) in ['trkpt', 'rtept']]
+            if len(points) > 1:
+                lines.append(shapely.LineString(points))
+    return lines
+
+
+def _local_name(element: ET.Element) -> str:
+    return element.tag.rpartition('}')[2]
+
+
+def to_tile_space(coords: np.ndarray, n: float) -> np.ndarray:
+    """Convert (lon, lat) coordinates into fractional tile coordinates of the zoom with n tiles per axis"""
+    lon, lat = coords[:, 0], np.radians(coords[:, 1])
+    return np.column_stack([(lon + 180.0) / 360.0 * n, (1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * n])
+
+
+def from_tile_space(coords: np.ndarray, n: float) -> np.ndarray:
+    """Convert fractional tile coordinates of the zoom with n tiles per axis into (lon, lat) coordinates"""
+    x, y = coords[:, 0], coords[:, 1]
+    return np.column_stack([x / n * 360.0 - 180.0, np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * y / n))))])
+
+
+def buffer_in_tiles(track: shapely.MultiLineString, buffer: float, n: float) -> float:
+    """Convert the buffer distance in meters into tiles of the zoom with n tiles per axis"""
+    (_, bounds_s, _, bounds_n) = track.bounds
+    farthest = max(abs(bounds_s), abs(bounds_n))
+    return buffer / (2 * math.pi * EARTH_RADIUS * math.cos(math.radians(farthest))) * n
+
+
+def corridor(track: shapely.MultiLineString, buffer: float) -> shapely.MultiPolygon:
+    """Build the polygon of all points closer to the track than buffer meters"""
+    # buffered in the unit square of the Web Mercator, where the buffer distance doesn't depend on the direction
+    projected = shapely.transform(track, lambda coords: to_tile_space(coords, 1.0))
+    buffered = shapely.buffer(projected, buffer_in_tiles(track=track, buffer=buffer, n=1.0))
+    geometry = shapely.orient_polygons(shapely.transform(buffered, lambda coords: from_tile_space(coords, 1.0)))
+    if geometry.geom_type == 'Polygon':
+        return shapely.MultiPolygon([geometry])
+    return geometry
+
+
+def corridor_extent(track: shapely.MultiLineString, buffer: float) -> tuple[tuple[float, float, float, float], float]:
+    """Estimate the bounding box and the area of the corridor without building it
+
+    The area is the length of the track times the width of the corridor, scaled from the Web Mercator
+    to the bounding box, so it's overestimated where the corridor overlaps itself.
+    """
+    projected = shapely.transform(track, lambda coords: to_tile_space(coords, 1.0))
+    distance = buffer_in_tiles(track=track, buffer=buffer, n=1.0)
+    (min_x, min_y, max_x, max_y) = projected.bounds
+    min_x, min_y, max_x, max_y = min_x - distance, min_y - distance, max_x + distance, max_y + distance
+    # share of the bounding box covered by the corridor, ends of the track add a half circle each
+    share = min(1.0, (2 * distance * projected.length + math.pi * distance ** 2) / ((max_x - min_x) * (max_y - min_y)))
+    # y of the tile space grows southwards
+    [[west, south], [east, north]] = from_tile_space(np.array([[min_x, max_y], [max_x, min_y]]), 1.0).tolist()
+    return (west, south, east, north), share * (east - west) * (north - south)
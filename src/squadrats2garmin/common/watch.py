@@ -0,0 +1,63 @@
+"""Classes to watch files for changes
+
+Files are polled (compared by modification time and size), so no platform specific notification API is needed.
+"""
+import logging
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+type FileState = tuple[int, int]
+
+
+class PollingWatcher:
+    """
+    Watch files and directory trees for added, modified and removed files
+    """
+
+    def __init__(self, paths: list[Path], interval: float = 2.0) -> None:
+        self._paths = paths
+        self._interval = interval
+        self._state: dict[Path, FileState] = self._scan()
+
+    def _scan(self) -> dict[Path, FileState]:
+        state = {}
+        for path in self._paths:
+            files = path.rglob('*') if path.is_dir() else [path]
+            for file in files:
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                if file.is_file():
+                    state[file] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def poll(self) -> set[Path]:
+        """Scan the files once
+
+        :return: files added, modified or removed since the previous scan
+        """
+        state = self._scan()
+        changed = {path for path in state.keys() | self._state.keys() if state.get(path) != self._state.get(path)}
+        self._state = state
+        return changed
+
+    def wait(self) -> set[Path]:
+        """Block until some files change
+
+        Changes are collected until the files stay unchanged for one polling interval,
+        so that a file being written or a batch of edited files is reported at once.
+
+        :return: files added, modified or removed since the previous call
+        """
+        changed: set[Path] = set()
+        while True:
+            time.sleep(self._interval)
+            changes = self.poll()
+            if changes:
+                changed |= changes
+            elif changed:
+                logger.debug('Changed files: %s', sorted(changed))
+                return changed
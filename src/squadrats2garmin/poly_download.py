@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
+import json
 import logging
+import os
 import re
+import tempfile
+import threading
 import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import NamedTuple
+from urllib.parse import urlparse
 
 import overpy
 import pycountry
@@ -11,13 +21,157 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
 
+from squadrats2garmin.common.cache import DEFAULT_CACHE_DIR
+
 logger = logging.getLogger(__name__)
 
+DEFAULT_MANIFEST = DEFAULT_CACHE_DIR / 'poly-download.json'
+
+# downloads are streamed to disk in chunks of this size
+_CHUNK_SIZE = 64 * 1024
+_POLY_HEADER = b'polygon\n'
+_GEOJSON_TYPE = re.compile(rb'"type"\s*:\s*"(\w+)"')
+# bytes kept from the start and from the end of the content, enough to find patterns split between chunks
+_EDGE_SIZE = 64
+
+
+class HostLimiter:
+    """Limit the number of concurrent requests to every host, so that the download workers stay polite"""
+
+    def __init__(self, max_per_host: int) -> None:
+        self._max_per_host = max_per_host
+        self._semaphores: dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, url: str) -> Iterator[None]:
+        """Wait for a free slot of the URL's host and hold it"""
+        host = urlparse(url).netloc
+        with self._lock:
+            semaphore = self._semaphores.setdefault(host, threading.Semaphore(self._max_per_host))
+        with semaphore:
+            yield
+
+
+class ManifestEntry(NamedTuple):
+    """Relation, content digest and HTTP validators of a downloaded polygon file"""
+    relation_id: int
+    sha256: str
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+class DownloadManifest:
+    """Entries of the downloaded polygon files, kept in a JSON file
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries: dict[str, ManifestEntry] = {}
+        try:
+            entries = json.loads(path.read_text(encoding='UTF-8'))
+        except FileNotFoundError:
+            return
+        self._entries = {output: ManifestEntry(**entry) for output, entry in entries.items()}
+
+    def get(self, output_path: Path) -> ManifestEntry | None:
+        with self._lock:
+            return self._entries.get(str(output_path))
+
+    def update(self, output_path: Path, entry: ManifestEntry) -> None:
+        with self._lock:
+            self._entries[str(output_path)] = entry
+
+    def save(self) -> None:
+        with self._lock:
+            manifest = {output: entry._asdict() for output, entry in sorted(self._entries.items())}
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self._path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='UTF-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_name, self._path)
+
+
+class PolygonValidator:
+    """
+    Validate the downloaded polygon chunk by chunk, without keeping the whole file in memory
+
+    Only the parts needed to reject error pages and truncated responses are checked: the header and the END
+    of POLY files, the enclosing braces and the type of the geometry of GeoJSON files.
+    """
+
+    def __init__(self, poly_format: str) -> None:
+        self._poly_format = poly_format
+        self._head = b''
+        self._tail = b''
+        self._geometry_type: str | None = None
+
+    def feed(self, chunk: bytes) -> None:
+        """Check the next chunk
+
+        :raises ValueError: as soon as the content is known not to be a polygon
+        """
+        if len(self._head) < _EDGE_SIZE:
+            self._head += chunk[:_EDGE_SIZE - len(self._head)]
+            self._check_head()
+
+        window = self._tail + chunk
+        if self._poly_format == 'json' and self._geometry_type is None:
+            if match := _GEOJSON_TYPE.search(window):
+                self._geometry_type = match.group(1).decode()
+                if self._geometry_type not in ['Polygon', 'MultiPolygon']:
+                    raise ValueError(f'Geometry type {self._geometry_type} is not supported')
+        self._tail = window[-_EDGE_SIZE:]
+
+    def close(self) -> None:
+        """Check the end of the content
+
+        :raises ValueError: when the content is not a complete polygon
+        """
+        if self._poly_format == 'poly':
+            if not self._head.startswith(_POLY_HEADER):
+                raise ValueError('Response is not a POLY file')
+            if not self._tail.rstrip().endswith(b'END'):
+                raise ValueError('POLY file is truncated')
+        else:
+            if self._geometry_type is None:
+                raise ValueError('Response is not a GeoJSON geometry')
+            if not self._tail.rstrip().endswith(b'}'):
+                raise ValueError('GeoJSON file is truncated')
+
+    def _check_head(self) -> None:
+        if self._poly_format == 'poly':
+            length = min(len(self._head), len(_POLY_HEADER))
+            if self._head[:length] != _POLY_HEADER[:length]:
+                raise ValueError('Response is not a POLY file')
+        else:
+            head = self._head.lstrip()
+            if head and not head.startswith(b'{'):
+                raise ValueError('Response is not a GeoJSON object')
+
+
+class DownloadResult(NamedTuple):
+    """Entry of the downloaded file and whether the file was written"""
+    entry: ManifestEntry
+    changed: bool
+
+
+def _file_sha256(path: Path) -> str | None:
+    try:
+        with path.open('rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+    except FileNotFoundError:
+        return None
+
 
 class PolyDownloader:
-    def __init__(self, base_url: str = "http://polygons.openstreetmap.fr", poly_format: str = "json") -> None:
+    def __init__(self, base_url: str = "http://polygons.openstreetmap.fr", poly_format: str = "json",
+                 workers: int = 1, max_per_host: int = 2) -> None:
         self._poly_format = poly_format
         self._base_url = base_url
+        self._limiter = HostLimiter(max_per_host=max_per_host)
+        # session is shared by all the workers, its connection pool keeps a connection for each of them
         self._session = requests.Session()
         self._session.headers.update({
             'User-Agent': 'OSM-PolyDownloader/1.0'
@@ -28,12 +182,20 @@ class PolyDownloader:
             backoff_factor=2,
             status_forcelist=[429, 500, 502, 503, 504],
         )
-        adapter = HTTPAdapter(max_retries=retry)
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max(workers, 1))
         self._session.mount('http://', adapter)
         self._session.mount('https://', adapter)
 
-    def download(self, relation_id: int, output_path: Path):
-        """Download POLY file with retries"""
+    def download(self, relation_id: int, output_path: Path,
+                 previous: ManifestEntry | None = None) -> DownloadResult | None:
+        """Download POLY file with retries
+
+        Validators of the previous download are sent with the request, unless the relation or the local file
+        changed since. The response is streamed to a temporary file and validated on the way, the file
+        is replaced only when the downloaded polygon is valid and its content differs.
+
+        :return: None if the download failed, the reason is logged
+        """
         url: str
         if self._poly_format == "json":
             url = f"{self._base_url}/get_geojson.py"
@@ -47,29 +209,78 @@ class PolyDownloader:
             "params": "0.020000-0.020000-0.020000"
         }
 
-        try:
-            response = self._session.get(url, params=params, timeout=30)
-            response.raise_for_status()
+        local_sha256 = _file_sha256(output_path)
+        headers = {}
+        if previous and previous.relation_id == relation_id and previous.sha256 == local_sha256:
+            if previous.etag:
+                headers['If-None-Match'] = previous.etag
+            if previous.last_modified:
+                headers['If-Modified-Since'] = previous.last_modified
 
-            # Check if the response is actually a POLY file
-            # if not response.text.startswith('polygon\n'):
-            #     raise ValueError("Response is not a valid POLY file")
+        # streamed next to the output file, which is replaced only by a complete and valid polygon
+        tmp_path = output_path.with_name(f'.{output_path.name}.tmp')
+        try:
+            with self._limiter.slot(url), \
+                    self._session.get(url, params=params, headers=headers, timeout=30, stream=True) as response:
+                response.raise_for_status()
+
+                if response.status_code == 304:
+                    logger.debug("Relation %s not modified", relation_id)
+                    return DownloadResult(entry=previous, changed=False)
+
+                validator = PolygonValidator(poly_format=self._poly_format)
+                digest = hashlib.sha256()
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                with tmp_path.open('wb') as f:
+                    for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                        validator.feed(chunk)
+                        digest.update(chunk)
+                        f.write(chunk)
+                validator.close()
+
+                entry = ManifestEntry(relation_id=relation_id, sha256=digest.hexdigest(),
+                                      etag=response.headers.get('ETag'),
+                                      last_modified=response.headers.get('Last-Modified'))
+
+            if entry.sha256 == local_sha256:
+                # identical content is not rewritten, so that nothing downstream is invalidated
+                logger.debug("Relation %s unchanged", relation_id)
+                return DownloadResult(entry=entry, changed=False)
+
+            os.replace(tmp_path, output_path)
+            return DownloadResult(entry=entry, changed=True)
+
+        except requests.RequestException as e:
+            logger.error("Downloading relation %s failed: %s", relation_id, e)
+        except ValueError as e:
+            logger.error("Invalid polygon of relation %s: %s", relation_id, e)
+        except OSError as e:
+            logger.error("Writing %s failed: %s", output_path, e)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return None
 
-            # Create the parent directory if needed
-            output_path.parent.mkdir(parents=True, exist_ok=True)
 
-            # Write file
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(response.text)
-            return True
+class OsmIdResolver:
+    def __init__(self, url: str | None = None):
+        self.api = overpy.Overpass(url=url)
+        self.queries = 0
 
-        except Exception as e:
-            return False
+    def _query(self, query: str, retry_count: int) -> overpy.Result | None:
+        """Run the query with retries
 
+        :return: None if all attempts failed
+        """
+        for attempt in range(retry_count):
+            try:
+                self.queries += 1
+                return self.api.query(query)
+            except (overpy.exception.OverPyException, OSError) as e:
+                logger.warning("Attempt %d failed: %s", attempt + 1, e)
+                if attempt < retry_count - 1:
+                    time.sleep(2 ** attempt)  # Exponential backoff
 
-class OsmIdResolver:
-    def __init__(self):
-        self.api = overpy.Overpass()
+        return None
 
     def get_id(self, iso_code: str, retry_count: int = 5) -> int:
         query: str
@@ -84,25 +295,66 @@ class OsmIdResolver:
              out ids;
              '''
 
-        for attempt in range(retry_count):
-            try:
-                result: overpy.Result = self.api.query(query)
-
-                if len(result.relations) == 0:
-                    logger.error("Unable to find relation for %s", iso_code)
-                    return False
-                elif len(result.relations) > 1:
-                    logger.error("Multiple relations found for %s", iso_code)
-                    return False
-                else:
-                    return result.relations[0].id
+        result = self._query(query=query, retry_count=retry_count)
+        if result is None:
+            return False
 
-            except Exception as e:
-                logger.warning("Attempt %d failed: %s", attempt + 1, e)
-                if attempt < retry_count - 1:
-                    time.sleep(2 ** attempt)  # Exponential backoff
+        if len(result.relations) == 0:
+            logger.error("Unable to find relation for %s", iso_code)
+            return False
+        elif len(result.relations) > 1:
+            logger.error("Multiple relations found for %s", iso_code)
+            return False
+        else:
+            return result.relations[0].id
+
+    def get_ids(self, iso_codes: list[str], retry_count: int = 5) -> dict[str, int]:
+        """Resolve relation ids of the codes
 
-        return False
+        Subdivisions are resolved with a single query per country returning all its ISO3166-2 relations,
+        codes missing in the result are resolved one by one. Codes of a country whose query failed
+        are not retried one by one.
+
+        :return: relation id by code, codes that can't be resolved are left out
+        """
+        subdivisions: dict[str, list[str]] = {}
+        for code in iso_codes:
+            if "-" in code:
+                subdivisions.setdefault(code.partition("-")[0], []).append(code)
+
+        resolved: dict[str, int] = {}
+        skipped: set[str] = set()
+        for country_code, codes in subdivisions.items():
+            query = f'''
+             relation["ISO3166-2"~"^{re.escape(country_code)}-"]["boundary"="administrative"];
+             out tags;
+             '''
+            result = self._query(query=query, retry_count=retry_count)
+            if result is None:
+                logger.error("Unable to query subdivisions of %s, skipping %d codes", country_code, len(codes))
+                skipped.update(codes)
+                continue
+
+            relations: dict[str, list[int]] = {}
+            for relation in result.relations:
+                relations.setdefault(relation.tags.get("ISO3166-2"), []).append(relation.id)
+            for code in codes:
+                ids = relations.get(code, [])
+                if len(ids) == 1:
+                    resolved[code] = ids[0]
+                elif len(ids) > 1:
+                    logger.error("Multiple relations found for %s", code)
+                    skipped.add(code)
+
+        # countries and codes missing in the country results
+        for code in iso_codes:
+            if code not in resolved and code not in skipped:
+                osm_id = self.get_id(iso_code=code, retry_count=retry_count)
+                if osm_id:
+                    resolved[code] = osm_id
+
+        logger.info("Resolved %d of %d relations with %d queries", len(resolved), len(iso_codes), self.queries)
+        return resolved
 
 
 class PolyNameResolver:
@@ -131,11 +383,44 @@ class PolyNameResolver:
 
         return Path(resolve_name(code=code, file_ext=self._file_ext))
 
-def download_poly(downloader: PolyDownloader, name_resolver: PolyNameResolver, code: str, osm_id: int):
+def download_poly(downloader: PolyDownloader, name_resolver: PolyNameResolver, code: str, osm_id: int,
+                  manifest: DownloadManifest | None = None) -> bool | None:
+    """Download polygon of the relation
+
+    :return: True if the file changed, False if it stayed the same and None if the download failed
+    """
     output_path = name_resolver.resolve(code=code)
+    previous = manifest.get(output_path) if manifest else None
+
+    result = downloader.download(relation_id=osm_id, output_path=output_path, previous=previous)
+    if result is None:
+        return None
+    if manifest:
+        manifest.update(output_path=output_path, entry=result.entry)
 
-    if downloader.download(relation_id=osm_id, output_path=output_path):
+    if result.changed:
         logger.info("Successfully downloaded %s", output_path)
+    else:
+        logger.info("%s is up to date", output_path)
+    return result.changed
+
+
+def download_polys(downloader: PolyDownloader, name_resolver: PolyNameResolver, osm_ids: dict[str, int],
+                   workers: int, manifest: DownloadManifest | None = None) -> tuple[list[str], list[str]]:
+    """Download polygons of all the relations concurrently
+
+    :return: codes whose polygon changed and codes whose download failed
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda item: download_poly(downloader=downloader, name_resolver=name_resolver, code=item[0],
+                                       osm_id=item[1], manifest=manifest),
+            osm_ids.items()))
+
+    if manifest:
+        manifest.save()
+    return ([code for code, changed in zip(osm_ids, results) if changed],
+            [code for code, changed in zip(osm_ids, results) if changed is None])
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Download polygon for OpenStreetMap relation")
@@ -147,6 +432,15 @@ def parse_args():
     parser.add_argument('-r', '--regions', required=True, nargs='+', metavar='REGION',
                         help="list of regions to download")
     parser.add_argument('-v', '--verbose', action='store_true', help="verbose output")
+    parser.add_argument('--overpass-url', metavar='URL',
+                        help="Overpass API interpreter URL (default: the overpy default)")
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help="number of polygons downloaded concurrently (default: %(default)s)")
+    parser.add_argument('--max-per-host', type=int, default=2, metavar='N',
+                        help="maximum number of concurrent requests to a single host (default: %(default)s)")
+    parser.add_argument('--manifest', type=Path, default=DEFAULT_MANIFEST,
+                        help="manifest of the downloaded files used to skip unchanged polygons "
+                             "(default: %(default)s)")
 
     return parser.parse_args()
 
@@ -156,14 +450,16 @@ def main():
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 
-    osm_id_resolver = OsmIdResolver()
-    poly_downloader = PolyDownloader(poly_format=args.format)
+    osm_id_resolver = OsmIdResolver(url=args.overpass_url)
+    poly_downloader = PolyDownloader(poly_format=args.format, workers=args.workers, max_per_host=args.max_per_host)
     name_resolver = PolyNameResolver(poly_format=args.format)
 
+    osm_ids: dict[str, int] = {}
+    codes: list[str] = []
     for arg in args.regions:
         # relation id
         if arg.isdigit():
-            download_poly(downloader=poly_downloader, name_resolver=name_resolver, code=arg, osm_id=int(arg))
+            osm_ids[arg] = int(arg)
             continue
 
         # country wildcard (all subdivisions)
@@ -173,13 +469,24 @@ def main():
             subdivisions = pycountry.subdivisions.get(country_code=country_code)
             if not subdivisions:
                 raise ValueError(f'No subdivisions defined for country {match.group(1)}')
-            for subdivision in sorted(subdivisions, key=lambda subdivision: subdivision.code):
-                code = subdivision.code
-                osm_id = osm_id_resolver.get_id(code)
-                download_poly(downloader=poly_downloader, name_resolver=name_resolver, code=code, osm_id=osm_id)
+            codes.extend(sorted(subdivision.code for subdivision in subdivisions))
         else:
-            osm_id = osm_id_resolver.get_id(arg)
-            download_poly(downloader=poly_downloader, name_resolver=name_resolver, code=arg, osm_id=osm_id)
+            codes.append(arg)
+
+    # relation ids are resolved up front, with one query per country
+    resolved = osm_id_resolver.get_ids(codes)
+    unresolved = [code for code in codes if code not in resolved]
+    for code in unresolved:
+        logger.error("Skipping %s, relation not found", code)
+    osm_ids |= {code: resolved[code] for code in codes if code in resolved}
+
+    changed, failed = download_polys(downloader=poly_downloader, name_resolver=name_resolver, osm_ids=osm_ids,
+                                     workers=args.workers, manifest=DownloadManifest(args.manifest))
+
+    logger.info("Downloaded %d of %d polygons, %d changed", len(osm_ids) - len(failed),
+                len(osm_ids) + len(unresolved), len(changed))
+    if failed or unresolved:
+        raise SystemExit(f'Failed: {", ".join(unresolved + failed)}')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,286 @@
+"""HTTP service generating Squadrats grids on demand
+
+The RegionIndex together with the loaded region coordinates stays in memory between the requests.
+Built artifacts are kept in a bounded in-memory LRU cache, generated OSM files and compiled map tiles
+in the on-disk caches shared with the grid command.
+
+POST /grid?format=img|osm with a JSON body in the shape of the config file, ie.
+    {"description": "Squadrats, Malta", "zoom_14": ["MT"], "zoom_17": ["MT"]}
+returns the Garmin IMG file or a ZIP archive with OSM files of all the jobs.
+"""
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import logging
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from squadrats2garmin.common.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, FileCache, cache_key, \
+    create_file_caches
+from squadrats2garmin.common.mkgmap import RegionConfig
+from squadrats2garmin.common.region import DEFAULT_GEOMETRY_CACHE_VERTICES, GeometryCache, RegionIndex
+from squadrats2garmin.common.squadrats import OSM_FORMAT_VERSION
+from squadrats2garmin.common.tile import ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS
+from squadrats2garmin.common.timer import timeit
+from squadrats2garmin.squadrats2garmin import prepare_jobs
+
+logger = logging.getLogger(__name__)
+
+_POLYGONS_DIR = Path("config/polygons")
+# keys of the request accepted from the clients, anything else (ie. paths of style files) is ignored
+_REQUEST_KEYS = ['description', 'zoom_14', 'zoom_17']
+# content type and file name of the response for every supported format
+_FORMATS = {
+    'img': ('application/octet-stream', 'squadrats.img'),
+    'osm': ('application/zip', 'squadrats-osm.zip'),
+}
+
+
+def _refers_to_file(region: str | dict) -> bool:
+    """Does the region entry refer to a file on the server (route or polygon file)
+
+    Clients can select the regions by ISO codes and geometries only.
+    """
+    if not isinstance(region, dict):
+        return False
+    within = region.get('within', [])
+    return 'route' in region or isinstance(region.get('polygon'), str) \
+        or any(_refers_to_file(r) for r in (within if isinstance(within, list) else [within]))
+
+
+def _check_regions(regions: list[str | dict], key: str) -> None:
+    """Check that the regions of the request are a list of region codes and region objects
+
+    :raises ValueError: when they are not, including the regions the areas are limited to
+    """
+    if not isinstance(regions, list) or not all(isinstance(region, (str, dict)) for region in regions):
+        raise ValueError(f'{key} must be a list of region codes and objects')
+    for region in regions:
+        if isinstance(region, dict) and 'within' in region:
+            within = region['within']
+            _check_regions(within if isinstance(within, list) else [within], key=key)
+
+
+class ArtifactCache:
+    """
+    Bounded in-memory LRU cache of built artifacts
+
+    Concurrent requests for the same artifact are coalesced, the artifact is built only once
+    and all the requests wait for the result.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._size = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._pending: dict[str, Future[bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key: str, build: Callable[[], bytes]) -> bytes:
+        """Return the cached artifact, build it if missing"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                logger.debug('Artifact cache hit %s', key)
+                return self._entries[key]
+
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = Future()
+                building = True
+            else:
+                logger.debug('Waiting for pending build of %s', key)
+                building = False
+
+        if not building:
+            return future.result()
+
+        try:
+            artifact = build()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._pending[key]
+            self._put(key=key, artifact=artifact)
+        future.set_result(artifact)
+        return artifact
+
+    def _put(self, key: str, artifact: bytes) -> None:
+        if len(artifact) > self._max_size:
+            return
+        self._entries[key] = artifact
+        self._size += len(artifact)
+        while self._size > self._max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+
+class GridService:
+    """
+    Build grids for the requests using the resident RegionIndex and the caches
+    """
+
+    def __init__(self, poly_index: RegionIndex, artifact_cache: ArtifactCache,
+                 osm_cache: FileCache | None = None, img_cache: FileCache | None = None) -> None:
+        self._poly_index = poly_index
+        self._artifact_cache = artifact_cache
+        self._osm_cache = osm_cache
+        self._img_cache = img_cache
+
+    def get(self, request: dict, output_format: str) -> bytes:
+        """Return the grid in the requested format (img or osm)
+
+        :raises ValueError: when the request is invalid
+        """
+        if output_format not in _FORMATS:
+            raise ValueError(f'Unsupported format {output_format}')
+        config = {'description': 'Squadrats grid', 'zoom_14': [], 'zoom_17': []} | \
+                 {k: v for k, v in request.items() if k in _REQUEST_KEYS}
+        if not isinstance(config['description'], str):
+            raise ValueError('description must be a string')
+        for zoom in [ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS]:
+            _check_regions(config[f'zoom_{zoom.zoom}'], key=f'zoom_{zoom.zoom}')
+        if any(_refers_to_file(region)
+               for zoom in [ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS] for region in config[f'zoom_{zoom.zoom}']):
+            raise ValueError('Routes and polygon files are not supported')
+
+        regions = [region
+                   for zoom in [ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS]
+                   for region in self._poly_index.select_regions(regions=config[f'zoom_{zoom.zoom}'])]
+        if not regions:
+            raise ValueError('No regions requested')
+
+        # polygon files are identified by their modification time and size, so that the key is cheap to compute
+        polygons = sorted({path for region in regions for path in region.source_paths})
+        key = cache_key(output_format, OSM_FORMAT_VERSION, json.dumps(config, sort_keys=True),
+                        *(f'{path}:{path.stat().st_mtime_ns}:{path.stat().st_size}' for path in polygons))
+
+        return self._artifact_cache.get_or_build(key=key, build=lambda: self._build(config, output_format))
+
+    def _build(self, config: dict, output_format: str) -> bytes:
+        try:
+            return self._build_artifact(config=config, output_format=output_format)
+        finally:
+            self._poly_index.geometry_cache.log_stats()
+
+    def _build_artifact(self, config: dict, output_format: str) -> bytes:
+        with tempfile.TemporaryDirectory(prefix="squadrats-serve-") as tmp_dir_name:
+            tmp_dir = Path(tmp_dir_name)
+            region_config = RegionConfig.from_dict(config=config | {'output': tmp_dir / 'squadrats.img'},
+                                                   poly_index=self._poly_index, output_dir=tmp_dir)
+
+            with timeit(msg=f'Building {output_format} for {config["zoom_14"]} {config["zoom_17"]}',
+                        level=logging.INFO):
+                jobs = prepare_jobs(config=region_config, output_dir=tmp_dir, osm_cache=self._osm_cache)
+                if output_format == 'osm':
+                    archive = io.BytesIO()
+                    with zipfile.ZipFile(archive, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+                        for job in jobs:
+                            zip_file.write(job.osm_file, arcname=job.osm_file.name)
+                    return archive.getvalue()
+
+                return region_config.build_garmin_img(jobs=jobs, img_cache=self._img_cache).read_bytes()
+
+
+class GridRequestHandler(BaseHTTPRequestHandler):
+    """Handle POST /grid requests"""
+    service: GridService
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/grid':
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        output_format = parse_qs(url.query).get('format', ['img'])[0]
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+            artifact = self.service.get(request=request, output_format=output_format)
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, explain=str(e))
+            return
+        except Exception as e:
+            logger.error('Building grid for %s failed: %s', self.path, e)
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+            return
+
+        content_type, file_name = _FORMATS[output_format]
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Disposition', f'attachment; filename="{file_name}"')
+        self.send_header('Content-Length', str(len(artifact)))
+        self.end_headers()
+        self.wfile.write(artifact)
+
+    def log_message(self, format, *args):
+        logger.info('%s - ' + format, self.address_string(), *args)
+
+
+def create_server(address: tuple[str, int], service: GridService) -> ThreadingHTTPServer:
+    """Create HTTP server handling every request in a separate thread"""
+    handler = type('BoundGridRequestHandler', (GridRequestHandler,), {'service': service})
+    return ThreadingHTTPServer(address, handler)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve Squadrats grids generated on demand over HTTP")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="verbose output")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help="port to listen on (default: %(default)s)")
+    parser.add_argument('--memory-cache-size', type=int, default=256, metavar='MB',
+                        help="maximum size of the in-memory cache of built grids in megabytes (default: %(default)s)")
+    parser.add_argument('--geometry-cache-vertices', type=int, default=DEFAULT_GEOMETRY_CACHE_VERTICES, metavar='N',
+                        help="maximum number of vertices of region coordinates kept in memory (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="do not use the cache of generated files")
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR,
+                        help=f"cache directory (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // 1024 ** 2, metavar='MB',
+                        help="maximum size of the cache in megabytes (default: %(default)s)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    caches = create_file_caches(cache_dir=args.cache_dir, cache_size=args.cache_size * 1024 ** 2,
+                                no_cache=args.no_cache)
+    poly_index = RegionIndex(_POLYGONS_DIR, geometry_cache=GeometryCache(max_vertices=args.geometry_cache_vertices),
+                             manifest_path=None if args.no_cache else args.cache_dir / 'region-index.json',
+                             poly_cache=caches.poly)
+    artifact_cache = ArtifactCache(max_size=args.memory_cache_size * 1024 ** 2)
+    service = GridService(poly_index=poly_index, artifact_cache=artifact_cache,
+                          osm_cache=caches.osm, img_cache=caches.img)
+
+    with create_server((args.host, args.port), service) as server:
+        logger.info('Serving grids on http://%s:%d/grid', args.host, args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('Server stopped')
+
+
+if __name__ == "__main__":
+    main()
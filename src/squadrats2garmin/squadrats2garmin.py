@@ -1,32 +1,155 @@
 import argparse
+import itertools
+import json
 import logging
 import tempfile
+from collections.abc import Callable
+from operator import attrgetter
 from pathlib import Path
 
+from squadrats2garmin.common.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, FileCache, FileMemo, cache_key, \
+    create_file_caches
 from squadrats2garmin.common.job import Job
-from squadrats2garmin.common.mkgmap import RegionConfig
-from squadrats2garmin.common.region import RegionIndex
-from squadrats2garmin.common.squadrats import generate_osm
+from squadrats2garmin.common.mkgmap import RegionConfig, build_garmin_imgs
+from squadrats2garmin.common.region import DEFAULT_GEOMETRY_CACHE_VERTICES, CoordsPrefetcher, GeometryCache, \
+    Region, RegionIndex, Route
+from squadrats2garmin.common.squadrats import generate_osm, osm_cache_key, plan_shards
 from squadrats2garmin.common.tile import ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS
 from squadrats2garmin.common.timer import timeit
+from squadrats2garmin.common.watch import PollingWatcher
 
 logger = logging.getLogger(__name__)
 
-def process_input_job(config_file: str, poly_index: RegionIndex, output_dir: Path) -> None:
-    """Generate grid according to the config file and convert it into Garmin IMG file"""
+_POLYGONS_DIR = Path("config/polygons")
+# number of regions whose coordinates are loaded ahead of the grid generation
+_PREFETCH_LOOKAHEAD = 2
+
+def reuse_osm(job: Job, osm_cache: FileCache | None = None, osm_memo: FileMemo | None = None) -> bool:
+    """Write the OSM file of the job taken from the osm_memo (generated earlier in this run) or from the osm_cache
+
+    :return: False when the file is in neither of them and has to be generated
+    """
+    if osm_memo and osm_memo.get(key=_memo_key(job), dst=job.osm_file):
+        logger.info('Reusing OSM generated in this run: %s -> %s', job, job.osm_file)
+        return True
+
+    if osm_cache and osm_cache.get(key=osm_cache_key(job), dst=job.osm_file):
+        logger.info('Using cached OSM: %s -> %s', job, job.osm_file)
+        if osm_memo:
+            osm_memo.put(key=_memo_key(job), src=job.osm_file)
+        return True
+    return False
+
+
+def create_osm(job: Job, osm_cache: FileCache | None = None, osm_memo: FileMemo | None = None) -> None:
+    """Generate the OSM file of the job and keep it in the osm_cache and the osm_memo"""
+    with timeit(f"{job}: generate_osm"):
+        generate_osm(job)
+    if osm_cache:
+        osm_cache.put(key=osm_cache_key(job), src=job.osm_file)
+    if osm_memo:
+        osm_memo.put(key=_memo_key(job), src=job.osm_file)
+
+
+def _memo_key(job: Job) -> str:
+    return cache_key(job.region.code, job.region.poly_path, job.zoom.zoom, *job.region.grid_parameters,
+                     *(job.shard or ()))
+
+
+def prepare_input_job(config_file: str, poly_index: RegionIndex, output_dir: Path,
+                      osm_cache: FileCache | None = None, osm_memo: FileMemo | None = None,
+                      options: dict | None = None) -> tuple[RegionConfig, list[Job]]:
+    """Load the config file and obtain OSM files for all its jobs
+
+    Options override the values from the config file.
+    """
     logger.info("Load input job")
-    config = RegionConfig.parse(filename=config_file, poly_index=poly_index, output_dir=output_dir)
+    config = RegionConfig.parse(filename=config_file, poly_index=poly_index, output_dir=output_dir, options=options)
+    return config, prepare_jobs(config=config, output_dir=output_dir, osm_cache=osm_cache, osm_memo=osm_memo)
+
+
+def prepare_jobs(config: RegionConfig, output_dir: Path,
+                 osm_cache: FileCache | None = None, osm_memo: FileMemo | None = None) -> list[Job]:
+    """Obtain OSM files for all jobs of the config
+
+    Regions covering more tiles than the config's shard_max_tiles are split into shards along tile rows,
+    every shard gets its own OSM file. OSM files found in the osm_memo or in the osm_cache are reused
+    instead of being generated again, coordinates are loaded only for the regions of the other files.
+    """
+    work = [(zoom, region)
+            for zoom in [ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS]
+            for region in sorted(config.regions[zoom], key=lambda r: r.code)]
 
     jobs: list[Job] = []
-    for zoom in [ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS]:
-        for region in sorted(config.regions[zoom], key=lambda r: r.code):
-            osm_file = output_dir / f"{region.code}-{zoom.zoom}.osm"
-            job = Job(region=region, zoom=zoom, osm_file=osm_file)
-            with timeit(f"{job}: generate_osm"):
-                generate_osm(job)
-            jobs.append(job)
+    for zoom, region in work:
+        # tiles of a walked route don't come from the clipped polygon, so the route is never split;
+        # shards are planned from the footprint, so OSM files reused from the caches need no coordinates
+        shards = [] if _is_walked(region) else plan_shards(footprint=region.footprint, zoom=zoom,
+                                               max_tiles=config.shard_max_tiles)
+        if shards:
+            logger.info('Splitting %s@%d into %d shards', region.code, zoom.zoom, len(shards))
+            jobs.extend(Job(region=region, zoom=zoom, shard=shard,
+                            osm_file=output_dir / f"{region.code}-{zoom.zoom}-{shard.index}.osm")
+                        for shard in shards)
+        else:
+            jobs.append(Job(region=region, zoom=zoom, osm_file=output_dir / f"{region.code}-{zoom.zoom}.osm"))
+
+    missing = [job for job in jobs if not reuse_osm(job=job, osm_cache=osm_cache, osm_memo=osm_memo)]
+
+    groups = [(region, list(region_jobs))
+              for region, region_jobs in itertools.groupby(missing, key=attrgetter('region'))]
+    # the corridor of a walked route is never built, so only coordinates of the other regions are loaded;
+    # coordinates of the next regions are loaded while the grid of the current one is being generated
+    with CoordsPrefetcher(regions=[region for region, _ in groups if not _is_walked(region)],
+                          lookahead=_PREFETCH_LOOKAHEAD) as prefetcher:
+        prefetched = iter(prefetcher)
+        for region, region_jobs in groups:
+            if not _is_walked(region):
+                next(prefetched)
+            for job in region_jobs:
+                create_osm(job=job, osm_cache=osm_cache, osm_memo=osm_memo)
+
+    return jobs
+
+
+def _is_walked(region: Region) -> bool:
+    return isinstance(region, Route) and region.method == 'walk'
+
+
+def process_input_job(config_file: str, poly_index: RegionIndex, output_dir: Path,
+                      osm_cache: FileCache | None = None, img_cache: FileCache | None = None,
+                      osm_memo: FileMemo | None = None, options: dict | None = None) -> None:
+    """Generate grid according to the config file and convert it into Garmin IMG file
+
+    OSM files found in the osm_memo or in the osm_cache and tile IMG files found in the img_cache
+    are reused instead of being generated again. Options override the values from the config file.
+    """
+    config, jobs = prepare_input_job(config_file=config_file, poly_index=poly_index, output_dir=output_dir,
+                                     osm_cache=osm_cache, osm_memo=osm_memo, options=options)
+    config.build_garmin_img(jobs=jobs, img_cache=img_cache)
+
+
+def process_input_jobs_in_batch(config_files: list[str], poly_index: RegionIndex, output_dir: Path,
+                                osm_cache: FileCache | None = None, img_cache: FileCache | None = None,
+                                osm_memo: FileMemo | None = None, options: dict | None = None) -> None:
+    """Generate grids according to multiple config files compiling all the map tiles in a single mkgmap run
 
-    config.build_garmin_img(jobs=jobs)
+    Every config gets its own subdirectory of the output_dir and its own output IMG file
+    """
+    builds: list[tuple[RegionConfig, list[Job]]] = []
+    for sequence_number, config_file in enumerate(config_files, start=1):
+        config_dir = output_dir / f'{sequence_number:03d}'
+        config_dir.mkdir()
+        with timeit(msg=f"Preparing {config_file}"):
+            builds.append(prepare_input_job(config_file=config_file, poly_index=poly_index, output_dir=config_dir,
+                                            osm_cache=osm_cache, osm_memo=osm_memo, options=options))
+
+    with timeit(msg=f"Building {len(builds)} Garmin IMG files"):
+        configs = [config for config, _ in builds]
+        build_garmin_imgs(builds=builds, work_dir=output_dir, img_cache=img_cache,
+                          processes=max(config.mkgmap_processes for config in configs),
+                          heap_mb=max((c.mkgmap_max_heap for c in configs if c.mkgmap_max_heap), default=None),
+                          max_jobs=max((c.mkgmap_max_jobs for c in configs if c.mkgmap_max_jobs), default=None))
 
 
 def parse_args():
@@ -37,9 +160,134 @@ def parse_args():
                         help="keep output files after processing")
     parser.add_argument('-c', '--config-files', required=True, nargs='+', metavar='CONFIG_FILE',
                         help="list of config files to process")
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help="compile map tiles of all config files in a single mkgmap run")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="keep running and process config files again whenever they or their polygons change")
+    parser.add_argument('--watch-interval', type=float, default=2.0, metavar='SECONDS',
+                        help="interval of checking files for changes in the watch mode (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="do not use the cache of generated files")
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR,
+                        help=f"cache directory (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // 1024 ** 2, metavar='MB',
+                        help="maximum size of the cache in megabytes (default: %(default)s)")
+    parser.add_argument('--mkgmap-processes', type=int, metavar='N',
+                        help="number of mkgmap processes compiling map tiles concurrently")
+    parser.add_argument('--mkgmap-max-heap', type=int, metavar='MB',
+                        help="JVM heap size of every mkgmap process (default: sized from the input)")
+    parser.add_argument('--mkgmap-max-jobs', type=int, metavar='N',
+                        help="number of threads of every mkgmap process (default: sized from the input)")
+    parser.add_argument('--geometry-cache-vertices', type=int, default=DEFAULT_GEOMETRY_CACHE_VERTICES, metavar='N',
+                        help="maximum number of vertices of region coordinates kept in memory (default: %(default)s)")
+    parser.add_argument('--shard-max-tiles', type=int, metavar='N',
+                        help="split regions covering more tiles into shards compiled as separate map tiles")
     return parser.parse_args()
 
 
+def process_config_files(config_files: list[str], poly_index: RegionIndex,
+                         osm_cache: FileCache | None = None, img_cache: FileCache | None = None,
+                         options: dict | None = None, batch: bool = False, keep: bool = False) -> None:
+    """Process config files one by one or all of them in a single batch"""
+    # OSM files generated in this run are shared by all config files
+    with tempfile.TemporaryDirectory(prefix="squadrats-osm-") as memo_dir_name:
+        osm_memo = FileMemo(root=Path(memo_dir_name))
+
+        # process input jobs
+        if batch:
+            with tempfile.TemporaryDirectory(prefix="mkgmap-", delete=(not keep)) as tmp_dir_name:
+                with timeit(msg=f"Processing {len(config_files)} config files"):
+                    process_input_jobs_in_batch(config_files=config_files, poly_index=poly_index,
+                                                output_dir=Path(tmp_dir_name), osm_cache=osm_cache,
+                                                img_cache=img_cache, osm_memo=osm_memo, options=options)
+
+                if keep:
+                    logger.info(f"Keeping output files in {tmp_dir_name}")
+            return
+
+        for config_file in config_files:
+            with tempfile.TemporaryDirectory(prefix="mkgmap-", delete=(not keep)) as tmp_dir_name:
+                tmp_dir = Path(tmp_dir_name)
+
+                with timeit(msg=f"Processing {config_file}"):
+                    process_input_job(config_file=config_file, poly_index=poly_index, output_dir=tmp_dir,
+                                      osm_cache=osm_cache, img_cache=img_cache, osm_memo=osm_memo,
+                                      options=options)
+
+                if keep:
+                    logger.info(f"Keeping output files in {tmp_dir_name}")
+
+
+def config_poly_paths(config_file: str, poly_index: RegionIndex) -> set[Path] | None:
+    """Paths of the polygon files of all regions selected by the config file
+
+    :return: None if the config file can't be read or refers to unknown regions
+    """
+    try:
+        with open(config_file, encoding='UTF-8') as f:
+            config = json.load(f)
+        regions = poly_index.select_regions(regions=config['zoom_14']) + \
+                  poly_index.select_regions(regions=config['zoom_17'])
+    except (OSError, ValueError, KeyError) as e:
+        logger.error('Invalid config file %s: %s', config_file, e)
+        return None
+    return {path for region in regions for path in region.source_paths}
+
+
+def watch_config_files(config_files: list[str], poly_index: RegionIndex, polygons_dir: Path, interval: float,
+                       process: Callable[[list[str], RegionIndex], None]) -> None:
+    """Process all config files, then process config files affected by changes of the config files
+    or the polygon files until interrupted
+
+    A failed run or a failed update of the index is logged and does not stop watching, the previous index is used
+    then. The RegionIndex is kept between the runs together with the loaded coordinates, only coordinates
+    of the changed polygon files are loaded again. The index is rebuilt when polygon files are added or removed.
+    """
+    def process_safely(affected: list[str]) -> None:
+        try:
+            process(affected, poly_index)
+        except Exception as e:
+            logger.error('Processing failed: %s', e)
+
+    watcher = PollingWatcher(paths=[polygons_dir, *(Path(config_file) for config_file in config_files)],
+                             interval=interval)
+    dependencies = {config_file: config_poly_paths(config_file, poly_index) for config_file in config_files}
+    process_safely([config_file for config_file in config_files if dependencies[config_file] is not None])
+
+    logger.info('Watching %d config files and "%s" for changes', len(config_files), polygons_dir)
+    while True:
+        changed = watcher.wait()
+        changed_polygons = {path for path in changed if path.suffix in ['.geojson', '.poly']}
+
+        try:
+            if any(path not in poly_index.poly_paths() or not path.exists() for path in changed_polygons):
+                logger.info('Polygon files added or removed - rebuilding polygon index')
+                poly_index = RegionIndex(polygons_dir, geometry_cache=poly_index.geometry_cache,
+                                         manifest_path=poly_index.manifest_path, poly_cache=poly_index.poly_cache)
+                affected = list(config_files)
+            else:
+                poly_index.invalidate(changed_polygons)
+                affected = [config_file for config_file in config_files
+                            if Path(config_file) in changed
+                            or dependencies[config_file] is None
+                            or dependencies[config_file] & changed_polygons]
+        except Exception as e:
+            # the previous index is kept until the next change
+            logger.error('Updating polygon index failed: %s', e)
+            continue
+
+        for config_file in affected:
+            dependencies[config_file] = config_poly_paths(config_file, poly_index)
+        affected = [config_file for config_file in affected if dependencies[config_file] is not None]
+        if not affected:
+            logger.info('No config file affected by the changes')
+            continue
+
+        logger.info('Processing %d affected config files: %s', len(affected), ', '.join(affected))
+        process_safely(affected)
+        poly_index.geometry_cache.log_stats()
+
+
 def main():
     # parse arguments
     args = parse_args()
@@ -48,18 +296,38 @@ def main():
 
     # create poly index
     logger.info("Generate poly index")
-    poly_index = RegionIndex(Path("config/polygons"))
+    caches = create_file_caches(cache_dir=args.cache_dir, cache_size=args.cache_size * 1024 ** 2,
+                                no_cache=args.no_cache)
+    poly_index = RegionIndex(_POLYGONS_DIR, geometry_cache=GeometryCache(max_vertices=args.geometry_cache_vertices),
+                             manifest_path=None if args.no_cache else args.cache_dir / 'region-index.json',
+                             poly_cache=caches.poly)
+
+
+    options = {}
+    if args.mkgmap_processes:
+        options['mkgmap_processes'] = args.mkgmap_processes
+    if args.mkgmap_max_heap:
+        options['mkgmap_max_heap'] = args.mkgmap_max_heap
+    if args.mkgmap_max_jobs:
+        options['mkgmap_max_jobs'] = args.mkgmap_max_jobs
+    if args.shard_max_tiles:
+        options['shard_max_tiles'] = args.shard_max_tiles
+
+    def process(config_files: list[str], poly_index: RegionIndex) -> None:
+        process_config_files(config_files=config_files, poly_index=poly_index, osm_cache=caches.osm,
+                             img_cache=caches.img, options=options, batch=args.batch, keep=args.keep)
 
-    # process input jobs
-    for config_file in args.config_files:
-        with tempfile.TemporaryDirectory(prefix="mkgmap-", delete=(not args.keep)) as tmp_dir_name:
-            tmp_dir = Path(tmp_dir_name)
+    if not args.watch:
+        process(args.config_files, poly_index)
+        poly_index.geometry_cache.log_stats()
+        return
 
-            with timeit(msg=f"Processing {config_file}"):
-                process_input_job(config_file=config_file, poly_index=poly_index, output_dir=tmp_dir)
+    try:
+        watch_config_files(config_files=args.config_files, poly_index=poly_index, polygons_dir=_POLYGONS_DIR,
+                           interval=args.watch_interval, process=process)
+    except KeyboardInterrupt:
+        logger.info('Watching stopped')
 
-            if args.keep:
-                logger.info(f"Keeping output files in {tmp_dir_name}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
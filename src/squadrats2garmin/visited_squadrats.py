@@ -1,9 +1,9 @@
 import argparse
-import itertools
 import logging
+import math
 import sys
 import tempfile
-from collections.abc import Sequence
+from collections.abc import Iterator, Sequence
 from pathlib import Path
 from typing import Protocol
 
@@ -11,24 +11,108 @@ import fastkml.geometry
 from fastkml import KML
 from fastkml import Placemark
 from fastkml.utils import find
-from shapely import LinearRing, MultiPolygon, Polygon
-from shapely.geometry import shape
 
+from squadrats2garmin.common.geojson import Feature, iter_features
 from squadrats2garmin.common.mkgmap import VisitedSquadratsConfig
-from squadrats2garmin.common.osm import Tags, OSMProducer, AbstractOSMProducer, node_to_xml, \
-    way_to_xml, multipolygon_to_xml
+from squadrats2garmin.common.osm import Point, Tags, OSMProducer, AbstractOSMProducer, OSMWriter
 from squadrats2garmin.common.squadrats import SquadratsClient
+from squadrats2garmin.common.tile import ZOOM_SQUADRATINHOS
 from squadrats2garmin.common.timer import timeit
 
 logger = logging.getLogger(__name__)
 
+# vertices closer to a corner of a squadratinho than this fraction of the tile are snapped to the corner
+_SNAP_TOLERANCE = 0.01
+
 
 class GeoJSONProvider(Protocol):
-    def load(self):
+    def features(self) -> Iterator[Feature]:
+        """Features of the GeoJSON, read one at a time"""
         ...
 
 
-class KMLOSMProducer(AbstractOSMProducer, OSMProducer):
+class VisitedOSMProducer(AbstractOSMProducer):
+    """
+    Base of the producers of visited squadrats, writing rings of the trophies
+
+    Trophies are unions of tiles, so their vertices lie on the lattice of squadratinhos corners. Vertices are
+    snapped to the lattice, vertices in the middle of straight edges are dropped and every vertex is written
+    as a single node shared by all the rings passing through it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.__n = 2 ** ZOOM_SQUADRATINHOS.zoom
+        self.__node_ids: dict[tuple[float, float], int] = {}
+
+    def __to_lattice(self, point: Point) -> tuple[float, float]:
+        """Vertex of the point in the tile coordinates, integer if snapped to the lattice"""
+        x = (point[0] + 180.0) / 360.0 * self.__n
+        y = (1.0 - math.asinh(math.tan(math.radians(point[1]))) / math.pi) / 2.0 * self.__n
+        tile = (round(x), round(y))
+        if abs(x - tile[0]) < _SNAP_TOLERANCE and abs(y - tile[1]) < _SNAP_TOLERANCE:
+            return tile
+        return x, y
+
+    def _write_ring(self, writer: OSMWriter, coords: Sequence[Point]) -> int | None:
+        """Write the ring as a way
+
+        :return: id of the way, None if the ring has no area
+        """
+        vertices = [self.__to_lattice(point) for point in coords]
+        ring = _simplify_ring(vertices)
+        if len(ring) < 3:
+            return None
+
+        node_ids = []
+        points: dict[tuple[float, float], Point] | None = None
+        for vertex in ring:
+            node_id = self.__node_ids.get(vertex)
+            if node_id is None:
+                node_id = self.__node_ids[vertex] = self._next_id()
+                if isinstance(vertex[0], int):
+                    geom = ZOOM_SQUADRATINHOS.to_point(vertex)
+                else:
+                    # vertices off the lattice keep the coordinates of their points
+                    points = points or dict(zip(vertices, coords))
+                    geom = points[vertex]
+                writer.write_node(element_id=node_id, geom=geom)
+            node_ids.append(node_id)
+
+        # first and last node are the same and this needs to be the same object in OSM file
+        node_ids.append(node_ids[0])
+
+        way_id = self._next_id()
+        writer.write_way(element_id=way_id, refs=node_ids)
+        return way_id
+
+
+def _collinear(a: tuple[float, float], b: tuple[float, float], c: tuple[float, float]) -> bool:
+    # exact on the lattice, where the vertices are integers
+    return (b[0] - a[0]) * (c[1] - b[1]) == (b[1] - a[1]) * (c[0] - b[0])
+
+
+def _simplify_ring(vertices: list[tuple[float, float]]) -> list[tuple[float, float]]:
+    """Drop repeated vertices and vertices in the middle of straight edges of the closed ring"""
+    ring: list[tuple[float, float]] = []
+    for vertex in vertices:
+        while len(ring) >= 2 and _collinear(ring[-2], ring[-1], vertex):
+            ring.pop()
+        if not ring or ring[-1] != vertex:
+            ring.append(vertex)
+
+    # the ring wraps around, so its first and last vertices may lie in the middle of an edge as well
+    while len(ring) >= 3:
+        if ring[-1] == ring[0] or _collinear(ring[-2], ring[-1], ring[0]):
+            ring.pop()
+        elif _collinear(ring[-1], ring[0], ring[1]):
+            ring.pop(0)
+        else:
+            break
+    return ring
+
+
+class KMLOSMProducer(VisitedOSMProducer, OSMProducer):
     """Convert Squadrats' KML to OSM"""
 
     __KML_PLACEMARKS: list[str] = ['squadrats', 'squadratinhos', 'ubersquadrat', 'ubersquadratinho']
@@ -40,54 +124,45 @@ class KMLOSMProducer(AbstractOSMProducer, OSMProducer):
     def to_file(self, file: Path) -> None:
         """OSMProducer protocol"""
         logger.info("Processing KML data")
-        for placemark_name in self.__KML_PLACEMARKS:
-            with timeit(msg=f"Processing {placemark_name}"):
-                placemark: Placemark = find(self.__kml, name=placemark_name)
-                self.__kml_placemark_to_osm(placemark=placemark, tags={'name': placemark_name})
-
-        self._write_document(file=file)
+        with OSMWriter(file) as writer:
+            for placemark_name in self.__KML_PLACEMARKS:
+                with timeit(msg=f"Processing {placemark_name}"):
+                    placemark: Placemark = find(self.__kml, name=placemark_name)
+                    self.__kml_placemark_to_osm(writer=writer, placemark=placemark, tags={'name': placemark_name})
 
-    def __parse_kml_linear_ring(self, ring: fastkml.geometry.LinearRing) -> int:
+    def __parse_kml_linear_ring(self, writer: OSMWriter, ring: fastkml.geometry.LinearRing) -> int | None:
         """Parse fastkml.geometry.LinearRing"""
-        coords = ring.kml_coordinates.coords
-
-        # first and last node are the same and this needs to be the same object in OSM file
-        node_ids = [self._next_id() for _ in itertools.islice(coords, 0, len(coords) - 1)]
-
-        for node_id, point in zip(node_ids, coords):
-            self._document.append(node_to_xml(element_id=node_id, geom=point))
+        return self._write_ring(writer=writer, coords=ring.kml_coordinates.coords)
 
-        node_ids.append(node_ids[0])
-
-        way_id = self._next_id()
-        self._document.append(way_to_xml(element_id=way_id, refs=node_ids))
-        return way_id
-
-    def __parse_kml_multipolygon(self, polygons: list[fastkml.geometry.Polygon], tags: Tags = None) -> None:
+    def __parse_kml_multipolygon(self, writer: OSMWriter, polygons: list[fastkml.geometry.Polygon],
+                                 tags: Tags = None) -> None:
         """Parse fastkml.geometry.Polygon"""
         outer: list[int] = []
         inner: list[int] = []
 
         for poly in polygons:
-            outer.append(self.__parse_kml_linear_ring(ring=poly.outer_boundary.kml_geometry))
-            inner.extend(
-                [self.__parse_kml_linear_ring(ring=boundary.kml_geometry) for boundary in poly.inner_boundaries])
+            way_id = self.__parse_kml_linear_ring(writer=writer, ring=poly.outer_boundary.kml_geometry)
+            if way_id is None:
+                continue
+            outer.append(way_id)
+            inner.extend(way_id for way_id in (self.__parse_kml_linear_ring(writer=writer, ring=boundary.kml_geometry)
+                                               for boundary in poly.inner_boundaries) if way_id is not None)
 
-        self._document.append(multipolygon_to_xml(
-            element_id=self._next_id(), outer_rings=outer, inner_rings=inner, tags=tags))
+        if outer:
+            writer.write_multipolygon(element_id=self._next_id(), outer_rings=outer, inner_rings=inner, tags=tags)
 
-    def __kml_placemark_to_osm(self, placemark: Placemark, tags: Tags):
+    def __kml_placemark_to_osm(self, writer: OSMWriter, placemark: Placemark, tags: Tags):
         """Write fastkml.Placemark to OSM XML"""
         # use kml_geometry as it doesn't require recalculation
         if isinstance(placemark.kml_geometry, fastkml.geometry.MultiGeometry):
-            self.__parse_kml_multipolygon(polygons=placemark.kml_geometry.kml_geometries, tags=tags)
+            self.__parse_kml_multipolygon(writer=writer, polygons=placemark.kml_geometry.kml_geometries, tags=tags)
         elif isinstance(placemark.kml_geometry, fastkml.geometry.Polygon):
-            self.__parse_kml_multipolygon(polygons=[placemark.kml_geometry], tags=tags)
+            self.__parse_kml_multipolygon(writer=writer, polygons=[placemark.kml_geometry], tags=tags)
         else:
             return
 
 
-class GeoJSONOSMProducer(AbstractOSMProducer, OSMProducer):
+class GeoJSONOSMProducer(VisitedOSMProducer, OSMProducer):
     """Convert Squadrats' GeoJSON to OSM"""
 
     __GEOJSON_FEATURES: list[str] = ['squadrats', 'squadratinhos', 'ubersquadrat', 'ubersquadratinho']
@@ -97,64 +172,58 @@ class GeoJSONOSMProducer(AbstractOSMProducer, OSMProducer):
         self.__provider = provider
 
     def to_file(self, file: Path) -> None:
-        """OSMProducer protocol"""
-        geo_json = self.__provider.load()
-        for feature in geo_json['features']:
-            feature_name = feature['properties']['name']
-            if feature_name in self.__GEOJSON_FEATURES:
-                with timeit(msg=f"Processing {feature_name}"):
-                    self.__shape_to_osm(geom=shape(feature), tags={'name': feature_name})
-
-        self._write_document(file=file)
-
-    def __parse_linear_ring(self, ring: LinearRing) -> int:
-        """Parse LinearRing"""
-
-        # first and last node are the same and this needs to be the same object in OSM file
-        node_ids = [self._next_id() for _ in itertools.islice(ring.coords, 0, len(ring.coords) - 1)]
-
-        for node_id, point in zip(node_ids, ring.coords):
-            self._document.append(node_to_xml(element_id=node_id, geom=point))
-
-        node_ids.append(node_ids[0])
-
-        way_id = self._next_id()
-        self._document.append(way_to_xml(element_id=way_id, refs=node_ids))
-        return way_id
-
-    def __parse_multipolygon(self, polygons: Sequence[Polygon], tags: Tags = None):
+        """OSMProducer protocol
+
+        Polygons are converted as they are decoded and their elements written straight to the file.
+        """
+        with OSMWriter(file) as writer:
+            for feature in self.__provider.features():
+                feature_name = feature.properties.get('name')
+                if feature_name in self.__GEOJSON_FEATURES:
+                    with timeit(msg=f"Processing {feature_name}"):
+                        self.__parse_multipolygon(writer=writer, polygons=feature.polygons,
+                                                  tags={'name': feature_name})
+
+    def __parse_multipolygon(self, writer: OSMWriter, polygons: Iterator[list[Sequence[Point]]], tags: Tags = None):
+        """Parse polygons given as lists of rings, the outer ring first"""
         outer: list[int] = []
         inner: list[int] = []
 
         for poly in polygons:
-            outer.append(self.__parse_linear_ring(ring=poly.exterior))
-            inner.extend([
-                self.__parse_linear_ring(ring=inner_ring)
-                for inner_ring in poly.interiors
-            ])
+            way_id = self._write_ring(writer=writer, coords=poly[0]) if poly else None
+            if way_id is None:
+                continue
+            outer.append(way_id)
+            inner.extend(way_id for way_id in (self._write_ring(writer=writer, coords=inner_ring)
+                                               for inner_ring in poly[1:]) if way_id is not None)
 
-        self._document.append(multipolygon_to_xml(
-            element_id=self._next_id(), outer_rings=outer, inner_rings=inner, tags=tags))
+        if outer:
+            writer.write_multipolygon(element_id=self._next_id(), outer_rings=outer, inner_rings=inner, tags=tags)
 
-    def __shape_to_osm(self, geom: Polygon | MultiPolygon, tags: Tags):
-        """Write shape to OSM XML"""
-        match geom.geom_type:
-            case 'MultiPolygon':
-                self.__parse_multipolygon(polygons=geom.geoms, tags=tags)
-                pass
-            case 'Polygon':
-                self.__parse_multipolygon(polygons=[geom], tags=tags)
+
+class GeoJSONFileProvider(GeoJSONProvider):
+    def __init__(self, path: Path) -> None:
+        self.__path: Path = path
+
+    def features(self) -> Iterator[Feature]:
+        """GeoJSONProvider protocol"""
+        return iter_features(self.__path)
 
 
 class SquadratsTrophiesProvider(GeoJSONProvider):
-    def __init__(self, user_id: str) -> None:
+    def __init__(self, user_id: str, download_dir: Path) -> None:
         self.__user_id: str = user_id
+        self.__path: Path = download_dir / 'squadrats-trophies.geojson'
         self.__client = SquadratsClient()
 
-    def load(self):
-        """GeoJSONProvider protocol"""
+    def features(self) -> Iterator[Feature]:
+        """GeoJSONProvider protocol
+
+        Trophies are downloaded to a file first and decoded from it incrementally.
+        """
         logger.info("Fetching Squadrats data")
-        return self.__client.get_trophies(user_id=self.__user_id)
+        self.__client.download_trophies(user_id=self.__user_id, path=self.__path)
+        return iter_features(self.__path)
 
 
 def parse_args():
@@ -175,7 +244,8 @@ def generate_osm(output: Path, args):
     osm_producer: OSMProducer
 
     if args.user_id:
-        osm_producer = GeoJSONOSMProducer(provider=SquadratsTrophiesProvider(user_id=args.user_id))
+        osm_producer = GeoJSONOSMProducer(
+            provider=SquadratsTrophiesProvider(user_id=args.user_id, download_dir=output.parent))
     elif args.kml_file:
         osm_producer = KMLOSMProducer(kml=KML.parse(Path(args.kml_file)))
     else:
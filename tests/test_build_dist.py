@@ -0,0 +1,85 @@
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from squadrats2garmin.build_dist import BuildState, BuildTarget
+from squadrats2garmin.common.region import RegionIndex
+
+
+class TestBuildTarget(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region" / "index-1"
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+        self.polygons_dir = self.tmp_dir / 'polygons'
+        shutil.copytree(self.RESOURCE_DIR, self.polygons_dir)
+
+        self.config_file = self.tmp_dir / 'IE.json'
+        self.config_file.write_text(json.dumps({
+            'output': str(self.tmp_dir / 'dist' / 'squadrats-IE.img'),
+            'description': 'Squadrats, Ireland',
+            'zoom_14': ['IE-*'],
+            'zoom_17': ['IE-C'],
+        }))
+
+    def _target(self) -> BuildTarget:
+        return BuildTarget.from_config(config_file=self.config_file, poly_index=RegionIndex(self.polygons_dir))
+
+    def test_dependencies(self):
+        target = self._target()
+
+        self.assertEqual(self.tmp_dir / 'dist' / 'squadrats-IE.img', target.output)
+        self.assertEqual(self.config_file, target.inputs[0])
+        self.assertEqual(['IE-C-Connaught.poly', 'IE-L-Leinster.poly', 'IE-M-Munster.poly', 'IE-U-Ulster.poly'],
+                         [path.name for path in target.inputs[1:5]])
+        self.assertEqual(7, len(target.inputs))
+
+    def test_fingerprint(self):
+        fingerprint = self._target().fingerprint()
+        self.assertEqual(fingerprint, self._target().fingerprint())
+
+        # change in a polygon file changes the fingerprint
+        with (self.polygons_dir / 'IE-Éire' / 'IE-U-Ulster.poly').open('a') as f:
+            f.write('\n')
+        self.assertNotEqual(fingerprint, self._target().fingerprint())
+
+    def test_area_fingerprint(self):
+        area_file = self.tmp_dir / 'areas' / 'dublin.geojson'
+        area_file.parent.mkdir()
+        area_file.write_text(json.dumps({'type': 'Polygon',
+                                         'coordinates': [[[-6.5, 53.2], [-6.0, 53.2], [-6.0, 53.5], [-6.5, 53.2]]]}))
+        self.config_file.write_text(json.dumps({
+            'output': str(self.tmp_dir / 'dist' / 'squadrats-dublin.img'),
+            'description': 'Squadrats, Dublin',
+            'zoom_14': [],
+            'zoom_17': [{'polygon': str(area_file), 'within': 'IE-*'}],
+        }))
+        target = self._target()
+        self.assertIn(area_file, target.inputs)
+        fingerprint = target.fingerprint()
+
+        # change in the area file changes the fingerprint, not only changes in the regions it's limited to
+        with area_file.open('a') as f:
+            f.write('\n')
+        self.assertNotEqual(fingerprint, self._target().fingerprint())
+
+    def test_build_state(self):
+        target = self._target()
+        fingerprint = target.fingerprint()
+        state_file = self.tmp_dir / 'cache' / 'build-state.json'
+
+        # missing output is never up to date
+        BuildState(state_file).update(target=target, fingerprint=fingerprint)
+        self.assertFalse(BuildState(state_file).is_up_to_date(target=target, fingerprint=fingerprint))
+
+        target.output.parent.mkdir(parents=True)
+        target.output.write_bytes(b'IMG')
+        self.assertTrue(BuildState(state_file).is_up_to_date(target=target, fingerprint=fingerprint))
+        self.assertFalse(BuildState(state_file).is_up_to_date(target=target, fingerprint='changed'))
+
+
+if __name__ == '__main__':
+    unittest.main()
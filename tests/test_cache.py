@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from squadrats2garmin.common.cache import FileCache, FileMemo, cache_key, create_file_caches
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def _write(self, name: str, content: bytes) -> Path:
+        path = self.tmp_dir / name
+        path.write_bytes(content)
+        return path
+
+    def test_cache_key(self):
+        """Test that the cache key depends on all the parts"""
+        self.assertEqual(cache_key('abc', 14, 1), cache_key('abc', 14, 1))
+        self.assertNotEqual(cache_key('abc', 14, 1), cache_key('abc', 17, 1))
+        self.assertNotEqual(cache_key('abc', 14, 1), cache_key('abc', 14, 2))
+
+    def test_get_put(self):
+        """Test storing and retrieving a file"""
+        cache = FileCache(root=self.tmp_dir / 'cache', suffix='.osm')
+        key = cache_key('PL-22', 14)
+
+        self.assertFalse(cache.get(key=key, dst=self.tmp_dir / 'out' / 'miss.osm'))
+        self.assertFalse((self.tmp_dir / 'out' / 'miss.osm').exists())
+
+        cache.put(key=key, src=self._write('PL-22-14.osm', b'<osm/>'))
+        self.assertTrue(cache.get(key=key, dst=self.tmp_dir / 'out' / 'hit.osm'))
+        self.assertEqual(b'<osm/>', (self.tmp_dir / 'out' / 'hit.osm').read_bytes())
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entries are evicted first"""
+        cache = FileCache(root=self.tmp_dir / 'cache', max_size=20, suffix='.osm')
+        keys = [cache_key(i) for i in range(3)]
+
+        for i, key in enumerate(keys[:2]):
+            cache.put(key=key, src=self._write(f'{i}.osm', b'x' * 10))
+            # make sure the access times differ
+            os.utime(cache._entry(key), (i, i))
+
+        # touch the first entry, so the second one becomes the least recently used
+        self.assertTrue(cache.get(key=keys[0], dst=self.tmp_dir / 'hit.osm'))
+        cache.put(key=keys[2], src=self._write('2.osm', b'x' * 10))
+
+        self.assertTrue(cache.get(key=keys[0], dst=self.tmp_dir / 'hit.osm'))
+        self.assertFalse(cache.get(key=keys[1], dst=self.tmp_dir / 'hit.osm'))
+        self.assertTrue(cache.get(key=keys[2], dst=self.tmp_dir / 'hit.osm'))
+
+
+class TestCreateFileCaches(unittest.TestCase):
+
+    def test_caches_share_the_size(self):
+        caches = create_file_caches(cache_dir=Path('cache'), cache_size=1000)
+        self.assertEqual([Path('cache/poly'), Path('cache/osm'), Path('cache/img')], [cache.root for cache in caches])
+        self.assertGreaterEqual(1000, sum(cache.max_size for cache in caches))
+
+        caches = create_file_caches(cache_dir=Path('cache'), cache_size=1000, no_cache=True)
+        self.assertEqual((None, None, None), caches)
+
+
+class TestFileMemo(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def test_get_put(self):
+        """Test that memoized file is available after the source is gone"""
+        memo = FileMemo(root=self.tmp_dir / 'memo')
+        key = cache_key('PL-22', 17)
+
+        src = self.tmp_dir / 'config-1' / 'PL-22-17.osm'
+        src.parent.mkdir()
+        src.write_bytes(b'<osm/>')
+
+        self.assertFalse(memo.get(key=key, dst=self.tmp_dir / 'config-2' / 'PL-22-17.osm'))
+        memo.put(key=key, src=src)
+        src.unlink()
+
+        self.assertTrue(memo.get(key=key, dst=self.tmp_dir / 'config-2' / 'PL-22-17.osm'))
+        self.assertEqual(b'<osm/>', (self.tmp_dir / 'config-2' / 'PL-22-17.osm').read_bytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
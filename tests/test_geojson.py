@@ -0,0 +1,95 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from parameterized import parameterized
+
+from squadrats2garmin.common.geojson import iter_features
+
+FEATURES = [
+    {'type': 'Feature', 'properties': {'name': 'squadrats'},
+     'geometry': {'type': 'Polygon', 'coordinates': [[[18.5, 54.25], [18.75, 54.25], [18.75, 54.5], [18.5, 54.25]]]}},
+    {'type': 'Feature', 'properties': {'name': 'ubersquadrat', 'size': 12345678901234567890},
+     'geometry': {'type': 'Polygon', 'coordinates': [[[-0.125, 1e-7], [1, 0], [1, 1], [-0.125, 1e-7]]]}},
+    {'type': 'Feature', 'properties': {'name': 'squadratinhos'},
+     'geometry': {'type': 'MultiPolygon', 'coordinates': [
+         [[[0, 0], [4, 0], [4, 4], [0, 0]], [[1, 1], [2, 1], [2, 2], [1, 1]]],
+         [[[5, 5], [6, 5], [6, 6], [5, 5]]],
+     ]}},
+    {'type': 'Feature', 'properties': {'name': 'point'}, 'geometry': {'type': 'Point', 'coordinates': [0, 0]}},
+    {'type': 'Feature', 'properties': None, 'geometry': None},
+]
+
+
+def polygons(feature: dict) -> list:
+    """Polygons of the feature as expected from the reader"""
+    geometry = feature['geometry'] or {}
+    match geometry.get('type'):
+        case 'Polygon':
+            return [geometry['coordinates']]
+        case 'MultiPolygon':
+            return geometry['coordinates']
+    return []
+
+
+def read(path: Path, chunk_size: int = 64 * 1024) -> list[tuple[dict, list]]:
+    """Properties and polygons of the features, polygons taken before the next feature"""
+    return [(feature.properties, list(feature.polygons)) for feature in iter_features(path, chunk_size=chunk_size)]
+
+
+class TestIterFeatures(unittest.TestCase):
+
+    def setUp(self):
+        self.path = Path(self.enterContext(tempfile.TemporaryDirectory())) / 'trophies.geojson'
+
+    @parameterized.expand([(1,), (7,), (64 * 1024,)])
+    def test_iter_features(self, chunk_size: int):
+        self.path.write_text(json.dumps({'type': 'FeatureCollection', 'features': FEATURES,
+                                         'properties': {'name': 'Zażółć'}}, indent=1), encoding='utf-8')
+        self.assertEqual([(feature['properties'] or {}, polygons(feature)) for feature in FEATURES],
+                         read(self.path, chunk_size=chunk_size))
+
+    @parameterized.expand([(1,), (64 * 1024,)])
+    def test_member_order(self, chunk_size: int):
+        # properties after the geometry and type after the coordinates
+        self.path.write_text('{"features": [{"geometry": {"coordinates": [[[[0, 0], [1, 0], [1, 1], [0, 0]]]], '
+                             '"type": "MultiPolygon"}, "properties": {"name": "squadrats"}, "type": "Feature"}]}')
+        self.assertEqual([({'name': 'squadrats'}, [[[[0, 0], [1, 0], [1, 1], [0, 0]]]])],
+                         read(self.path, chunk_size=chunk_size))
+
+    def test_polygons_skipped(self):
+        self.path.write_text(json.dumps({'features': FEATURES}))
+        self.assertEqual([feature['properties'] or {} for feature in FEATURES],
+                         [feature.properties for feature in iter_features(self.path)])
+
+    def test_polygons_decoded_one_at_a_time(self):
+        # the file ends in the middle of the second polygon, the first one is decoded before that's known
+        self.path.write_text('{"features": [{"properties": {}, "geometry": {"type": "MultiPolygon", "coordinates": '
+                             '[[[[0, 0], [1, 0], [1, 1], [0, 0]]], [[[5, 5], [6, 5]')
+        features = iter_features(self.path, chunk_size=4)
+        feature = next(features)
+        self.assertEqual([[[0, 0], [1, 0], [1, 1], [0, 0]]], next(feature.polygons))
+        with self.assertRaises(ValueError):
+            next(feature.polygons)
+
+    def test_empty(self):
+        self.path.write_text('{"type": "FeatureCollection", "features": [ ]}')
+        self.assertEqual([], read(self.path))
+        self.path.write_text(' {} ')
+        self.assertEqual([], read(self.path))
+
+    @parameterized.expand([
+        ('<html></html>',),
+        ('{"type": "FeatureCollection", "features": [{"type": "Feature"}',),
+        ('{"type": "FeatureCollection", "features": [{"type": "Feature"} {}]}',),
+        ('',),
+    ])
+    def test_invalid(self, content: str):
+        self.path.write_text(content)
+        with self.assertRaises(ValueError):
+            list(iter_features(self.path, chunk_size=4))
+
+
+if __name__ == '__main__':
+    unittest.main()
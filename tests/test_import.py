@@ -0,0 +1,42 @@
+import subprocess
+import sys
+import unittest
+
+from parameterized import parameterized
+
+HEAVY_MODULES = ['fastkml', 'overpy', 'pycountry', 'requests', 'shapely']
+
+
+def imported_modules(statement: str) -> set[str]:
+    """Run the import statement in a fresh interpreter and return heavy modules it imported"""
+    result = subprocess.run(
+        [sys.executable, '-c', f'{statement}\nimport sys\nprint(" ".join(sys.modules))'],
+        check=True, capture_output=True, text=True)
+    return set(result.stdout.split()) & set(HEAVY_MODULES)
+
+
+class TestLazyImports(unittest.TestCase):
+
+    @parameterized.expand([
+        ('package', 'import squadrats2garmin', set()),
+        ('grid', 'from squadrats2garmin import squadrats_grid', {'shapely'}),
+        ('visited', 'from squadrats2garmin import visited_squadrats', {'fastkml', 'shapely'}),
+        ('poly', 'from squadrats2garmin import poly_download', {'overpy', 'pycountry', 'requests'}),
+    ])
+    def test_entry_point_imports(self, _, statement: str, expected: set[str]):
+        self.assertEqual(expected, imported_modules(statement))
+
+    def test_unknown_attribute(self):
+        import squadrats2garmin
+        with self.assertRaises(AttributeError):
+            _ = squadrats2garmin.unknown
+
+
+def test_import_time(benchmark):
+    result = benchmark.pedantic(subprocess.run, args=([sys.executable, '-c', 'import squadrats2garmin'],),
+                                kwargs={'check': True}, rounds=5)
+    assert result.returncode == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
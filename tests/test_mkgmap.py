@@ -0,0 +1,204 @@
+import os
+import re
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from squadrats2garmin.common.cache import FileCache
+from squadrats2garmin.common.job import Job
+from squadrats2garmin.common.mkgmap import RegionConfig, IMG_FAMILY_ID_SQUADRATS_GRID, MkgmapResources, \
+    build_garmin_imgs, run_mkgmap
+from squadrats2garmin.common.poly import ExtensionAwarePolyLoader
+from squadrats2garmin.common.region import Country, Subdivision
+from squadrats2garmin.common.tile import ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS
+
+
+def fake_mkgmap(config_path: Path, mkgmap_resources: MkgmapResources | None = None) -> None:
+    """Pretend to be mkgmap: create IMG files for all mapnames and gmapsupp.img if requested"""
+    config = config_path.read_text(encoding='UTF-8')
+    output_dir = Path(re.search(r'^output-dir=(.*)$', config, re.MULTILINE).group(1))
+    for mapname in re.findall(r'^mapname=(\d+)$', config, re.MULTILINE):
+        (output_dir / f'{mapname}.img').write_text(mapname)
+    if re.search(r'^gmapsupp$', config, re.MULTILINE):
+        (output_dir / 'gmapsupp.img').write_text(config)
+
+
+class TestRegionConfig(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region" / "index-1"
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+        self.malta = Country(iso_code='MT', poly_loader=ExtensionAwarePolyLoader(self.RESOURCE_DIR / 'MT-Malta.geojson'))
+        self.connaught = Subdivision(
+            country=Country(iso_code='IE'),
+            iso_code='IE-C',
+            poly_loader=ExtensionAwarePolyLoader(self.RESOURCE_DIR / 'IE-Éire' / 'IE-C-Connaught.poly'))
+
+    def _config(self, output_dir: Path, mkgmap_processes: int = 1, mapname_prefix: str = '97999') -> RegionConfig:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return RegionConfig(
+            output=self.tmp_dir / 'dist' / f'squadrats-{mapname_prefix}-{output_dir.name}.img',
+            config={
+                'description': 'Squadrats',
+                'mapname_prefix': mapname_prefix,
+                'img_family_id': IMG_FAMILY_ID_SQUADRATS_GRID,
+                'series_name': 'Squadrats grid',
+                'output_dir': output_dir,
+                'mkgmap_processes': mkgmap_processes,
+            },
+            regions_14=[self.malta],
+            regions_17=[self.connaught])
+
+    def _jobs(self, output_dir: Path) -> list[Job]:
+        jobs = [
+            Job(region=self.malta, zoom=ZOOM_SQUADRATS, osm_file=output_dir / 'MT-14.osm'),
+            Job(region=self.connaught, zoom=ZOOM_SQUADRATINHOS, osm_file=output_dir / 'IE-C-17.osm'),
+        ]
+        for job in jobs:
+            job.osm_file.write_text(str(job))
+        return jobs
+
+    def test_assign_mapnames(self):
+        config = self._config(self.tmp_dir / 'build')
+        jobs = self._jobs(self.tmp_dir / 'build')
+
+        self.assertEqual([('97999001', jobs[0]), ('97999002', jobs[1])], config.assign_mapnames(jobs))
+
+    def test_build_garmin_img_reuses_cached_tiles(self):
+        img_cache = FileCache(root=self.tmp_dir / 'cache', suffix='.img')
+
+        with mock.patch('squadrats2garmin.common.mkgmap.run_mkgmap', side_effect=fake_mkgmap) as run_mkgmap:
+            # first build compiles all the tiles and combines them
+            config = self._config(self.tmp_dir / 'build-1')
+            output = config.build_garmin_img(jobs=self._jobs(config.output_dir), img_cache=img_cache)
+            self.assertEqual(2, run_mkgmap.call_count)
+            self.assertIn('input-file=97999001.img', output.read_text())
+            self.assertIn('input-file=97999002.img', output.read_text())
+
+            # second build only combines the cached tiles
+            run_mkgmap.reset_mock()
+            config = self._config(self.tmp_dir / 'build-2')
+            config.build_garmin_img(jobs=self._jobs(config.output_dir), img_cache=img_cache)
+            self.assertEqual(1, run_mkgmap.call_count)
+            self.assertEqual('97999002', (config.output_dir / '97999002.img').read_text())
+
+            # changed OSM file recompiles only the affected tile
+            run_mkgmap.reset_mock()
+            config = self._config(self.tmp_dir / 'build-3')
+            jobs = self._jobs(config.output_dir)
+            jobs[0].osm_file.write_text('changed')
+            config.build_garmin_img(jobs=jobs, img_cache=img_cache)
+            self.assertEqual(2, run_mkgmap.call_count)
+            tiles_config = (config.output_dir / 'mkgmap-tiles-1.cfg').read_text()
+            self.assertIn('mapname=97999001', tiles_config)
+            self.assertNotIn('mapname=97999002', tiles_config)
+
+    def test_build_garmin_img_in_parallel(self):
+        with mock.patch('squadrats2garmin.common.mkgmap.run_mkgmap', side_effect=fake_mkgmap) as run_mkgmap:
+            config = self._config(self.tmp_dir / 'build', mkgmap_processes=4)
+            output = config.build_garmin_img(jobs=self._jobs(config.output_dir))
+
+            # two batches with a single tile each and the combine step
+            self.assertEqual(3, run_mkgmap.call_count)
+            self.assertEqual(
+                ['mapname=97999001', 'mapname=97999002'],
+                sorted(re.search(r'^mapname=\d+$', (config.output_dir / f'mkgmap-tiles-{n}.cfg').read_text(),
+                                 re.MULTILINE).group(0) for n in [1, 2]))
+            self.assertIn('input-file=97999001.img\ninput-file=97999002.img\n', output.read_text())
+
+    def test_build_garmin_imgs_in_batch(self):
+        with mock.patch('squadrats2garmin.common.mkgmap.run_mkgmap', side_effect=fake_mkgmap) as run_mkgmap:
+            configs = [self._config(self.tmp_dir / 'batch' / '001', mapname_prefix='97001'),
+                       self._config(self.tmp_dir / 'batch' / '002', mapname_prefix='97002')]
+            outputs = build_garmin_imgs(builds=[(config, self._jobs(config.output_dir)) for config in configs],
+                                        work_dir=self.tmp_dir / 'batch')
+
+            # single compile step and a combine step per config
+            self.assertEqual(3, run_mkgmap.call_count)
+            tiles_config = (self.tmp_dir / 'batch' / 'mkgmap-tiles-1.cfg').read_text()
+            self.assertEqual(2, tiles_config.count('family-id='))
+            self.assertIn('input-file=001/MT-14.osm', tiles_config)
+            self.assertIn('input-file=002/IE-C-17.osm', tiles_config)
+
+            self.assertEqual([config.output for config in configs], outputs)
+            self.assertEqual('97002001', (configs[1].output_dir / '97002001.img').read_text())
+            self.assertIn('input-file=97002001.img', outputs[1].read_text())
+
+    def test_build_garmin_imgs_in_batch_with_same_mapnames(self):
+        with mock.patch('squadrats2garmin.common.mkgmap.run_mkgmap', side_effect=fake_mkgmap) as run_mkgmap:
+            configs = [self._config(self.tmp_dir / 'batch' / '001'), self._config(self.tmp_dir / 'batch' / '002')]
+            build_garmin_imgs(builds=[(config, self._jobs(config.output_dir)) for config in configs],
+                              work_dir=self.tmp_dir / 'batch')
+
+            # configs sharing mapnames are compiled one after another
+            self.assertEqual(4, run_mkgmap.call_count)
+            for config in configs:
+                self.assertTrue((config.output_dir / '97999001.img').exists())
+
+
+class TestMkgmapResources(unittest.TestCase):
+
+    @mock.patch('os.cpu_count', return_value=8)
+    @mock.patch('squadrats2garmin.common.mkgmap._physical_memory', return_value=16 * 1024 ** 3)
+    def test_tune(self, *_):
+        # small input gets the minimum heap, threads are limited by the number of tiles
+        resources = MkgmapResources.tune(input_size=1024 ** 2, tiles=2)
+        self.assertEqual(512, resources.heap_mb)
+        self.assertEqual(2, resources.max_jobs)
+
+        # heap grows with the input, threads are limited by the number of cores
+        resources = MkgmapResources.tune(input_size=1024 ** 3, tiles=100)
+        self.assertEqual(256 + 3 * 1024, resources.heap_mb)
+        self.assertEqual(8, resources.max_jobs)
+
+        # concurrent processes share the memory and the cores
+        resources = MkgmapResources.tune(input_size=10 * 1024 ** 3, tiles=100, processes=4)
+        self.assertEqual(3 * 1024, resources.heap_mb)
+        self.assertEqual(2, resources.max_jobs)
+
+        # overrides
+        resources = MkgmapResources.tune(input_size=10 * 1024 ** 3, tiles=100, heap_mb=2048, max_jobs=3)
+        self.assertEqual(2048, resources.heap_mb)
+        self.assertEqual(3, resources.max_jobs)
+
+
+class TestRunMkgmap(unittest.TestCase):
+    # stand-in for mkgmap allocating as many MB as given in the config file, failing when it's negative
+    MKGMAP = f"""#!{sys.executable}
+import sys
+size = int(open(sys.argv[-1].removeprefix('--read-config=')).read())
+if size < 0:
+    sys.exit('mkgmap error')
+data = b'x' * size * 1024 ** 2
+"""
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        mkgmap = self.tmp_dir / 'mkgmap'
+        mkgmap.write_text(self.MKGMAP)
+        mkgmap.chmod(0o755)
+        self.enterContext(mock.patch.dict(os.environ, {'PATH': f'{self.tmp_dir}{os.pathsep}{os.environ["PATH"]}'}))
+
+    def run_mkgmap(self, size: int) -> int:
+        """Peak memory in MB logged for the run"""
+        config_path = self.tmp_dir / 'mkgmap.cfg'
+        config_path.write_text(str(size))
+        with self.assertLogs('squadrats2garmin.common.mkgmap', level='INFO') as logs:
+            run_mkgmap(config_path=config_path)
+        return int(re.search(r'Peak memory usage of mkgmap: (\d+) MB', logs.output[-1]).group(1))
+
+    def test_peak_memory(self):
+        self.assertGreaterEqual(self.run_mkgmap(size=256), 256)
+        # the peak of the previous process is not reported again
+        self.assertLess(self.run_mkgmap(size=0), 256)
+
+    def test_failure(self):
+        with self.assertRaisesRegex(RuntimeError, 'mkgmap error'):
+            self.run_mkgmap(size=-1)
+
+
+if __name__ == '__main__':
+    unittest.main()
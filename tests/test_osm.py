@@ -1,6 +1,9 @@
+import tempfile
 import unittest
+import xml.etree.ElementTree as ET
+from pathlib import Path
 
-from squadrats2garmin.common.osm import Node
+from squadrats2garmin.common.osm import Node, OSMWriter, multipolygon_to_xml, node_to_xml, way_to_xml
 
 class TestNode(unittest.TestCase):
     def test_node_to_xml(self):
@@ -22,5 +25,28 @@ class TestNode(unittest.TestCase):
         self.assertEqual(elem[1].tag, 'tag')
         self.assertDictEqual(elem[1].attrib, {'k': 'k2', 'v': 'v2'})
 
+
+class TestOSMWriter(unittest.TestCase):
+    def test_write(self):
+        """Test that the written elements are the same as the built ones"""
+        expected = ET.Element('osm', {'version': '0.6'})
+        expected.extend([
+            node_to_xml(element_id=1, geom=(18.5, 54.25)),
+            node_to_xml(element_id=2, geom=(-0.125, 1e-07)),
+            way_to_xml(element_id=3, refs=[1, 2, 1]),
+            multipolygon_to_xml(element_id=4, outer_rings=[3], inner_rings=[], tags={'name': '"squadrats" & <co>'}),
+        ])
+
+        with tempfile.TemporaryDirectory() as tmp_dir_name:
+            path = Path(tmp_dir_name) / 'test.osm'
+            with OSMWriter(path) as writer:
+                writer.write_node(element_id=1, geom=(18.5, 54.25))
+                writer.write_node(element_id=2, geom=(-0.125, 1e-07))
+                writer.write_way(element_id=3, refs=[1, 2, 1])
+                writer.write_multipolygon(element_id=4, outer_rings=[3], tags={'name': '"squadrats" & <co>'})
+
+            self.assertEqual(ET.tostring(expected), ET.tostring(ET.parse(path).getroot()))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,11 +1,16 @@
 import logging
+import shutil
+import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
 
 import shapely
 from pytest_benchmark.plugin import benchmark
 
-from squadrats2garmin.common.poly import parse_poly_file
+from squadrats2garmin.common.cache import FileCache
+from squadrats2garmin.common.poly import CachedPolyLoader, POLYPolyLoader, PolyFileFormatException, \
+    PolyFileIncorrectFiletypeException, parse_poly_file
 
 
 class TestPoly(unittest.TestCase):
@@ -45,6 +50,36 @@ class TestPoly(unittest.TestCase):
         poly = parse_poly_file(self.RESOURCE_DIR / 'PL-22-Pomorskie.geojson')
         self.assertEqual((16.68, 53.48, 19.66, 54.86), poly.bounds)
 
+    def test_poly_with_holes(self):
+        """
+        Test that POLY sections starting with ! are holes of the preceding polygon
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir_name:
+            path = Path(tmp_dir_name) / 'XX-holes.poly'
+            path.write_text('polygon\n'
+                            'first\n   0.0E+00  0\n 10 0\n\t10\t10\n 0 10\n 0 0\nEND\n'
+                            '!hole\n 2 2\n 4 2\n 4 4\n 2 2\nEND\n'
+                            'second\n 20 20\n 30 20\n 30 30\n 20 20\nEND\n'
+                            'END\n')
+            poly = parse_poly_file(path)
+
+        self.assertEqual(2, len(poly.geoms))
+        self.assertEqual([1, 0], [len(geom.interiors) for geom in poly.geoms])
+        self.assertEqual(100 - 2, poly.geoms[0].area)
+        self.assertTrue(poly.geoms[0].exterior.is_ccw)
+        self.assertFalse(poly.geoms[0].interiors[0].is_ccw)
+
+    def test_wrong_format(self):
+        with self.assertRaises(PolyFileIncorrectFiletypeException):
+            parse_poly_file(self.RESOURCE_DIR / 'wrong_format.poly')
+
+    def test_invalid_coordinates(self):
+        with tempfile.TemporaryDirectory() as tmp_dir_name:
+            path = Path(tmp_dir_name) / 'XX-invalid.poly'
+            path.write_text('polygon\n1\n 0 0\n 1 x\nEND\nEND\n')
+            with self.assertRaises(PolyFileFormatException):
+                parse_poly_file(path)
+
     def test_squadrats_rings_are_closed(self):
         json_file = TestPoly.RESOURCE_DIR / "P2NkzJ2UfnOGnq7DNaA1Y1JZYkl1.json"
         squadrats_trophies: shapely.GeometryCollection = shapely.from_geojson(json_file.read_bytes())
@@ -62,6 +97,39 @@ class TestPoly(unittest.TestCase):
                     self.assertTrue(ring.is_closed)
 
 
+class TestCachedPolyLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.cache = FileCache(root=self.tmp_dir / 'cache', suffix='.bin')
+        self.path = self.tmp_dir / 'ES-CN-Canarias.poly'
+        shutil.copyfile(TestPoly.RESOURCE_DIR / 'ES-CN-Canarias.poly', self.path)
+
+    def test_cached_polygon(self):
+        expected = parse_poly_file(self.path)
+        loader = CachedPolyLoader(delegate=POLYPolyLoader(self.path), cache=self.cache)
+        self.assertEqual(expected.wkb, loader.load().wkb)
+
+        # second load reads the binary entry instead of the source
+        with mock.patch.object(POLYPolyLoader, 'load', side_effect=AssertionError('source parsed')):
+            self.assertEqual(expected.wkb, loader.load().wkb)
+
+    def test_changed_source(self):
+        loader = CachedPolyLoader(delegate=POLYPolyLoader(self.path), cache=self.cache)
+        self.assertEqual(9, len(loader.load().geoms))
+
+        self.path.write_text('polygon\n1\n 0 0\n 1 0\n 1 1\n 0 0\nEND\nEND\n')
+        self.assertEqual(1, len(loader.load().geoms))
+
+    def test_corrupted_entry(self):
+        loader = CachedPolyLoader(delegate=POLYPolyLoader(self.path), cache=self.cache)
+        expected = loader.load()
+
+        [entry] = self.cache.root.rglob('*.bin')
+        entry.write_bytes(entry.read_bytes()[:100])
+        self.assertEqual(expected.wkb, loader.load().wkb)
+
+
 def test_parse_poly(benchmark):
     def parse():
         poly = parse_poly_file(TestPoly.RESOURCE_DIR / 'PL-Poland-67097-points.poly')
@@ -80,6 +148,20 @@ def test_parse_json(benchmark):
     assert result == 67097
 
 
+def test_load_cached_poly(benchmark):
+    with tempfile.TemporaryDirectory() as tmp_dir_name:
+        loader = CachedPolyLoader(delegate=POLYPolyLoader(TestPoly.RESOURCE_DIR / 'PL-Poland-67097-points.poly'),
+                                  cache=FileCache(root=Path(tmp_dir_name), suffix='.bin'))
+        loader.load()
+
+        def load():
+            return len(loader.load().geoms[0].exterior.coords)
+
+        result = benchmark(load)
+
+    assert result == 67097
+
+
 def test_parse_trophies_shapely(benchmark):
     def parse():
         json_file = TestPoly.RESOURCE_DIR / "P2NkzJ2UfnOGnq7DNaA1Y1JZYkl1.json"
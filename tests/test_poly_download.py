@@ -0,0 +1,261 @@
+import json
+import re
+import tempfile
+import threading
+import time
+import unittest
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from parameterized import parameterized
+
+from squadrats2garmin.poly_download import (DownloadManifest, OsmIdResolver, PolyDownloader, PolygonValidator,
+                                            download_polys)
+
+# ISO3166-2 relations known to the stand-in Overpass endpoint
+RELATIONS = {
+    130971: 'PL-02',
+    130957: 'PL-04',
+    130919: 'PL-06',
+    224458: 'PL-08',
+}
+# country whose queries the stand-in Overpass endpoint always fails
+UNAVAILABLE = 'DE'
+# bodies served by the stand-in polygons endpoint with 200 OK for the ids of broken relations
+BROKEN = {
+    2: b'<html><body>Internal error</body></html>',
+    3: b'{"type": "Polygon", "coordinates": [[[0, 0], [1, 0]',
+}
+GEOJSON = json.dumps({'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}).encode()
+POLY = b'polygon\n1\n  0.0  0.0\n  1.0  0.0\n  1.0  1.0\n  0.0  0.0\nEND\nEND\n'
+
+
+class OverpassStandIn(BaseHTTPRequestHandler):
+    """Answer Overpass queries for the ISO3166-2 relations in JSON"""
+    queries: list[str]
+
+    def do_POST(self):
+        query = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        self.queries.append(query)
+
+        if UNAVAILABLE in query:
+            self.send_error(HTTPStatus.GATEWAY_TIMEOUT)
+            return
+        if match := re.search(r'"ISO3166-2"~"\^(\w+)-"', query):
+            codes = {osm_id: code for osm_id, code in RELATIONS.items() if code.startswith(f'{match.group(1)}-')}
+        elif match := re.search(r'"ISO3166-2"="([\w-]+)"', query):
+            codes = {osm_id: code for osm_id, code in RELATIONS.items() if code == match.group(1)}
+        else:
+            self.send_error(HTTPStatus.BAD_REQUEST)
+            return
+
+        body = json.dumps({'version': 0.6, 'elements': [
+            {'type': 'relation', 'id': osm_id, 'members': [], 'tags': {'ISO3166-2': code, 'boundary': 'administrative'}}
+            for osm_id, code in codes.items()
+        ]}).encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestOsmIdResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = []
+        handler = type('BoundOverpassStandIn', (OverpassStandIn,), {'queries': self.queries})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.resolver = OsmIdResolver(url=f'http://127.0.0.1:{self.server.server_address[1]}/api/interpreter')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_id(self):
+        self.assertEqual(130971, self.resolver.get_id('PL-02'))
+        self.assertFalse(self.resolver.get_id('PL-99'))
+
+    def test_get_ids_one_query_per_country(self):
+        codes = ['PL-02', 'PL-04', 'PL-06', 'PL-08']
+        self.assertEqual({'PL-02': 130971, 'PL-04': 130957, 'PL-06': 130919, 'PL-08': 224458},
+                         self.resolver.get_ids(codes))
+        self.assertEqual(1, len(self.queries))
+
+    def test_get_ids_fallback(self):
+        # the missing code is looked up on its own
+        self.assertEqual({'PL-02': 130971}, self.resolver.get_ids(['PL-02', 'PL-99']))
+        self.assertEqual(2, len(self.queries))
+        self.assertIn('"ISO3166-2"="PL-99"', self.queries[1])
+
+    @mock.patch('time.sleep')
+    def test_get_ids_failed_country(self, sleep: mock.Mock):
+        # codes of the country whose query failed are not looked up on their own
+        self.assertEqual({'PL-02': 130971}, self.resolver.get_ids(['DE-BY', 'DE-BE', 'PL-02'], retry_count=3))
+        self.assertEqual(4, len(self.queries))
+        self.assertEqual(2, sleep.call_count)
+
+
+class TestPolygonValidator(unittest.TestCase):
+
+    @staticmethod
+    def validate(poly_format: str, content: bytes, chunk_size: int) -> None:
+        validator = PolygonValidator(poly_format=poly_format)
+        for start in range(0, len(content), chunk_size):
+            validator.feed(content[start:start + chunk_size])
+        validator.close()
+
+    @parameterized.expand([(1,), (5,), (1024,)])
+    def test_valid(self, chunk_size: int):
+        self.validate('json', b'\n ' + GEOJSON, chunk_size=chunk_size)
+        self.validate('json', b'{"coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]]], "type": "MultiPolygon"}',
+                      chunk_size=chunk_size)
+        self.validate('poly', POLY, chunk_size=chunk_size)
+
+    @parameterized.expand([
+        ('json', BROKEN[2]),
+        ('json', BROKEN[3]),
+        ('json', b'{"type": "Point", "coordinates": [0, 0]}'),
+        ('json', b'{}'),
+        ('json', b''),
+        ('poly', BROKEN[2]),
+        ('poly', POLY[:-8]),
+        ('poly', GEOJSON),
+        ('poly', b''),
+    ])
+    def test_invalid(self, poly_format: str, content: bytes):
+        for chunk_size in [1, 5, 1024]:
+            with self.assertRaises(ValueError):
+                self.validate(poly_format, content, chunk_size=chunk_size)
+
+
+class PolygonsStandIn(BaseHTTPRequestHandler):
+    """Serve GeoJSON and POLY polygons of the known relations, keep track of the concurrent requests"""
+    in_flight: list[int]
+    lock: threading.Lock
+
+    def do_GET(self):
+        with self.lock:
+            self.in_flight[0] += 1
+            self.in_flight[1] = max(self.in_flight[1], self.in_flight[0])
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight[0] -= 1
+
+        url = urlparse(self.path)
+        relation_id = int(parse_qs(url.query)['id'][0])
+        if relation_id in BROKEN:
+            self.send_response(HTTPStatus.OK)
+            self.end_headers()
+            self.wfile.write(BROKEN[relation_id])
+            return
+        if relation_id not in RELATIONS:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        etag = f'"{relation_id}-v1"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.end_headers()
+            return
+        body = POLY if url.path == '/get_poly.py' else GEOJSON
+        self.send_response(HTTPStatus.OK)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadPolys(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        # current and maximum number of requests in flight
+        self.in_flight = [0, 0]
+        handler = type('BoundPolygonsStandIn', (PolygonsStandIn,), {'in_flight': self.in_flight,
+                                                                     'lock': threading.Lock()})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.name_resolver = mock.Mock(resolve=lambda code: self.tmp_dir / f'{code}.geojson')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_download_polys(self):
+        downloader = PolyDownloader(base_url=f'http://127.0.0.1:{self.server.server_address[1]}', workers=4,
+                                    max_per_host=2)
+        osm_ids = {code: osm_id for osm_id, code in RELATIONS.items()} | {'PL-99': 1}
+
+        with self.assertLogs('squadrats2garmin.poly_download', level='ERROR') as logs:
+            changed, failed = download_polys(downloader=downloader, name_resolver=self.name_resolver,
+                                             osm_ids=osm_ids, workers=4)
+
+        self.assertEqual(['PL-02', 'PL-04', 'PL-06', 'PL-08'], sorted(changed))
+        self.assertEqual(['PL-99'], failed)
+        self.assertIn('404', logs.output[0])
+        self.assertEqual(['PL-02.geojson', 'PL-04.geojson', 'PL-06.geojson', 'PL-08.geojson'],
+                         sorted(path.name for path in self.tmp_dir.iterdir()))
+        # workers share the host, which allows only 2 requests at a time
+        self.assertEqual(2, self.in_flight[1])
+
+    def test_incremental_refresh(self):
+        downloader = PolyDownloader(base_url=f'http://127.0.0.1:{self.server.server_address[1]}')
+        osm_ids = {'PL-02': 130971, 'PL-04': 130957}
+        manifest_path = self.tmp_dir / 'manifest' / 'poly-download.json'
+
+        def refresh(manifest_path: Path) -> list[str]:
+            changed, _ = download_polys(downloader=downloader, name_resolver=self.name_resolver, osm_ids=osm_ids,
+                                        workers=1, manifest=DownloadManifest(manifest_path))
+            return sorted(changed)
+
+        self.assertEqual(['PL-02', 'PL-04'], refresh(manifest_path))
+        self.assertEqual('"130971-v1"', DownloadManifest(manifest_path).get(self.tmp_dir / 'PL-02.geojson').etag)
+        mtimes = {path: path.stat().st_mtime_ns for path in self.tmp_dir.glob('*.geojson')}
+
+        # not modified upstream
+        self.assertEqual([], refresh(manifest_path))
+        # without the validators the content is compared, identical files are not rewritten
+        self.assertEqual([], refresh(self.tmp_dir / 'other-manifest.json'))
+        self.assertEqual(mtimes, {path: path.stat().st_mtime_ns for path in self.tmp_dir.glob('*.geojson')})
+
+        # locally modified file is downloaded again in full
+        (self.tmp_dir / 'PL-04.geojson').write_text('{}')
+        self.assertEqual(['PL-04'], refresh(manifest_path))
+
+    def test_invalid_response(self):
+        downloader = PolyDownloader(base_url=f'http://127.0.0.1:{self.server.server_address[1]}')
+        for code in BROKEN:
+            (self.tmp_dir / f'{code}.geojson').write_bytes(GEOJSON)
+
+        with self.assertLogs('squadrats2garmin.poly_download', level='ERROR') as logs:
+            changed, failed = download_polys(downloader=downloader, name_resolver=self.name_resolver,
+                                             osm_ids={code: code for code in BROKEN}, workers=1)
+
+        self.assertEqual(([], [2, 3]), (changed, failed))
+        self.assertIn('not a GeoJSON object', logs.output[0])
+        self.assertIn('truncated', logs.output[1])
+        # files in place are kept, no temporary files are left behind
+        self.assertEqual(['2.geojson', '3.geojson'], sorted(path.name for path in self.tmp_dir.iterdir()))
+        for code in BROKEN:
+            self.assertEqual(GEOJSON, (self.tmp_dir / f'{code}.geojson').read_bytes())
+
+    def test_download_poly(self):
+        downloader = PolyDownloader(base_url=f'http://127.0.0.1:{self.server.server_address[1]}', poly_format='poly')
+        result = downloader.download(relation_id=130971, output_path=self.tmp_dir / 'polygons' / 'PL-02.poly')
+
+        self.assertTrue(result.changed)
+        self.assertEqual(POLY, (self.tmp_dir / 'polygons' / 'PL-02.poly').read_bytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
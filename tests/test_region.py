@@ -1,11 +1,15 @@
 import logging
+import shutil
+import tempfile
 import unittest
 from pathlib import Path
 from typing import cast
+from unittest import mock
 
 import shapely
 
-from squadrats2garmin.common.region import RegionIndex
+from squadrats2garmin.common.poly import ExtensionAwarePolyLoader, PolyFileFormatException
+from squadrats2garmin.common.region import Area, Country, CoordsPrefetcher, GeometryCache, RegionIndex, Route
 
 
 class MyTestCase(unittest.TestCase):
@@ -71,5 +75,271 @@ class MyTestCase(unittest.TestCase):
                             self.assertFalse(interior.is_ccw, msg=f"{region.code}: interior of all Polygons should be clockwise")
 
 
+class TestRegionIndexManifest(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region"
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.polygons_dir = self.tmp_dir / 'polygons'
+        shutil.copytree(self.RESOURCE_DIR / "index-1", self.polygons_dir)
+        self.manifest_path = self.tmp_dir / 'cache' / 'region-index.json'
+
+    def test_manifest(self):
+        region_index = RegionIndex(root_path=self.polygons_dir, manifest_path=self.manifest_path)
+        self.assertTrue(self.manifest_path.exists())
+
+        [malta] = [entry for entry in region_index.entries if entry.code == 'MT']
+        self.assertEqual('Malta', malta.country_name)
+        self.assertEqual((13.92, 35.56, 14.84, 36.3), malta.bbox)
+        self.assertLess(0, malta.vertices)
+        self.assertLess(0, malta.area)
+
+        # unchanged files are neither parsed nor looked up in the ISO database
+        connaught = self.polygons_dir / 'IE-Éire' / 'IE-C-Connaught.poly'
+        connaught.write_text(connaught.read_text() + '\n')
+        with mock.patch('squadrats2garmin.common.region.ExtensionAwarePolyLoader.load',
+                        side_effect=ExtensionAwarePolyLoader.load, autospec=True) as load:
+            region_index = RegionIndex(root_path=self.polygons_dir, manifest_path=self.manifest_path)
+            self.assertEqual([connaught], [call.args[0].path for call in load.call_args_list])
+
+        self.assertEqual(5, len(region_index.entries))
+        self.assertEqual('Ireland - Connaught', region_index.select_regions(['IE-C'])[0].name)
+
+    def test_broken_polygon(self):
+        broken = self.polygons_dir / 'DE-Deutschland.poly'
+        broken.write_text('polygon\n1\n  abc def\nEND\nEND\n')
+
+        with self.assertLogs('squadrats2garmin.common.region', level='ERROR'):
+            region_index = RegionIndex(root_path=self.polygons_dir, manifest_path=self.manifest_path)
+        self.assertEqual('MT', region_index.select_regions(['MT'])[0].code)
+        # the error surfaces when the region is used
+        [germany] = region_index.select_regions(['DE'])
+        with self.assertRaises(PolyFileFormatException):
+            _ = germany.coords
+
+    def test_regions_are_created_on_demand(self):
+        region_index = RegionIndex(root_path=self.polygons_dir, manifest_path=self.manifest_path)
+
+        with mock.patch('squadrats2garmin.common.region.Country', wraps=Country) as country:
+            region_index.select_regions(['MT'])
+            region_index.select_regions(['MT'])
+            self.assertEqual(['MT'], [call.kwargs['iso_code'] for call in country.call_args_list])
+
+
+class TestGeometryCache(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region"
+
+    def test_lru_eviction(self):
+        cache = GeometryCache(max_vertices=10)
+        polygons = {key: shapely.MultiPolygon([shapely.box(i, i, i + 1, i + 1)]) for i, key in enumerate('abc')}
+        load = {key: mock.Mock(return_value=poly) for key, poly in polygons.items()}
+
+        cache.get(key=Path('a'), load=load['a'])
+        cache.get(key=Path('b'), load=load['b'])
+        # touch a, so b becomes the least recently used
+        self.assertIs(polygons['a'], cache.get(key=Path('a'), load=load['a']))
+        cache.get(key=Path('c'), load=load['c'])
+
+        self.assertEqual((1, 3, 1), (cache.hits, cache.misses, cache.evictions))
+        self.assertEqual(10, cache.vertices)
+
+        # evicted coordinates are loaded again
+        cache.get(key=Path('b'), load=load['b'])
+        self.assertEqual(2, load['b'].call_count)
+        self.assertEqual(1, load['a'].call_count)
+
+    def test_oversized_geometry_is_kept(self):
+        cache = GeometryCache(max_vertices=1)
+        load = mock.Mock(return_value=shapely.MultiPolygon([shapely.box(0, 0, 1, 1)]))
+
+        cache.get(key=Path('a'), load=load)
+        cache.get(key=Path('a'), load=load)
+        load.assert_called_once()
+
+    def test_regions_share_cache(self):
+        cache = GeometryCache()
+        index_1 = RegionIndex(root_path=self.RESOURCE_DIR / "index-1", geometry_cache=cache)
+        index_2 = RegionIndex(root_path=self.RESOURCE_DIR / "index-1", geometry_cache=cache)
+
+        [malta_1] = index_1.select_regions(['MT'])
+        [malta_2] = index_2.select_regions(['MT'])
+        self.assertIs(malta_1.coords, malta_2.coords)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+        malta_1.invalidate()
+        self.assertEqual(0, cache.vertices)
+        self.assertTrue(malta_1.coords.equals(malta_2.coords))
+        self.assertEqual(2, cache.misses)
+
+
+class TestRegionSpatialIndex(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region"
+
+    def test_query(self):
+        region_index = RegionIndex(root_path=self.RESOURCE_DIR / "index-1", geometry_cache=GeometryCache())
+
+        # Dublin, track from Galway to Dublin, bounding box around Malta, Null Island
+        self.assertEqual(['IE-L'], [r.code for r in region_index.query(shapely.Point(-6.26, 53.35))])
+        self.assertEqual(['IE-C', 'IE-L'],
+                         [r.code for r in region_index.query(shapely.LineString([(-9.05, 53.27), (-6.26, 53.35)]))])
+        self.assertEqual(['MT'], [r.code for r in region_index.query(shapely.box(14, 35.5, 15, 36.5))])
+        self.assertEqual([], region_index.query(shapely.Point(0, 0)))
+
+        with self.assertRaises(ValueError):
+            region_index.query(shapely.Point(0, 0), level='province')
+
+    def test_only_candidates_are_loaded(self):
+        with tempfile.TemporaryDirectory() as tmp_dir_name:
+            manifest_path = Path(tmp_dir_name) / 'region-index.json'
+            RegionIndex(root_path=self.RESOURCE_DIR / "index-1", manifest_path=manifest_path)
+
+            # bounding boxes come from the manifest, only the polygon of Malta is loaded
+            cache = GeometryCache()
+            region_index = RegionIndex(root_path=self.RESOURCE_DIR / "index-1", geometry_cache=cache,
+                                       manifest_path=manifest_path)
+            self.assertEqual(['MT'], [r.code for r in region_index.query(shapely.Point(14.5, 35.9))])
+            self.assertEqual(1, cache.misses)
+
+    def test_invalidate(self):
+        with tempfile.TemporaryDirectory() as tmp_dir_name:
+            root_path = Path(tmp_dir_name) / 'polygons'
+            shutil.copytree(self.RESOURCE_DIR / "index-1", root_path)
+            manifest_path = Path(tmp_dir_name) / 'region-index.json'
+            region_index = RegionIndex(root_path=root_path, geometry_cache=GeometryCache(),
+                                       manifest_path=manifest_path)
+            self.assertEqual([], region_index.query(shapely.Point(10.5, 45.5)))
+
+            # Malta moved to northern Italy
+            malta = root_path / 'MT-Malta.geojson'
+            malta.write_text(shapely.to_geojson(shapely.box(10, 45, 11, 46)))
+            region_index.invalidate([malta])
+
+            self.assertEqual(['MT'], [r.code for r in region_index.query(shapely.Point(10.5, 45.5))])
+            self.assertEqual([], region_index.query(shapely.Point(14.5, 35.9)))
+            # the manifest follows the polygon too
+            fresh_index = RegionIndex(root_path=root_path, geometry_cache=GeometryCache(),
+                                      manifest_path=manifest_path)
+            self.assertEqual(region_index.entries, fresh_index.entries)
+
+    def test_select_regions(self):
+        region_index = RegionIndex(root_path=self.RESOURCE_DIR / "index-1", geometry_cache=GeometryCache())
+
+        regions = region_index.select_regions([
+            {'intersects': [-10, 51, -5, 52.5]},
+            {'intersects': {'type': 'Point', 'coordinates': [14.5, 35.9]}, 'level': 'country'},
+            'IE-U',
+        ])
+        self.assertEqual(['IE-L', 'IE-M', 'MT', 'IE-U'], [r.code for r in regions])
+
+        for invalid in [{'intersects': [1, 2, 3]}, {'intersects': {'type': 'Circle'}}, {}]:
+            with self.assertRaises(ValueError):
+                region_index.select_regions([invalid])
+
+    def test_select_route(self):
+        region_index = RegionIndex(root_path=self.RESOURCE_DIR / "index-1", geometry_cache=GeometryCache())
+        track = Path(__file__).parent / 'test_track' / 'gdansk.gpx'
+
+        [route] = region_index.select_regions([{'route': str(track), 'buffer': 100, 'method': 'buffer'}])
+        self.assertIsInstance(route, Route)
+        self.assertRegex(route.code, r'^route-gdansk-[0-9a-f]{8}$')
+        self.assertEqual((track, (100.0, 'buffer')), (route.poly_path, route.grid_parameters))
+        self.assertTrue(route.coords.contains(route.track))
+
+        # routes of the same name in different directories
+        with tempfile.TemporaryDirectory() as tmp_dir_name:
+            tracks = [Path(tmp_dir_name) / tour / 'route.gpx' for tour in ['a', 'b']]
+            for path in tracks:
+                path.parent.mkdir()
+                shutil.copyfile(track, path)
+            routes = region_index.select_regions([{'route': str(path)} for path in tracks])
+            self.assertEqual(2, len({route.code for route in routes}))
+
+        for invalid in [{'route': str(track), 'buffer': 0}, {'route': str(track), 'method': 'fly'},
+                        {'route': str(track.with_name('missing.gpx'))}]:
+            with self.assertRaises(ValueError):
+                region_index.select_regions([invalid])
+
+
+class TestArea(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region"
+
+    def setUp(self):
+        self.region_index = RegionIndex(root_path=self.RESOURCE_DIR / "index-1", geometry_cache=GeometryCache())
+
+    def test_bbox(self):
+        [area] = self.region_index.select_regions([{'bbox': [14.4, 35.8, 14.6, 36.0]}])
+        self.assertIsInstance(area, Area)
+        self.assertTrue(area.coords.equals(shapely.box(14.4, 35.8, 14.6, 36.0)))
+        self.assertIsNone(area.poly_path)
+        self.assertEqual('', area.get_country_code())
+
+        # unnamed areas are named after their definition
+        [same] = self.region_index.select_regions([{'bbox': [14.4, 35.8, 14.6, 36.0]}])
+        self.assertEqual(area.code, same.code)
+        self.assertEqual(area.grid_parameters, same.grid_parameters)
+
+    def test_polygon(self):
+        polygon_file = Path(__file__).parent / 'test_poly' / 'PL-22-Pomorskie.poly'
+        inline, external = self.region_index.select_regions([
+            {'polygon': {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}, 'name': 'triangle'},
+            {'polygon': str(polygon_file), 'name': 'pomorskie'},
+        ])
+        self.assertEqual(('triangle', 0.5), (inline.code, inline.coords.area))
+        self.assertEqual(polygon_file, external.poly_path)
+        self.assertTrue(external.coords.geoms[0].exterior.is_ccw)
+
+    def test_within(self):
+        areas = self.region_index.select_regions([{'bbox': [-7, 53, -6, 54], 'within': 'IE-*', 'name': 'dublin'}])
+
+        # subdivisions touching or not overlapping the area are skipped
+        self.assertEqual(['IE-L-dublin', 'IE-U-dublin'], [area.code for area in areas])
+        self.assertEqual('Ireland - Leinster - dublin', areas[0].name)
+        self.assertEqual('IE', areas[0].get_country_code())
+        self.assertEqual(areas[0].within.poly_path, areas[0].poly_path)
+        leinster = self.region_index.select_regions(['IE-L'])[0].coords
+        self.assertTrue(areas[0].coords.equals(shapely.intersection(leinster, shapely.box(-7, 53, -6, 54))))
+
+    def test_invalid(self):
+        for invalid in [{'bbox': [15, 36, 14, 35]}, {'bbox': [14, 35]},
+                        {'polygon': {'type': 'Point', 'coordinates': [14.5, 35.9]}},
+                        {'polygon': 'missing.poly'},
+                        {'bbox': [0, 0, 1, 1], 'within': 'MT'},
+                        {'bbox': [0, 0, 1, 1], 'name': '../../../../tmp/escaped'},
+                        {'bbox': [0, 0, 1, 1], 'name': '.hidden'},
+                        {'bbox': [0, 0, 1, 1], 'name': ['list']}]:
+            with self.subTest(entry=invalid):
+                with self.assertRaises(ValueError):
+                    self.region_index.select_regions([invalid])
+
+        # names are unique, also among the codes of the other regions
+        for duplicate in [[{'bbox': [0, 0, 1, 1], 'name': 'home'}, {'bbox': [1, 1, 2, 2], 'name': 'home'}],
+                          ['MT', {'bbox': [14.4, 35.8, 14.6, 36.0], 'name': 'MT'}]]:
+            with self.subTest(regions=duplicate):
+                with self.assertRaises(ValueError):
+                    self.region_index.select_regions(duplicate)
+
+
+class TestCoordsPrefetcher(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region"
+
+    def test_prefetch(self):
+        regions = RegionIndex(root_path=self.RESOURCE_DIR / "index-1").select_regions(['IE-*', 'MT'])
+
+        with CoordsPrefetcher(regions=regions, lookahead=2) as prefetcher:
+            coords = list(prefetcher)
+
+        self.assertEqual([region.coords for region in regions], coords)
+        self.assertEqual(len(regions), prefetcher.hits + prefetcher.misses)
+
+    def test_lookahead(self):
+        regions = [mock.Mock(code=str(i)) for i in range(5)]
+
+        with CoordsPrefetcher(regions=regions, lookahead=1) as prefetcher:
+            iterator = iter(prefetcher)
+            self.assertIs(regions[0].coords, next(iterator))
+            # only the next region is loaded ahead
+            self.assertEqual([1], list(prefetcher._futures))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,115 @@
+import io
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+import zipfile
+from pathlib import Path
+from unittest import mock
+
+from squadrats2garmin.common.region import RegionIndex
+from squadrats2garmin.serve import ArtifactCache, GridService, create_server
+from tests.test_mkgmap import fake_mkgmap
+
+
+class TestArtifactCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = ArtifactCache(max_size=20)
+        cache.get_or_build(key='a', build=lambda: b'a' * 10)
+        cache.get_or_build(key='b', build=lambda: b'b' * 10)
+        # touch a, so b becomes the least recently used
+        cache.get_or_build(key='a', build=lambda: self.fail('a should be cached'))
+        cache.get_or_build(key='c', build=lambda: b'c' * 10)
+
+        build = mock.Mock(return_value=b'B')
+        self.assertEqual(b'a' * 10, cache.get_or_build(key='a', build=build))
+        self.assertEqual(b'B', cache.get_or_build(key='b', build=build))
+        build.assert_called_once()
+
+    def test_concurrent_builds_are_coalesced(self):
+        cache = ArtifactCache(max_size=1024)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_build() -> bytes:
+            started.set()
+            release.wait()
+            return b'grid'
+
+        build = mock.Mock(side_effect=slow_build)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_build(key='k', build=build)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        build.assert_called_once()
+        self.assertEqual([b'grid'] * 4, results)
+
+    def test_failed_build_is_not_cached(self):
+        cache = ArtifactCache(max_size=1024)
+        with self.assertRaises(RuntimeError):
+            cache.get_or_build(key='k', build=mock.Mock(side_effect=RuntimeError('mkgmap failed')))
+        self.assertEqual(b'grid', cache.get_or_build(key='k', build=lambda: b'grid'))
+
+
+class TestGridService(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region" / "index-1"
+
+    def setUp(self):
+        self.service = GridService(poly_index=RegionIndex(self.RESOURCE_DIR), artifact_cache=ArtifactCache(1024 ** 2))
+        self.server = create_server(('127.0.0.1', 0), self.service)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _post(self, path: str, request: dict) -> bytes:
+        url = f'http://127.0.0.1:{self.server.server_address[1]}{path}'
+        with urllib.request.urlopen(urllib.request.Request(url, data=json.dumps(request).encode())) as response:
+            return response.read()
+
+    def test_osm(self):
+        response = self._post('/grid?format=osm', {'zoom_14': ['MT'], 'zoom_17': ['IE-C']})
+        with zipfile.ZipFile(io.BytesIO(response)) as zip_file:
+            self.assertEqual(['MT-14.osm', 'IE-C-17.osm'], zip_file.namelist())
+
+    def test_img_is_cached(self):
+        with mock.patch('squadrats2garmin.common.mkgmap.run_mkgmap', side_effect=fake_mkgmap) as run_mkgmap:
+            response = self._post('/grid?format=img', {'description': 'Malta', 'zoom_14': ['MT'], 'zoom_17': []})
+            self.assertIn(b'description=Malta', response)
+            self.assertEqual(2, run_mkgmap.call_count)
+
+            self.assertEqual(response, self._post('/grid', {'description': 'Malta', 'zoom_14': ['MT']}))
+            self.assertEqual(2, run_mkgmap.call_count)
+
+    def test_invalid_request(self):
+        for path, request in [('/grid', {'zoom_14': ['XX']}), ('/grid', {}), ('/grid?format=kml', {'zoom_14': ['MT']}),
+                              ('/grid', {'zoom_17': [{'route': '/etc/passwd'}]}),
+                              ('/grid', {'zoom_17': [{'bbox': [14, 35, 15, 36], 'within': {'polygon': 'MT.poly'}}]}),
+                              ('/grid', {'zoom_17': [{'bbox': [0, 0, 1, 1], 'name': '../../../../tmp/escaped'}]}),
+                              # values of wrong types
+                              ('/grid', {'zoom_14': 5}), ('/grid', {'zoom_14': 'MT'}), ('/grid', {'zoom_14': [5]}),
+                              ('/grid', {'zoom_14': ['MT'], 'description': ['Malta']}),
+                              ('/grid', {'zoom_17': [{'bbox': [14, 35, 15, 36], 'within': [None]}]})]:
+            with self.subTest(path=path, request=request):
+                with self.assertRaises(urllib.error.HTTPError) as context:
+                    self._post(path, request)
+                self.assertEqual(400, context.exception.code)
+
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            self._post('/unknown', {})
+        self.assertEqual(404, context.exception.code)
+
+
+if __name__ == '__main__':
+    unittest.main()
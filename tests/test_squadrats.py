@@ -1,14 +1,19 @@
+import math
+import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
 
 import shapely
 
 import squadrats2garmin.common.squadrats as squadrats
+from squadrats2garmin.common.cache import FileCache
 from squadrats2garmin.common.job import Job
 from squadrats2garmin.common.osm import Way
 from squadrats2garmin.common.poly import ExtensionAwarePolyLoader
-from squadrats2garmin.common.region import Subdivision, Country
+from squadrats2garmin.common.region import Footprint, GeometryCache, RegionIndex, Subdivision, Country, Route
 from squadrats2garmin.common.tile import ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS, Zoom
+from squadrats2garmin.squadrats2garmin import prepare_jobs
 
 
 class TestSquadratsClient(unittest.TestCase):
@@ -129,6 +134,144 @@ class TestSquadrats(unittest.TestCase):
         ways: list[Way] = squadrats.generate_grid(poly=job.region.coords, job=job)
         self.assertEqual(len(ways), 307)
 
+    def test_plan_shards(self):
+        footprint = self.region['PL-22'].footprint
+        self.assertEqual([], squadrats.plan_shards(footprint=footprint, zoom=ZOOM_SQUADRATS, max_tiles=20_000))
+
+        shards = squadrats.plan_shards(footprint=footprint, zoom=ZOOM_SQUADRATS, max_tiles=1_000)
+        self.assertLess(1, len(shards))
+        # shards cover all the lines from the top edge of the first row to the bottom edge of the last row
+        self.assertEqual(5193, shards[0].y_start)
+        self.assertEqual(5300 + 2, shards[-1].y_end)
+        for shard, next_shard in zip(shards, shards[1:]):
+            self.assertEqual(shard.y_end, next_shard.y_start)
+
+    def test_cached_jobs_need_no_coordinates(self):
+        with tempfile.TemporaryDirectory() as tmp_dir_name:
+            tmp_dir = Path(tmp_dir_name)
+            osm_cache = FileCache(root=tmp_dir / 'osm')
+
+            def prepare(cache: GeometryCache) -> list[Job]:
+                poly_index = RegionIndex(root_path=Path(__file__).parent / 'test_region' / 'index-1',
+                                         geometry_cache=cache, manifest_path=tmp_dir / 'region-index.json')
+                config = mock.Mock(regions={ZOOM_SQUADRATS: poly_index.select_regions(['MT']),
+                                            ZOOM_SQUADRATINHOS: poly_index.select_regions(['MT'])},
+                                   shard_max_tiles=1_000)
+                return prepare_jobs(config=config, output_dir=tmp_dir / 'output', osm_cache=osm_cache)
+
+            jobs = prepare(GeometryCache())
+            self.assertLess(2, len(jobs))
+
+            # shards are planned from the manifest and all the files are cached
+            cache = GeometryCache()
+            self.assertEqual([str(job) for job in jobs], [str(job) for job in prepare(cache)])
+            self.assertEqual(0, cache.misses)
+
+    def test_generate_grid_sharded(self):
+        """Test that shards together produce exactly the edges of the whole region"""
+        region = self.region['PL-22']
+        job = Job(region=region, zoom=ZOOM_SQUADRATS, osm_file=None)
+        expected = grid_segments(squadrats.generate_grid(poly=region.coords, job=job), zoom=ZOOM_SQUADRATS)
+
+        segments = []
+        for shard in squadrats.plan_shards(footprint=region.footprint, zoom=ZOOM_SQUADRATS, max_tiles=1_000):
+            job = Job(region=region, zoom=ZOOM_SQUADRATS, osm_file=None, shard=shard)
+            segments.extend(grid_segments(squadrats.generate_grid(poly=region.coords, job=job), zoom=ZOOM_SQUADRATS))
+
+        # no edge is missing or generated twice at the seams
+        self.assertEqual(len(set(segments)), len(segments))
+        self.assertEqual(set(expected), set(segments))
+
+
+class TestTrackTileMapGenerator(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_track"
+
+    def setUp(self):
+        self.route = Route(path=self.RESOURCE_DIR / 'gdansk.gpx', buffer=250)
+        self._generator = squadrats.TrackTileMapGenerator(track=self.route.track, buffer=self.route.buffer)
+
+    def test_covers_corridor(self):
+        for zoom in [ZOOM_SQUADRATS, ZOOM_SQUADRATINHOS]:
+            walked = map_tiles(self._generator.generate_rows(poly=self.route.coords, zoom=zoom))
+            clipped = map_tiles(squadrats.ShapelyTileMapGenerator().generate_rows(poly=self.route.coords, zoom=zoom))
+
+            # every tile of the buffered corridor is walked, tiles off the corridor are the exception
+            self.assertLessEqual(clipped, walked)
+            if zoom == ZOOM_SQUADRATINHOS:
+                self.assertLess(len(walked - clipped), 0.1 * len(clipped))
+
+            columns = {(x, y) for (y, x) in map_tiles(self._generator.generate_cols(poly=None, zoom=zoom))}
+            self.assertEqual(walked, columns)
+
+    def test_footprint(self):
+        with mock.patch('squadrats2garmin.common.region.corridor') as corridor:
+            footprint = self.route.footprint
+        corridor.assert_not_called()
+
+        # the footprint covers the corridor, the area is estimated from the length of the track
+        corridor = Footprint.of(self.route.coords)
+        self.assertTrue(shapely.box(*footprint.bbox).contains(shapely.box(*corridor.bbox)))
+        self.assertLess(corridor.area, footprint.area)
+        self.assertLess(footprint.area, 1.5 * corridor.area)
+
+    def test_generate_grid(self):
+        job = Job(region=self.route, zoom=ZOOM_SQUADRATINHOS, osm_file=Path('route-gdansk-17.osm'))
+        self.assertIsInstance(squadrats.tile_map_generator(job), squadrats.TrackTileMapGenerator)
+
+        # every tile has 4 edges, edges of the adjacent tiles are shared
+        tiles = map_tiles(self._generator.generate_rows(poly=None, zoom=ZOOM_SQUADRATINHOS))
+        segments = set(grid_segments(squadrats.generate_grid(poly=self.route.coords, job=job,
+                                                             generator=self._generator), ZOOM_SQUADRATINHOS))
+        expected = {edge
+                    for (y, x) in tiles
+                    for edge in [((x, y), (x + 1, y)), ((x, y + 1), (x + 1, y + 1)),
+                                 ((x, y), (x, y + 1)), ((x + 1, y), (x + 1, y + 1))]}
+        self.assertEqual(expected, segments)
+
+    def test_corridor_is_not_built(self):
+        config = mock.Mock(regions={ZOOM_SQUADRATS: [self.route], ZOOM_SQUADRATINHOS: [self.route]},
+                           shard_max_tiles=1000)
+        with tempfile.TemporaryDirectory() as tmp_dir_name, \
+                mock.patch('squadrats2garmin.common.region.corridor') as corridor:
+            jobs = prepare_jobs(config=config, output_dir=Path(tmp_dir_name))
+
+            self.assertEqual([True, True], [job.osm_file.exists() for job in jobs])
+        corridor.assert_not_called()
+
+
+def map_tiles(tiles: squadrats.TileMap) -> set[tuple[int, int]]:
+    """Convert the tile map into a set of (key, value) tiles"""
+    return {(key, value) for key, ranges in tiles.items() for start, end in ranges for value in range(start, end + 1)}
+
+
+def test_walk_route(benchmark):
+    route = Route(path=TestTrackTileMapGenerator.RESOURCE_DIR / 'gdansk.gpx', buffer=250)
+
+    def walk():
+        generator = squadrats.TrackTileMapGenerator(track=route.track, buffer=route.buffer)
+        return generator.generate_rows(poly=None, zoom=ZOOM_SQUADRATINHOS)
+
+    result = benchmark(walk)
+    assert result
+
+
+def grid_segments(ways: list[Way], zoom: Zoom) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+    """Split ways into edges of single tiles, nodes are converted back to tile coordinates"""
+    n = 2 ** zoom.zoom
+
+    def to_tile(node) -> tuple[int, int]:
+        return (round((node.lon + 180.0) / 360.0 * n),
+                round((1.0 - math.asinh(math.tan(math.radians(node.lat))) / math.pi) / 2.0 * n))
+
+    segments = []
+    for way in ways:
+        (x_1, y_1), (x_2, y_2) = to_tile(way.nodes[0]), to_tile(way.nodes[-1])
+        if y_1 == y_2:
+            segments.extend(((x, y_1), (x + 1, y_1)) for x in range(x_1, x_2))
+        else:
+            segments.extend(((x_1, y), (x_1, y + 1)) for y in range(y_1, y_2))
+    return segments
+
 def tiles_to_geojson(tiles: squadrats.TileMap, zoom: Zoom) -> str:
     return shapely.to_geojson(shapely.multipolygons([
         tile_to_polygon(x=x, y=y, zoom=zoom)
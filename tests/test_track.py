@@ -0,0 +1,63 @@
+import json
+import math
+import tempfile
+import unittest
+from pathlib import Path
+
+import shapely
+
+from squadrats2garmin.common.poly import PolyFileFormatException
+from squadrats2garmin.common.track import EARTH_RADIUS, corridor, load_track
+
+
+class TestTrack(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_track"
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def test_load_gpx(self):
+        track = load_track(self.RESOURCE_DIR / 'gdansk.gpx')
+        self.assertEqual(1, len(track.geoms))
+        self.assertEqual(400, len(track.geoms[0].coords))
+        self.assertEqual((18.6004, 54.35), track.geoms[0].coords[0])
+
+    def test_load_gpx_route(self):
+        path = self.tmp_dir / 'route.gpx'
+        path.write_text('<gpx version="1.0" xmlns="http://www.topografix.com/GPX/1/0"><rte>'
+                        '<rtept lat="54.0" lon="18.0"/><rtept lat="54.1" lon="18.1"/>'
+                        '</rte></gpx>')
+        self.assertEqual([[(18.0, 54.0), (18.1, 54.1)]], [list(line.coords) for line in load_track(path).geoms])
+
+    def test_load_geojson(self):
+        path = self.tmp_dir / 'route.geojson'
+        path.write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {},
+             'geometry': {'type': 'LineString', 'coordinates': [[18.0, 54.0], [18.1, 54.1]]}},
+            {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': [18.0, 54.0]}},
+        ]}))
+        self.assertEqual([[(18.0, 54.0), (18.1, 54.1)]], [list(line.coords) for line in load_track(path).geoms])
+
+    def test_no_track(self):
+        path = self.tmp_dir / 'empty.gpx'
+        path.write_text('<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg/></trk></gpx>')
+        with self.assertRaises(PolyFileFormatException):
+            load_track(path)
+
+    def test_corridor(self):
+        track = load_track(self.RESOURCE_DIR / 'gdansk.gpx')
+        poly = corridor(track=track, buffer=250)
+
+        self.assertEqual('MultiPolygon', poly.geom_type)
+        self.assertTrue(poly.contains(track))
+        self.assertTrue(poly.geoms[0].exterior.is_ccw)
+
+        # corridor reaches at least the buffer distance south of the track
+        (_, track_s, _, _) = track.bounds
+        (_, poly_s, _, _) = poly.bounds
+        distance = math.radians(track_s - poly_s) * EARTH_RADIUS
+        self.assertTrue(250 <= distance < 260, distance)
+
+
+if __name__ == '__main__':
+    unittest.main()
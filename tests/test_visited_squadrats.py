@@ -0,0 +1,85 @@
+import json
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+from parameterized import parameterized
+
+from squadrats2garmin.common.tile import ZOOM_SQUADRATINHOS
+from squadrats2garmin.visited_squadrats import GeoJSONFileProvider, GeoJSONOSMProducer, _simplify_ring
+
+
+class TestSimplifyRing(unittest.TestCase):
+
+    @parameterized.expand([
+        ('straight edges', [(0, 0), (1, 0), (2, 0), (2, 1), (2, 2), (0, 2), (0, 1), (0, 0)],
+         [(0, 0), (2, 0), (2, 2), (0, 2)]),
+        ('repeated vertices', [(0, 0), (2, 0), (2, 0), (2, 2), (0, 2), (0, 0)], [(0, 0), (2, 0), (2, 2), (0, 2)]),
+        ('starts mid edge', [(1, 0), (2, 0), (2, 2), (0, 2), (0, 0), (1, 0)], [(2, 0), (2, 2), (0, 2), (0, 0)]),
+        ('spike', [(0, 0), (2, 0), (3, 0), (2, 0), (2, 2), (0, 2), (0, 0)], [(0, 0), (2, 0), (2, 2), (0, 2)]),
+        # tiles touching diagonally, the ring passes the shared corner twice
+        ('touching', [(0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (1, 2), (1, 1), (0, 1), (0, 0)],
+         [(0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (1, 2), (1, 1), (0, 1)]),
+        ('degenerate', [(0, 0), (1, 0), (2, 0), (0, 0)], [(0, 0)]),
+    ])
+    def test_simplify_ring(self, _, vertices: list[tuple[int, int]], expected: list[tuple[int, int]]):
+        self.assertEqual(expected, _simplify_ring(vertices))
+
+
+class TestGeoJSONOSMProducer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    @staticmethod
+    def ring(*tiles: tuple[int, int]) -> list[list[float]]:
+        """Closed ring through the corners of the squadratinhos, off the lattice by a rounding error"""
+        x, y = ZOOM_SQUADRATINHOS.x(18.6), ZOOM_SQUADRATINHOS.y(54.35)
+        return [[coord + 1e-9 for coord in ZOOM_SQUADRATINHOS.to_point((x + dx, y + dy))]
+                for dx, dy in [*tiles, tiles[0]]]
+
+    def test_to_file(self):
+        # square with vertices in the middle of its edges and a hole, adjacent square sharing an edge
+        left = self.ring((0, 0), (2, 0), (4, 0), (4, 2), (4, 4), (2, 4), (0, 4), (0, 2))
+        hole = self.ring((1, 1), (1, 3), (3, 3), (3, 1))
+        right = self.ring((4, 0), (6, 0), (6, 4), (4, 4), (4, 2))
+        geojson = self.tmp_dir / 'trophies.geojson'
+        geojson.write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {'name': 'squadrats'},
+             'geometry': {'type': 'MultiPolygon', 'coordinates': [[left, hole], [right]]}},
+            {'type': 'Feature', 'properties': {'name': 'unknown'},
+             'geometry': {'type': 'Polygon', 'coordinates': [left]}},
+            {'type': 'Feature', 'properties': {'name': 'squadratinhos'},
+             'geometry': {'type': 'Polygon', 'coordinates': [self.ring((0, 5), (1, 5), (2, 5))]}},
+            {'type': 'Feature', 'properties': {'name': 'ubersquadrat'},
+             'geometry': {'type': 'Polygon', 'coordinates': [right]}},
+        ]}))
+
+        osm = self.tmp_dir / 'trophies.osm'
+        GeoJSONOSMProducer(provider=GeoJSONFileProvider(geojson)).to_file(osm)
+
+        document = ET.parse(osm).getroot()
+        # corners of the squares and of the hole, each written once
+        nodes = {node.get('id'): (float(node.get('lon')), float(node.get('lat'))) for node in document.findall('node')}
+        self.assertEqual(4 + 4 + 2, len(nodes))
+        x, y = ZOOM_SQUADRATINHOS.x(18.6), ZOOM_SQUADRATINHOS.y(54.35)
+        self.assertIn(ZOOM_SQUADRATINHOS.to_point((x, y)), nodes.values())
+
+        ways = [[nd.get('ref') for nd in way.findall('nd')] for way in document.findall('way')]
+        self.assertEqual([5, 5, 5, 5], [len(refs) for refs in ways])
+        # rings are closed by referencing the first node
+        self.assertTrue(all(refs[0] == refs[-1] for refs in ways))
+        # the squares share the nodes of the common edge, the trophies share the whole ring
+        self.assertEqual(2, len(set(ways[0]) & set(ways[2])))
+        self.assertEqual(set(ways[2]), set(ways[3]))
+
+        # degenerate ring is left out together with its relation
+        relations = document.findall('relation')
+        self.assertEqual(['squadrats', 'ubersquadrat'],
+                         [relation.find("tag[@k='name']").get('v') for relation in relations])
+        self.assertEqual(['outer', 'outer', 'inner'], [member.get('role') for member in relations[0]
+                                                       if member.tag == 'member'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from squadrats2garmin.common.region import RegionIndex
+from squadrats2garmin.common.watch import PollingWatcher
+from squadrats2garmin.squadrats2garmin import watch_config_files
+
+
+class TestPollingWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+    def test_poll(self):
+        (self.tmp_dir / 'polygons').mkdir()
+        modified = self.tmp_dir / 'polygons' / 'MT-Malta.poly'
+        modified.write_text('MT')
+        removed = self.tmp_dir / 'polygons' / 'IE-C-Connaught.poly'
+        removed.write_text('IE-C')
+        config = self.tmp_dir / 'MT.json'
+        config.write_text('{}')
+
+        watcher = PollingWatcher(paths=[self.tmp_dir / 'polygons', config], interval=0)
+        self.assertEqual(set(), watcher.poll())
+
+        modified.write_text('Malta')
+        removed.unlink()
+        added = self.tmp_dir / 'polygons' / 'IE-L-Leinster.poly'
+        added.write_text('IE-L')
+        self.assertEqual({modified, removed, added}, watcher.poll())
+
+        # changes are reported only once
+        self.assertEqual(set(), watcher.poll())
+
+
+class TestWatchConfigFiles(unittest.TestCase):
+    RESOURCE_DIR = Path(__file__).parent / "test_region" / "index-1"
+
+    def setUp(self):
+        self.tmp_dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+
+        self.polygons_dir = self.tmp_dir / 'polygons'
+        shutil.copytree(self.RESOURCE_DIR, self.polygons_dir)
+
+        self.config_files = []
+        for code, regions in [('MT', ['MT']), ('IE', ['IE-C', 'IE-L'])]:
+            config_file = self.tmp_dir / f'{code}.json'
+            config_file.write_text(json.dumps({'output': f'{code}.img', 'description': code,
+                                               'zoom_14': regions, 'zoom_17': []}))
+            self.config_files.append(str(config_file))
+
+    def _watch(self, changes: list[set[Path]], poly_index: RegionIndex | None = None) -> list[list[str]]:
+        """Run the watch loop for the given sequence of changes, return config files processed in every run"""
+        poly_index = poly_index or RegionIndex(self.polygons_dir)
+        process = mock.Mock()
+        with mock.patch.object(PollingWatcher, 'wait', side_effect=[*changes, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                watch_config_files(config_files=self.config_files, poly_index=poly_index,
+                                   polygons_dir=self.polygons_dir, interval=0, process=process)
+        return [call.args[0] for call in process.call_args_list]
+
+    def test_changed_polygon(self):
+        connaught = self.polygons_dir / 'IE-Éire' / 'IE-C-Connaught.poly'
+        runs = self._watch([{connaught}, {self.polygons_dir / 'IE-Éire' / 'IE-M-Munster.poly'}])
+
+        # initial run, polygon used by IE only, polygon not used by any config
+        self.assertEqual([self.config_files, [self.config_files[1]]], runs)
+
+    def test_changed_config(self):
+        runs = self._watch([{Path(self.config_files[0])}])
+        self.assertEqual([self.config_files, [self.config_files[0]]], runs)
+
+    def test_added_polygon(self):
+        poly_index = RegionIndex(self.polygons_dir)
+        added = self.polygons_dir / 'IE-Éire' / 'IE-D-Dublin.poly'
+        shutil.copyfile(self.polygons_dir / 'IE-Éire' / 'IE-L-Leinster.poly', added)
+        runs = self._watch([{added}], poly_index=poly_index)
+
+        # polygon index is rebuilt and all config files are processed
+        self.assertEqual([self.config_files, self.config_files], runs)
+
+    def test_broken_index(self):
+        poly_index = RegionIndex(self.polygons_dir)
+        # unknown country code fails the rebuild of the index
+        added = self.polygons_dir / 'XX-Nowhere.geojson'
+        shutil.copyfile(self.polygons_dir / 'MT-Malta.geojson', added)
+        with self.assertLogs('squadrats2garmin.squadrats2garmin', level='ERROR'):
+            runs = self._watch([{added}, {Path(self.config_files[0])}], poly_index=poly_index)
+
+        # watching goes on with the previous index
+        self.assertEqual([self.config_files, [self.config_files[0]]], runs)
+
+    def test_changed_polygon_is_reloaded(self):
+        poly_index = RegionIndex(self.polygons_dir)
+        [malta] = poly_index.select_regions(['MT'])
+        coords = malta.coords
+
+        poly_index.invalidate([self.polygons_dir / 'IE-Éire' / 'IE-C-Connaught.poly'])
+        self.assertIs(coords, malta.coords)
+
+        poly_index.invalidate([malta.poly_path])
+        self.assertIsNot(coords, malta.coords)
+        self.assertTrue(coords.equals(malta.coords))
+
+
+if __name__ == '__main__':
+    unittest.main()